@@ -1,10 +1,52 @@
 import os
 
 import argparse
-import pandas as pd
+from collections import defaultdict
+
+import pyarrow as pa
+import pyarrow.parquet as pq
 from datasets import load_dataset
 
-from emac.utils import parse_action
+from rca.datasets.prefix_dataset import MESSAGES_TYPE, PrefixDatasetWriter
+from rca.utils.parsing import parse_action
+
+SCHEMA = pa.schema(
+    [
+        ("id", pa.int64()),
+        ("turn", pa.int64()),
+        ("input", MESSAGES_TYPE),
+        ("output", pa.string()),
+        ("N", pa.int64()),
+        ("data_source", pa.string()),
+        ("reward_model", pa.struct([("ground_truth", pa.string())])),
+        (
+            "extra_info",
+            pa.struct([("task", pa.string()), ("ground_truth", pa.string()), ("reward_partial", pa.bool_())]),
+        ),
+    ]
+)
+
+
+def to_messages(row):
+    """Messages of one trajectory, with the assistant turns reduced to their action."""
+    messages = [{"role": "system", "content": row["system"]}]
+    for step in row["conversations"]:
+        role = step["from"]
+        content = step["value"]
+
+        content = parse_action(content, string_only=True) if role == "gpt" else content
+        new_role = "assistant" if role == "gpt" else "user"
+        messages.append({"role": new_role, "content": content})
+    return messages
+
+
+def split_of(rank):
+    # `rank` counts samples in length order across buckets, so that every 10th sample goes to valid/test
+    # and the splits keep the length distribution (per-bucket ranks would send buckets of 1-8 samples to train)
+    if rank % 10 < 8:
+        return "train"
+    return "valid" if rank % 10 == 8 else "test"
+
 
 def main(args):
 
@@ -15,78 +57,73 @@ def main(args):
     else:
         dataset = load_dataset(args.data_path, split='train')
         task_name = args.task_name or args.data_path
+    data_source = f"{args.data_path}/{args.data_name}" if args.data_name else args.data_path
 
-    # Convert to pandas DataFrame
-    df = dataset.to_pandas()
-
-    def process_row(row):
-        system_message = row["system"]
-        conversations = row["conversations"]
-        messages = []
-        ongoing_message = [{"role": "system", "content": system_message}]
-        for step in conversations:
-            role = step["from"]
-            content = step["value"]
-
-            content = parse_action(content, string_only=True) if role == "gpt" else content
-            new_role = "assistant" if role == "gpt" else "user"
-            ongoing_message.append({"role": new_role, "content": content})
-
-            if role == "gpt":
-                messages.append(
-                    ongoing_message.copy()
-                )
-    
-        return pd.Series(messages)
-    
-    _df = df.apply(lambda x: process_row(x), axis=1)  # Example operation, replace with actual logic
-    data_df = pd.DataFrame()
-    _df = _df.stack().reset_index()
-    data_df["full_trajectory"] = _df[0]
-    data_df["id"] = _df["level_0"]
-    data_df["turn"] = _df["level_1"]
-    data_df["input"] = data_df["full_trajectory"].apply(lambda x: x[:-1])
-    data_df["output"] = data_df["full_trajectory"].apply(lambda x: x[-1]["content"])
-    data_df["N"] = data_df["input"].apply(lambda x: len(x))
-
-    data_df['data_source'] = f"{args.data_path}/{args.data_name}" if args.data_name else args.data_path
-
-    data_df['reward_model'] = data_df.apply(
-        lambda row: {
-            "ground_truth": row["output"],
-        },
-        axis=1
-    )
-
-    data_df["extra_info"] = data_df.apply(
-        lambda row: {
-            "task": row["data_source"],
-            "ground_truth": row["output"],
-            "reward_partial": True,
-        }, 
-        axis=1
-    )
-
-    # Sort by input length to ensure even distribution
-    data_df = data_df.sort_values('N').reset_index(drop=True)
-    data_df = data_df.drop(columns=['full_trajectory']) 
-    
-    task_size = len(data_df)
-    indices = list(range(task_size))
-    # Create stratified splits by distributing every 10th sample to maintain length distribution
-    train_indices = [i for i in indices if i % 10 < 8]
-    valid_indices = [i for i in indices if i % 10 == 8]
-    test_indices = [i for i in indices if i % 10 == 9]
-
-    train_df = data_df.loc[train_indices].reset_index(drop=True)
-    valid_df = data_df.loc[valid_indices].reset_index(drop=True)
-    test_df = data_df.loc[test_indices].reset_index(drop=True)
-
+    # Each trajectory is kept once, a sample (one per assistant turn) is a `(trajectory_id, turn)` reference
+    # into it. Samples are bucketed by input length `N`, i.e. the position of the assistant message, which
+    # orders them by length without a sort and without materializing any prefix.
     save_path = os.path.join(args.output_path, task_name)
+    # `prefix`: only the trajectories and the references are saved, see `rca.datasets.prefix_dataset`
+    prefix_writer = PrefixDatasetWriter(save_path, data_source) if args.format == "prefix" else None
+    trajectories = []
+    buckets = defaultdict(list)
+    for trajectory_id, row in enumerate(dataset.select_columns(["system", "conversations"])):
+        messages = to_messages(row)
+        if prefix_writer is not None:
+            prefix_writer.add_trajectory(messages)
+        else:
+            trajectories.append(messages)
+        turn = 0
+        for position, message in enumerate(messages):
+            if message["role"] == "assistant":
+                buckets[position].append((trajectory_id, turn))
+                turn += 1
+
+    # samples in length order
+    samples = ((n, trajectory_id, turn) for n in sorted(buckets) for trajectory_id, turn in buckets[n])
+
+    if prefix_writer is not None:
+        with prefix_writer:
+            for rank, (n, trajectory_id, turn) in enumerate(samples):
+                prefix_writer.add_sample(split_of(rank), trajectory_id, turn, n)
+        return
+
     os.makedirs(save_path, exist_ok=True)
-    train_df.to_parquet(os.path.join(save_path, "train.parquet"))
-    valid_df.to_parquet(os.path.join(save_path, "valid.parquet"))
-    test_df.to_parquet(os.path.join(save_path, "test.parquet"))
+    writers = {
+        split: pq.ParquetWriter(os.path.join(save_path, f"{split}.parquet"), SCHEMA)
+        for split in ("train", "valid", "test")
+    }
+    buffers = {split: [] for split in writers}
+
+    def flush(split):
+        writers[split].write_table(pa.Table.from_pylist(buffers[split], schema=SCHEMA))
+        buffers[split].clear()
+
+    # Only the rows of one row group per split are materialized at a time
+    try:
+        for rank, (n, trajectory_id, turn) in enumerate(samples):
+            output = trajectories[trajectory_id][n]["content"]
+            split = split_of(rank)
+            buffers[split].append(
+                {
+                    "id": trajectory_id,
+                    "turn": turn,
+                    "input": trajectories[trajectory_id][:n],
+                    "output": output,
+                    "N": n,
+                    "data_source": data_source,
+                    "reward_model": {"ground_truth": output},
+                    "extra_info": {"task": data_source, "ground_truth": output, "reward_partial": True},
+                }
+            )
+            if len(buffers[split]) >= args.row_group_size:
+                flush(split)
+        for split in writers:
+            if buffers[split]:
+                flush(split)
+    finally:
+        for writer in writers.values():
+            writer.close()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Construct data from datasets')
@@ -94,5 +131,7 @@ if __name__ == "__main__":
     parser.add_argument('--data_name', type=str, help='Name of the dataset configuration')
     parser.add_argument('--output_path', type=str, required=True, help='Path to save the processed data')
     parser.add_argument('--task_name', type=str, default=None, help='Name of the task')
+    parser.add_argument('--row_group_size', type=int, default=1000, help='Rows per parquet row group')
+    parser.add_argument('--format', type=str, default='parquet', choices=['parquet', 'prefix'], help='Output format, `prefix` stores each trajectory once and references into it')
     args = parser.parse_args()
-    main(args)
\ No newline at end of file
+    main(args)
@@ -0,0 +1,2 @@
+from .reminder_agent import AsyncAgentWithReminder, DefaultAgentWithReminder
+from .early_stop_agent import EarlyStopAgent, EarlyStopLitellmModel
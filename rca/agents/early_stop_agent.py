@@ -0,0 +1,171 @@
+import logging
+from dataclasses import dataclass
+
+import litellm
+from tenacity import (
+    before_sleep_log,
+    retry,
+    retry_if_not_exception_type,
+    stop_after_attempt,
+    wait_exponential,
+)
+
+from minisweagent import Environment
+from minisweagent.agents.default import AgentConfig, FormatError, LimitsExceeded
+from minisweagent.models import GLOBAL_MODEL_STATS
+from minisweagent.models.litellm_model import LitellmModel
+
+from rca.agents.reminder_agent import DefaultAgentWithReminder
+from rca.utils.parsing import StreamingActionParser, StreamingBashBlockParser, parse_action
+
+logger = logging.getLogger("litellm_model")
+
+ACTION_PARSERS = {
+    "bash": StreamingBashBlockParser,
+    "function": StreamingActionParser,
+}
+
+
+class EarlyStopLitellmModel(LitellmModel):
+    """`LitellmModel` that streams the completion and stops reading it once `action_parser` has a complete action.
+
+    Closing the stream makes vLLM/OpenAI-compatible servers abort the request, so the tokens after the action are
+    never decoded. The returned content ends with the action. Per call, `early_stop_stats` records the generated
+    `completion_tokens`, whether the call was `early_stopped` and `saved_tokens_upper_bound`, the part of the
+    `max_tokens` budget that was left. The model may have ended its turn right after the action anyway, so the
+    actual saving is usually much smaller (`None` without `max_tokens`).
+
+    Streamed responses don't carry the token ids of `miniswe_capture_tokens`.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.early_stop_stats: list[dict] = []
+
+    @retry(
+        stop=stop_after_attempt(10),
+        wait=wait_exponential(multiplier=1, min=4, max=60),
+        before_sleep=before_sleep_log(logger, logging.WARNING),
+        retry=retry_if_not_exception_type(
+            (
+                litellm.exceptions.UnsupportedParamsError,
+                litellm.exceptions.NotFoundError,
+                litellm.exceptions.PermissionDeniedError,
+                litellm.exceptions.ContextWindowExceededError,
+                litellm.exceptions.APIError,
+                litellm.exceptions.AuthenticationError,
+                KeyboardInterrupt,
+            )
+        ),
+    )
+    def _stream(self, messages: list[dict[str, str]], **kwargs):
+        return litellm.completion(
+            model=self.config.model_name,
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True},
+            **(self.config.model_kwargs | kwargs),
+        )
+
+    def query(self, messages: list[dict[str, str]], action_parser=None, **kwargs) -> dict:
+        if action_parser is None:
+            return super().query(messages, **kwargs)
+        stream = self._stream(messages, **kwargs)
+        chunks = []
+        early_stopped = False
+        for chunk in stream:
+            chunks.append(chunk)
+            if chunk.choices and (delta := chunk.choices[0].delta.content):
+                action_parser.feed(delta)
+                if action_parser.done:
+                    early_stopped = True
+                    break
+        if early_stopped and (close := getattr(getattr(stream, "completion_stream", None), "close", None)):
+            close()
+        response = litellm.stream_chunk_builder(chunks, messages=messages)
+        try:
+            cost = litellm.cost_calculator.completion_cost(response)
+        except Exception as e:
+            logger.critical(f"Error calculating cost for model {self.config.model_name}: {e}.")
+            raise
+        self.n_calls += 1
+        self.cost += cost
+        GLOBAL_MODEL_STATS.add(cost)
+
+        content = response.choices[0].message.content or ""  # type: ignore
+        completion_tokens = response.usage.completion_tokens  # type: ignore
+        max_tokens = (self.config.model_kwargs | kwargs).get("max_tokens")
+        stats = {
+            "completion_tokens": completion_tokens,
+            "early_stopped": early_stopped,
+            "saved_tokens_upper_bound": (
+                max(max_tokens - completion_tokens, 0) if early_stopped and max_tokens else None
+            ),
+        }
+        self.early_stop_stats.append(stats)
+        return {
+            "content": content[: action_parser.end] if early_stopped else content,
+            "extra": {
+                "response": response.model_dump(),
+                "early_stop": stats,
+            },
+        }
+
+
+@dataclass
+class EarlyStopAgentConfig(AgentConfig):
+    action_format: str = "bash"
+    """`bash` (```` ```bash ``` ```` blocks, as in `config_yaml/swebench.yaml`) or `function` (`<function=...>`)."""
+    bash_functions: tuple[str, ...] = ("bash", "execute_bash")
+    """With `action_format=function`, the functions whose `command` parameter is run as a bash command."""
+    early_stop: bool = True
+
+
+class EarlyStopAgent(DefaultAgentWithReminder):
+    """`DefaultAgentWithReminder` that stops generation after the first complete action.
+
+    Actions are ```` ```bash ``` ```` blocks or, with `action_format=function`, `<function=...>` calls of one of
+    the `bash_functions`. Needs a model whose `query` accepts an `action_parser`, like `EarlyStopLitellmModel`.
+    Note that this changes behavior for responses with several actions: `DefaultAgent` rejects them with a
+    format error, here the first action is executed and the rest is never generated.
+    """
+
+    def __init__(self, model: EarlyStopLitellmModel, env: Environment, *, config_class: type = EarlyStopAgentConfig, **kwargs):
+        super().__init__(model, env, config_class=config_class, **kwargs)
+        if self.config.action_format not in ACTION_PARSERS:
+            raise ValueError(f"Unknown action_format: {self.config.action_format}")
+
+    def query(self) -> dict:
+        if 0 < self.config.step_limit <= self.model.n_calls or 0 < self.config.cost_limit <= self.model.cost:
+            raise LimitsExceeded()
+        if self.config.early_stop:
+            response = self.model.query(self.messages, action_parser=ACTION_PARSERS[self.config.action_format]())
+        else:
+            response = self.model.query(self.messages)
+        self.add_message("assistant", **response)
+        return response
+
+    def parse_action(self, response: dict) -> dict:
+        if self.config.action_format == "bash":
+            return super().parse_action(response)
+        action = parse_action(response["content"])
+        if action is None or action[0] not in self.config.bash_functions or "command" not in action[1]:
+            actions = [] if action is None else [parse_action(response["content"], string_only=True)]
+            raise FormatError(self.render_template(self.config.format_error_template, actions=actions))
+        return {"action": action[1]["command"], **response}
+
+
+def get_early_stop_info(model) -> dict:
+    """Totals of `EarlyStopLitellmModel.early_stop_stats` for a trajectory's `extra_info`, empty for other models."""
+    stats = getattr(model, "early_stop_stats", None)
+    if not stats:
+        return {}
+    saved = [s["saved_tokens_upper_bound"] for s in stats if s["saved_tokens_upper_bound"] is not None]
+    return {
+        "early_stop": {
+            "calls": len(stats),
+            "early_stopped": sum(s["early_stopped"] for s in stats),
+            "completion_tokens": sum(s["completion_tokens"] for s in stats),
+            "saved_tokens_upper_bound": sum(saved) if saved else None,
+        }
+    }
@@ -0,0 +1,85 @@
+import asyncio
+import subprocess
+
+from minisweagent.agents.default import (
+    DefaultAgent,
+    ExecutionTimeoutError,
+    LimitsExceeded,
+    NonTerminatingException,
+    TerminatingException,
+)
+
+from rca.utils.templates import CachedTemplateRenderer
+
+
+class DefaultAgentWithReminder(CachedTemplateRenderer, DefaultAgent):
+    def get_observation(self, response: dict) -> dict:
+        """Execute the action and return the output."""
+        output = self.execute_action(self.parse_action(response))
+        self.add_observation(output)
+        return output
+
+    def add_observation(self, output: dict):
+        observation = self.render_template(self.config.action_observation_template, output=output)
+        remaining = self.config.step_limit - self.model.n_calls
+
+        if remaining == 1:
+            observation = f"{observation}\nREMINDER: You only have 1 turn left. Please provide the final answer"
+        elif remaining > 1:
+            observation = f"{observation}\nREMINDER: You have {remaining} turns left to arrive at the solution."
+
+        self.add_message("user", observation)
+
+
+class AsyncAgentWithReminder(DefaultAgentWithReminder):
+    """`DefaultAgentWithReminder` with a coroutine control flow, so that one event loop can drive many trajectories.
+
+    The model must provide `aquery` (see `rca.generators.async_runner.AsyncLitellmModel`). Environments are used
+    through `aexecute` if they have one, otherwise their blocking `execute` runs in a worker thread.
+    """
+
+    async def arun(self, task: str, **kwargs) -> tuple[str, str]:
+        """Run astep() until agent is finished. Return exit status & message"""
+        self.extra_template_vars |= {"task": task, **kwargs}
+        self.messages = []
+        self.add_message("system", self.render_template(self.config.system_template))
+        self.add_message("user", self.render_template(self.config.instance_template))
+        while True:
+            try:
+                await self.astep()
+            except NonTerminatingException as e:
+                self.add_message("user", str(e))
+            except TerminatingException as e:
+                self.add_message("user", str(e))
+                return type(e).__name__, str(e)
+
+    async def astep(self) -> dict:
+        return await self.aget_observation(await self.aquery())
+
+    async def aquery(self) -> dict:
+        if 0 < self.config.step_limit <= self.model.n_calls or 0 < self.config.cost_limit <= self.model.cost:
+            raise LimitsExceeded()
+        response = await self.model.aquery(self.messages)
+        self.add_message("assistant", **response)
+        return response
+
+    async def aget_observation(self, response: dict) -> dict:
+        output = await self.aexecute_action(self.parse_action(response))
+        self.add_observation(output)
+        return output
+
+    async def aexecute_action(self, action: dict) -> dict:
+        try:
+            if hasattr(self.env, "aexecute"):
+                output = await self.env.aexecute(action["action"])
+            else:
+                output = await asyncio.to_thread(self.env.execute, action["action"])
+        except subprocess.TimeoutExpired as e:
+            output = e.output.decode("utf-8", errors="replace") if e.output else ""
+            raise ExecutionTimeoutError(
+                self.render_template(self.config.timeout_template, action=action, output=output)
+            )
+        except TimeoutError:
+            raise ExecutionTimeoutError(self.render_template(self.config.timeout_template, action=action, output=""))
+        self.has_finished(output)
+        return output
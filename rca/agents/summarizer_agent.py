@@ -2,39 +2,263 @@
 
 import re
 import subprocess
+import time
 from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from dataclasses import asdict, dataclass
 
-from jinja2 import StrictUndefined, Template
-
 from minisweagent import Environment, Model
 
 from minisweagent.agents.default import AgentConfig, DefaultAgent, LimitsExceeded
 
+from rca.utils.templates import CachedTemplateRenderer
+
+
+@dataclass
+class SummarizerAgentConfig(AgentConfig):
+    summary_mode: str = "full"
+    """`full`: summarize the whole history every step. `incremental`: fold only the messages added since
+    the last summary into the previous summary."""
+    summary_refresh_interval: int = 1
+    """Update the summary every N steps, steps in between reuse the previous summary."""
+    summary_input_token_budget: int = 0
+    """Incremental mode: approximate token budget for the new messages sent to the summarizer, longer
+    messages are truncated in the middle. 0 means no limit."""
+    summary_max_tokens: int = 0
+    """`max_tokens` for summarizer calls, 0 uses the model's default."""
+    summary_pipeline: bool = False
+    """Compute the next summary in the background while the command runs and after its observation arrives,
+    instead of right before the deliberator call."""
+    summary_deadline: float = 5.0
+    """Pipelined mode: seconds the deliberator waits for an in-flight summary before using the previous one."""
+    summarizer_system_template: str = (
+        "You maintain a concise running summary of a software engineering agent's trajectory. "
+        "Keep everything needed to continue the task: findings, edited files, commands that failed and why."
+    )
+    summary_update_template: str = (
+        "{% if summary %}Current summary:\n{{summary}}\n\n{% endif %}"
+        "New messages:\n{% for message in new_messages %}[{{message.role}}]\n{{message.content}}\n\n{% endfor %}"
+        "Return the updated summary."
+    )
+
+
+def _approx_tokens(text: str) -> int:
+    return len(text) // 4
+
+
+def _truncate_middle(text: str, max_tokens: int) -> str:
+    max_chars = max_tokens * 4
+    if len(text) <= max_chars:
+        return text
+    half = max_chars // 2
+    return f"{text[:half]}\n[... {len(text) - 2 * half} characters omitted ...]\n{text[-half:]}"
+
 
-class SummarizerAgent(DefaultAgent):
-    def __init__(self, deliberator_model: Model, summarizer_model: Model, env: Environment, *, config_class: Callable = AgentConfig, **kwargs):
+def _usage(response: dict) -> dict:
+    return (response.get("extra", {}).get("response") or {}).get("usage") or {}
+
+
+class SummarizerAgent(CachedTemplateRenderer, DefaultAgent):
+    template_model_attr = "deliberator_model"
+
+    def __init__(self, deliberator_model: Model, summarizer_model: Model, env: Environment, *, config_class: Callable = SummarizerAgentConfig, **kwargs):
         self.config = config_class(**kwargs)
         self.messages: list[dict] = []
         self.deliberator_model = deliberator_model
+        # step/cost limits and observations refer to `self.model`
+        self.model = deliberator_model
         self.summarizer_model = summarizer_model
         self.env = env
         self.extra_template_vars = {}
+        self.summary = ""
+        self.summary_watermark = 0
+        """Number of messages already folded into `summary`."""
+        self.summary_stats: list[dict] = []
+        """Per-step summarizer latency and token counts."""
+        self._summary_executor: ThreadPoolExecutor | None = None
+        self._pending_summary: Future | None = None
+        self._pending_watermark = 0
+        """Number of messages the pending summary will cover."""
 
-    def render_template(self, template: str, **kwargs) -> str:
-        template_vars = asdict(self.config) | self.env.get_template_vars() | self.deliberator_model.get_template_vars()
-        return Template(template, undefined=StrictUndefined).render(
-            **kwargs, **template_vars, **self.extra_template_vars
-        )
+    def run(self, task: str, **kwargs) -> tuple[str, str]:
+        self.summary, self.summary_watermark, self.summary_stats = "", 0, []
+        try:
+            return super().run(task, **kwargs)
+        finally:
+            if self._pending_summary is not None:
+                self._pending_summary.cancel()
+                self._pending_summary = None
+            if self._summary_executor is not None:
+                self._summary_executor.shutdown(wait=False)
+                self._summary_executor = None
+
+    def _summary_request(self, messages: list[dict], summary: str, watermark: int) -> list[dict]:
+        if self.config.summary_mode == "full":
+            return messages
+        new_messages = messages[watermark:]
+        if budget := self.config.summary_input_token_budget:
+            per_message = max(budget // max(len(new_messages), 1), 1)
+            new_messages = [m | {"content": _truncate_middle(m["content"], per_message)} for m in new_messages]
+        return [
+            {"role": "system", "content": self.render_template(self.config.summarizer_system_template)},
+            {
+                "role": "user",
+                "content": self.render_template(
+                    self.config.summary_update_template, summary=summary, new_messages=new_messages
+                ),
+            },
+        ]
+
+    def _summarize(self, messages: list[dict], summary: str, watermark: int) -> tuple[str, int, dict]:
+        """Fold `messages[watermark:]` into `summary`, return the new summary, watermark and stats."""
+        request = self._summary_request(messages, summary, watermark)
+        kwargs = {"max_tokens": self.config.summary_max_tokens} if self.config.summary_max_tokens else {}
+        start = time.perf_counter()
+        response = self.summarizer_model.query(request, **kwargs)
+        usage = _usage(response)
+        stats = {
+            "refreshed": True,
+            "latency": time.perf_counter() - start,
+            "messages_folded": len(messages) - watermark,
+            "prompt_tokens": usage.get("prompt_tokens") or sum(_approx_tokens(m["content"]) for m in request),
+            "completion_tokens": usage.get("completion_tokens") or _approx_tokens(response["content"]),
+        }
+        return response["content"], len(messages), stats
+
+    def _summarize_after(self, previous: Future, messages: list[dict]) -> tuple[str, int, dict]:
+        """Like `_summarize`, starting from the result of the `previous` update instead of the current summary."""
+        summary, watermark, stats = previous.result()
+        summary, watermark, more_stats = self._summarize(messages, summary, watermark)
+        return summary, watermark, more_stats | {
+            key: stats[key] + more_stats[key] for key in ("latency", "messages_folded", "prompt_tokens", "completion_tokens")
+        }
+
+    def _summary_due(self) -> bool:
+        step = self.deliberator_model.n_calls
+        due = not self.summary or (step - self._last_refresh_step()) >= self.config.summary_refresh_interval
+        return due and self.summary_watermark < len(self.messages)
+
+    def update_summary(self) -> dict:
+        """Query the summarizer if the summary is due for a refresh, return this step's stats."""
+        stats = {
+            "step": self.deliberator_model.n_calls,
+            "refreshed": False,
+            "latency": 0.0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+        }
+        if self.config.summary_pipeline:
+            stats |= self._collect_pending_summary()
+        elif self._summary_due():
+            self.summary, self.summary_watermark, summary_stats = self._summarize(
+                list(self.messages), self.summary, self.summary_watermark
+            )
+            stats |= summary_stats
+        self.summary_stats.append(stats)
+        return stats
+
+    def _last_refresh_step(self) -> int:
+        return next((s["step"] for s in reversed(self.summary_stats) if s["refreshed"]), 0)
+
+    def start_summary(self):
+        """Pipelined mode: start updating the summary in the background, unless an update covering all
+        messages is in flight. An update that started before the latest messages is followed by one folding
+        them in."""
+        if not self._summary_due() or (
+            self._pending_summary is not None and self._pending_watermark >= len(self.messages)
+        ):
+            return
+        if self._summary_executor is None:
+            self._summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summarizer")
+        messages = list(self.messages)
+        if self._pending_summary is None:
+            self._pending_summary = self._summary_executor.submit(
+                self._summarize, messages, self.summary, self.summary_watermark
+            )
+        else:
+            # the executor has a single worker, so `previous` is done by the time this runs
+            self._pending_summary = self._summary_executor.submit(self._summarize_after, self._pending_summary, messages)
+        self._pending_watermark = len(messages)
+
+    def _collect_pending_summary(self) -> dict:
+        """Apply the background summary if it finishes within `summary_deadline`, otherwise keep the stale one.
+
+        A summary that doesn't cover all messages (e.g. not due for a refresh) is counted as stale as well.
+        """
+        self.start_summary()
+        if self._pending_summary is None:
+            return {}
+        start = time.perf_counter()
+        try:
+            summary, watermark, stats = self._pending_summary.result(timeout=self.config.summary_deadline)
+        except FutureTimeoutError:
+            # still running, picked up by a later step
+            return {"stale": True, "wait": time.perf_counter() - start}
+        finally:
+            if self._pending_summary.done():
+                self._pending_summary = None
+        self.summary, self.summary_watermark = summary, watermark
+        return stats | {"stale": watermark < len(self.messages), "wait": time.perf_counter() - start}
+
+    def execute_action(self, action: dict) -> dict:
+        if self.config.summary_pipeline:
+            # summarize up to the action while the command runs
+            self.start_summary()
+        return super().execute_action(action)
+
+    def get_observation(self, response: dict) -> dict:
+        output = super().get_observation(response)
+        if self.config.summary_pipeline:
+            self.start_summary()
+        return output
 
     def query(self) -> dict:
         """Query the model and return the response."""
         if 0 < self.config.step_limit <= self.model.n_calls or 0 < self.config.cost_limit <= self.model.cost:
             raise LimitsExceeded()
-        summary = self.summarizer_model.query(self.messages)
+        self.update_summary()
         response = self.deliberator_model.query([
             {"role": "system", "content": self.render_template(self.config.system_template)},
-            {"role": "user", "content": self.render_template(self.config.instance_template)+f"Summary:\n{summary}"}
+            {"role": "user", "content": self.render_template(self.config.instance_template)+f"Summary:\n{self.summary}"}
             ])
         self.add_message("assistant", **response)
         return response
+
+
+if __name__ == "__main__":
+    ## Step latency with and without pipelined summaries, using mock models with a fixed latency
+    ## python -m rca.agents.summarizer_agent
+    import yaml
+
+    from minisweagent.config import get_config_path
+    from minisweagent.environments.local import LocalEnvironment
+    from minisweagent.models.test_models import DeterministicModel
+
+    class SlowModel(DeterministicModel):
+        def __init__(self, latency: float, **kwargs):
+            super().__init__(**kwargs)
+            self.latency = latency
+
+        def query(self, messages, **kwargs):
+            time.sleep(self.latency)
+            return super().query(messages, **kwargs)
+
+    agent_config = yaml.safe_load(get_config_path("config_yaml/swebench.yaml").read_text())["agent"]
+    n_steps = 8
+    actions = ["Running the tests.\n```bash\nsleep 0.5 && echo ok\n```"] * n_steps
+    for pipeline in (False, True):
+        agent = SummarizerAgent(
+            SlowModel(0.3, outputs=actions, cost_per_call=0.0),
+            SlowModel(0.4, outputs=[f"summary {i}" for i in range(2 * n_steps)], cost_per_call=0.0),
+            LocalEnvironment(),
+            **agent_config | {"step_limit": n_steps, "cost_limit": 0},
+            summary_mode="incremental",
+            summary_pipeline=pipeline,
+            summary_deadline=0.2,
+        )
+        start = time.perf_counter()
+        agent.run("Fix the bug")
+        elapsed = time.perf_counter() - start
+        stale = sum(s.get("stale", False) for s in agent.summary_stats)
+        print(f"pipeline={pipeline}: {elapsed / n_steps:.2f}s per step, {stale} steps used a stale summary")
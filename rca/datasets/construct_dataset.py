@@ -1,29 +1,13 @@
-import re
 from datasets import load_dataset
 
+from rca.utils.parsing import parse_action as shared_parse_action
+
 trajectory_path = "neulab/agent-data-collection"
 trajectory_name = "SWE-smith_5kTrajectories"
 trajectory_data = load_dataset(trajectory_path, trajectory_name, split="train").to_pandas()
 
-# regex function that captures string between <X= and >
 def parse_action(response):
-    function_format = r"<function=(.*?)>(.*?)</function>"
-    function_matched = re.search(function_format, response, re.DOTALL)
-    
-    if function_matched:
-        function_name = function_matched.group(1)
-        function_param_string = function_matched.group(2).strip()
-        
-        param_format = r"<parameter=(.*?)>(.*?)</parameter>"
-        param_matched = re.findall(param_format, function_param_string, re.DOTALL)
-        if param_matched:
-            params = {name: value.strip() for name, value in param_matched}
-        else:
-            params = {}
-        
-        return function_name, params
-    else:
-        return None, {}
+    return shared_parse_action(response) or (None, {})
 
 def get_function(traj):
     for step in traj["conversations"]:
@@ -0,0 +1,27 @@
+from typing import Any, Dict, Iterable
+
+import pyarrow.parquet as pq
+
+
+class InstanceTable:
+    """Looks up SWE instances by `instance_id` in the side tables written by `preprocess_data.py`.
+
+    The parquet files are memory-mapped and a row is only converted to a dict when it is looked up.
+    """
+
+    def __init__(self, paths: Iterable[str]):
+        self._tables = [pq.read_table(path, memory_map=True) for path in paths]
+        self._index: Dict[str, tuple[int, int]] = {}
+        for table_index, table in enumerate(self._tables):
+            for row, instance_id in enumerate(table.column("instance_id").to_pylist()):
+                self._index[instance_id] = (table_index, row)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, instance_id: str) -> bool:
+        return instance_id in self._index
+
+    def __getitem__(self, instance_id: str) -> Dict[str, Any]:
+        table_index, row = self._index[instance_id]
+        return self._tables[table_index].slice(row, 1).to_pylist()[0]
@@ -0,0 +1,133 @@
+import json
+import os
+from typing import Any, Dict, List
+
+import pyarrow as pa
+
+MESSAGES_TYPE = pa.list_(pa.struct([("role", pa.string()), ("content", pa.string())]))
+TRAJECTORIES_SCHEMA = pa.schema([("messages", MESSAGES_TYPE)])
+SAMPLES_SCHEMA = pa.schema([("id", pa.int64()), ("turn", pa.int64()), ("N", pa.int64())])
+
+
+class PrefixDatasetWriter:
+    """Writes next-action samples as references into deduplicated trajectories.
+
+    Instead of one row with the full conversation prefix per turn, every trajectory is stored once and a
+    sample is `(id, turn, N)`: its input is `messages[:N]` of trajectory `id` and its output the content of
+    `messages[N]`. All splits share the trajectories. Layout::
+
+        <path>/trajectories.arrow     one row per trajectory, the row index is the trajectory id
+        <path>/<split>.samples.arrow  `id`, `turn`, `N` per sample
+        <path>/meta.json              `data_source` and the splits
+
+    Files are Arrow IPC, so that `PrefixDataset` can memory-map them.
+    """
+
+    def __init__(self, path: str, data_source: str, *, batch_size: int = 1000):
+        self.path = path
+        self.data_source = data_source
+        self.batch_size = batch_size
+        os.makedirs(path, exist_ok=True)
+        self._trajectories: List[List[Dict[str, str]]] = []
+        self._num_trajectories = 0
+        self._trajectory_writer = pa.ipc.new_file(os.path.join(path, "trajectories.arrow"), TRAJECTORIES_SCHEMA)
+        self._samples: Dict[str, List[Dict[str, int]]] = {}
+        self._sample_writers: Dict[str, pa.ipc.RecordBatchFileWriter] = {}
+
+    def add_trajectory(self, messages: List[Dict[str, str]]) -> int:
+        self._trajectories.append(messages)
+        if len(self._trajectories) >= self.batch_size:
+            self._flush_trajectories()
+        self._num_trajectories += 1
+        return self._num_trajectories - 1
+
+    def add_sample(self, split: str, trajectory_id: int, turn: int, n: int):
+        if split not in self._sample_writers:
+            self._sample_writers[split] = pa.ipc.new_file(
+                os.path.join(self.path, f"{split}.samples.arrow"), SAMPLES_SCHEMA
+            )
+            self._samples[split] = []
+        self._samples[split].append({"id": trajectory_id, "turn": turn, "N": n})
+        if len(self._samples[split]) >= self.batch_size:
+            self._flush_samples(split)
+
+    def _flush_trajectories(self):
+        batch = pa.RecordBatch.from_pylist([{"messages": m} for m in self._trajectories], schema=TRAJECTORIES_SCHEMA)
+        self._trajectory_writer.write_batch(batch)
+        self._trajectories.clear()
+
+    def _flush_samples(self, split: str):
+        self._sample_writers[split].write_batch(pa.RecordBatch.from_pylist(self._samples[split], schema=SAMPLES_SCHEMA))
+        self._samples[split].clear()
+
+    def close(self):
+        if self._trajectories:
+            self._flush_trajectories()
+        self._trajectory_writer.close()
+        for split, writer in self._sample_writers.items():
+            if self._samples[split]:
+                self._flush_samples(split)
+            writer.close()
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump({"data_source": self.data_source, "splits": sorted(self._sample_writers)}, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PrefixDataset:
+    """Map-style dataset over the format written by `PrefixDatasetWriter`.
+
+    Rows have the same fields as the parquet files of `data/construct.py` (`id`, `turn`, `input`, `output`,
+    `N`, `data_source`, `reward_model`, `extra_info`), materialized in `__getitem__`. The Arrow files are
+    memory-mapped and opened lazily in each process, so dataloader workers share the page cache instead of
+    each holding a copy.
+    """
+
+    def __init__(self, path: str, split: str = "train"):
+        self.path = path
+        self.split = split
+        with open(os.path.join(path, "meta.json")) as f:
+            self.data_source = json.load(f)["data_source"]
+        self._trajectories = None
+        self._samples = None
+
+    @staticmethod
+    def _read(path: str) -> pa.Table:
+        return pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+
+    def _open(self):
+        if self._samples is None:
+            self._trajectories = self._read(os.path.join(self.path, "trajectories.arrow")).column("messages")
+            self._samples = self._read(os.path.join(self.path, f"{self.split}.samples.arrow"))
+
+    def __getstate__(self):
+        # workers re-map the files instead of receiving a pickled copy of the tables
+        return self.__dict__ | {"_trajectories": None, "_samples": None}
+
+    def __len__(self) -> int:
+        self._open()
+        return self._samples.num_rows
+
+    def __getitem__(self, index: int) -> Dict[str, Any]:
+        self._open()
+        if index < 0:
+            index += len(self)
+        trajectory_id = self._samples.column("id")[index].as_py()
+        n = self._samples.column("N")[index].as_py()
+        # only the prefix (and the target) of the trajectory is converted to Python objects
+        messages = self._trajectories[trajectory_id].values.slice(0, n + 1).to_pylist()
+        output = messages[n]["content"]
+        return {
+            "id": trajectory_id,
+            "turn": self._samples.column("turn")[index].as_py(),
+            "input": messages[:n],
+            "output": output,
+            "N": n,
+            "data_source": self.data_source,
+            "reward_model": {"ground_truth": output},
+            "extra_info": {"task": self.data_source, "ground_truth": output, "reward_partial": True},
+        }
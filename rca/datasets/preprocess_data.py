@@ -1,11 +1,49 @@
 import argparse
+import hashlib
+import inspect
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import datasets
 
+# bump to invalidate existing outputs when the output format changes in a way `process_batch` doesn't show
+PREPROCESS_VERSION = 1
+
+
+def process_batch(batch, data_source):
+    return {
+        "data_source": [data_source] * len(batch["instance_id"]),
+        "prompt": [[{"role": "user", "content": problem_statement}] for problem_statement in batch["problem_statement"]],
+        "env_class": ["null"] * len(batch["instance_id"]),
+        # the full instance is looked up in the `*_instances.parquet` side table by the generator
+        "instance_id": batch["instance_id"],
+    }
+
+
+def get_cache_key(sources) -> str:
+    """Hash of the source datasets' fingerprints (content-based for hub datasets) and of the transform."""
+    key = {
+        "sources": [(name, split, dataset._fingerprint) for name, split, dataset in sources],
+        "transform": hashlib.sha256(inspect.getsource(process_batch).encode()).hexdigest(),
+        "version": PREPROCESS_VERSION,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def is_up_to_date(meta_path, paths, cache_key) -> bool:
+    if not all(os.path.exists(path) for path in [meta_path, *paths]):
+        return False
+    with open(meta_path) as f:
+        return json.load(f).get("cache_key") == cache_key
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--output_dir", default="./data/long_horizon/")
+    parser.add_argument("--num_proc", type=int, default=os.cpu_count())
+    parser.add_argument("--batch_size", type=int, default=1000)
+    parser.add_argument("--overwrite", action="store_true", help="Ignore outputs of a previous run with the same inputs")
 
     args = parser.parse_args()
 
@@ -17,28 +55,34 @@ if __name__ == "__main__":
     train_dataset = datasets.load_dataset(data_source, "default")["train"]
     val_dataset = datasets.load_dataset(eval_data_source, "default")["test"]
 
-    # add a row to each data item that represents a unique id
-    def make_map_fn(split):
-        def process_fn(example, idx):
-            data = {
-                "data_source": data_source if split == "train" else eval_data_source,
-                "prompt": [
-                    {
-                        "role": "user",
-                        "content": example["problem_statement"],
-                    }
-                ],
-                "env_class": "null",
-                "instance": example,
-            }
-            return data
-
-        return process_fn
-
-    train_dataset = train_dataset.map(function=make_map_fn("train"), with_indices=True)
-    val_dataset = val_dataset.map(function=make_map_fn("test"), with_indices=True)
-
     output_dir = args.output_dir
     os.makedirs(output_dir, exist_ok=True)
-    train_dataset.to_parquet(os.path.join(output_dir, "train.parquet"))
-    val_dataset.to_parquet(os.path.join(output_dir, "validation.parquet"))
+    meta_path = os.path.join(output_dir, "preprocess_meta.json")
+    outputs = {
+        "train": (data_source, train_dataset, "train.parquet", "train_instances.parquet"),
+        "validation": (eval_data_source, val_dataset, "validation.parquet", "validation_instances.parquet"),
+    }
+    cache_key = get_cache_key([(source, split, dataset) for split, (source, dataset, _, _) in outputs.items()])
+    paths = [os.path.join(output_dir, name) for _, _, *names in outputs.values() for name in names]
+    if not args.overwrite and is_up_to_date(meta_path, paths, cache_key):
+        print(f"{output_dir} is up to date, nothing to do")
+        raise SystemExit(0)
+
+    num_proc = min(args.num_proc or 1, max(len(train_dataset), len(val_dataset)) // args.batch_size + 1)
+    writes = []
+    for split, (source, dataset, path, instances_path) in outputs.items():
+        processed = dataset.map(
+            process_batch,
+            fn_kwargs={"data_source": source},
+            batched=True,
+            batch_size=args.batch_size,
+            num_proc=num_proc if num_proc > 1 else None,
+            remove_columns=dataset.column_names,
+        )
+        writes.append((processed, os.path.join(output_dir, path)))
+        writes.append((dataset, os.path.join(output_dir, instances_path)))
+
+    with ThreadPoolExecutor(max_workers=len(writes)) as executor:
+        list(executor.map(lambda write: write[0].to_parquet(write[1]), writes))
+    with open(meta_path, "w") as f:
+        json.dump({"cache_key": cache_key}, f)
@@ -1,20 +1,148 @@
+import asyncio
+import base64
 import os
+import selectors
+import shlex
+import signal
+import tempfile
 import typer
 import subprocess
+import time
+import uuid
 
-from typing import Any
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable
+
+from minisweagent.environments.singularity import SingularityEnvironment, SingularityEnvironmentConfig
+
+from rca.environments.image_cache import ImageCache
+from rca.environments.streaming import BoundedOutput, kill_process_group, run_streaming
+
+
+@dataclass
+class ApptainerEnvironmentConfig(SingularityEnvironmentConfig):
+    persistent_shell: bool = False
+    """Start one `apptainer instance` and one bash process per trajectory and send every command to it,
+    instead of paying for a fresh `apptainer exec` per step. Exported variables and activated venvs
+    persist between commands; the working directory is reset to `cwd` before every command.
+    """
+    image_cache_dir: str | None = os.getenv("RCA_IMAGE_CACHE_DIR")
+    """Node-local directory of converted images shared by all trajectories (see `ImageCache`).
+    If unset, every environment builds its own sandbox from the registry image.
+    """
+    image_cache_mode: str = "sandbox"
+    """`sandbox`: per-trajectory clone of a cached sandbox directory.
+    `overlay`: cached SIF plus a per-trajectory writable overlay image (cheapest, needs overlay support).
+    """
+    image_cache_max_gb: float = 200.0
+    """Disk budget of the image cache, least recently used images are evicted beyond it."""
+    overlay_size_mb: int = 8192
+    """Size of the sparse per-trajectory overlay image in `overlay` mode."""
+    staging_dir: str = "/rca-staging"
+    """Directory in the container that `stage_file` writes to. It is part of the writable sandbox, or bound
+    read-only from a host directory in `overlay` mode.
+    """
+    output_head_bytes: int = 65536
+    output_tail_bytes: int = 65536
+    """Only the first `output_head_bytes` and the last `output_tail_bytes` of a command's output are kept, the
+    rest is replaced by an elision marker. Results report the full size as `output_bytes`.
+    """
+    output_keep_prefix: str | None = "COMPLETE_TASK_AND_SUBMIT_FINAL_OUTPUT"
+    """Output starting with this line is kept in full: `DefaultAgent` takes the rest of it as the submitted patch."""
 
-from minisweagent.environments.singularity import SingularityEnvironment
 
 class ApptainerEnvironment(SingularityEnvironment):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    def __init__(self, *args, config_class: type = ApptainerEnvironmentConfig, **kwargs):
+        self.instance_name: str | None = None
+        self._shell: subprocess.Popen | None = None
+        self.image_cache: ImageCache | None = None
+        self.image_path: Path | None = None
+        super().__init__(*args, config_class=config_class, **kwargs)
         print("Starting Apptainer action execution server...")
         # self.execute("python -m openhands.runtime.action_execution_server.py 8120")
         print("sandbox_dir:", self.sandbox_dir)
 
-    def execute(self, command: str, cwd: str = "", *, timeout: int | None = None) -> dict[str, Any]:
-        """Execute a command in a Singularity container and return the result as a dict."""
+    def _build_sandbox(self) -> Path:
+        if not self.config.image_cache_dir:
+            return super()._build_sandbox()
+        self.image_cache = ImageCache(
+            self.config.image_cache_dir,
+            max_bytes=int(self.config.image_cache_max_gb * 1e9),
+            executable=self.config.executable,
+            build_retries=self.config.sandbox_build_retries,
+        )
+        sandbox_dir = Path(tempfile.gettempdir()) / f"minisweagent-{uuid.uuid4().hex[:8]}"
+        if self.config.image_cache_mode == "overlay":
+            self.image_path = self.image_cache.get_sif(self.config.image)
+            sandbox_dir.mkdir(parents=True)
+            subprocess.run(
+                [
+                    self.config.executable,
+                    "overlay",
+                    "create",
+                    "--sparse",
+                    "--size",
+                    str(self.config.overlay_size_mb),
+                    str(sandbox_dir / "overlay.img"),
+                ],
+                check=True,
+                capture_output=True,
+            )
+        elif self.config.image_cache_mode == "sandbox":
+            self.image_cache.clone_sandbox(self.config.image, sandbox_dir)
+        else:
+            raise ValueError(f"Unknown image_cache_mode: {self.config.image_cache_mode}")
+        return sandbox_dir
+
+    def _container_args(self) -> list[str]:
+        """Arguments selecting the writable container filesystem of this environment."""
+        if self.image_path is not None:
+            assert self.image_cache is not None
+            self.image_cache.touch(self.image_path)
+            staging = self._staging_host_dir()
+            staging.mkdir(parents=True, exist_ok=True)
+            return [
+                "--bind",
+                # read-only, files are staged from the host
+                f"{staging}:{self.config.staging_dir}:ro",
+                "--overlay",
+                str(self.sandbox_dir / "overlay.img"),
+                str(self.image_path),
+            ]
+        return ["--writable", str(self.sandbox_dir)]
+
+    def _staging_host_dir(self) -> Path:
+        if self.image_path is not None:
+            return self.sandbox_dir / "staging"
+        # the sandbox directory is the container's root filesystem
+        return self.sandbox_dir / self.config.staging_dir.lstrip("/")
+
+    def stage_file(self, content: str | bytes, name: str) -> str:
+        """Write `content` to `name` in the container's `staging_dir` and return its path in the container.
+
+        The file is written on the host, so its content never goes through a command line (`ARG_MAX`) or a pipe.
+        """
+        staging = self._staging_host_dir()
+        staging.mkdir(parents=True, exist_ok=True)
+        (staging / name).write_bytes(content.encode() if isinstance(content, str) else content)
+        return f"{self.config.staging_dir.rstrip('/')}/{name}"
+
+    def unstage_file(self, path: str):
+        """Remove a file created by `stage_file`, given its path in the container."""
+        (self._staging_host_dir() / Path(path).name).unlink(missing_ok=True)
+
+    def _env_args(self) -> list[str]:
+        args = []
+        for key in self.config.forward_env:
+            if (value := os.getenv(key)) is not None:
+                args.extend(["--env", f"{key}={value}"])
+        for key, value in self.config.env.items():
+            args.extend(["--env", f"{key}={value}"])
+        return args
+
+    def _exec_cmd(self, command: str, cwd: str = "", *, target: list[str] | None = None) -> list[str]:
+        """`apptainer exec` command line running `command` in `target`, by default this environment's container."""
         cmd = [self.config.executable, "exec"]
 
         # Do not inherit directories and env vars from host
@@ -24,20 +152,189 @@ class ApptainerEnvironment(SingularityEnvironment):
         if work_dir and work_dir != "/":
             cmd.extend(["--pwd", work_dir])
 
-        for key in self.config.forward_env:
-            if (value := os.getenv(key)) is not None:
-                cmd.extend(["--env", f"{key}={value}"])
-        for key, value in self.config.env.items():
-            cmd.extend(["--env", f"{key}={value}"])
+        cmd.extend(self._env_args())
+
+        cmd.extend([*(target or self._container_args()), "bash", "-c", command])
+        return cmd
+
+    def execute(self, command: str, cwd: str = "", *, timeout: int | None = None) -> dict[str, Any]:
+        """Execute a command in a Singularity container and return the result as a dict."""
+        if self.config.persistent_shell:
+            return self._execute_in_shell(command, cwd, timeout=timeout)
+
+        result = run_streaming(
+            self._exec_cmd(command, cwd),
+            timeout=timeout or self.config.timeout,
+            **self._output_bounds(),
+        )
+        return {"output": result["output"], "returncode": result["returncode"], "output_bytes": result["output_bytes"]}
+
+    def _output_bounds(self) -> dict[str, Any]:
+        return {
+            "head_bytes": self.config.output_head_bytes,
+            "tail_bytes": self.config.output_tail_bytes,
+            "keep_prefix": self.config.output_keep_prefix.encode() if self.config.output_keep_prefix else None,
+        }
+
+    def _new_output(self) -> BoundedOutput:
+        return BoundedOutput(**self._output_bounds())
+
+    async def aexecute(self, command: str, cwd: str = "", *, timeout: int | None = None) -> dict[str, Any]:
+        """Same as `execute`, but awaits the `apptainer exec` subprocess instead of blocking the event loop."""
+        if self.config.persistent_shell:
+            # the shell session is driven by blocking reads and isn't shared between threads
+            return await asyncio.to_thread(self._execute_in_shell, command, cwd, timeout=timeout)
+
+        timeout = timeout or self.config.timeout
+        proc = await asyncio.create_subprocess_exec(
+            *self._exec_cmd(command, cwd),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            start_new_session=True,
+        )
+        assert proc.stdout is not None
+        output = self._new_output()
+
+        async def read():
+            while chunk := await proc.stdout.read(65536):
+                output.feed(chunk)
+            return await proc.wait()
 
-        cmd.extend(["--writable", str(self.sandbox_dir), "bash", "-c", command])
-        result = subprocess.run(
+        try:
+            returncode = await asyncio.wait_for(read(), timeout)
+        except asyncio.TimeoutError:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                pass
+            await proc.wait()
+            raise subprocess.TimeoutExpired(command, timeout, output=output.getvalue())
+        return {
+            "output": output.getvalue().decode("utf-8", errors="replace"),
+            "returncode": returncode,
+            "output_bytes": output.total_bytes,
+        }
+
+    def execute_stream(
+        self, command: str, cwd: str = "", *, timeout: int | None = None, on_output: Callable[[str], bool] | None = None
+    ) -> dict[str, Any]:
+        """Same as `execute`, but passes output chunks to `on_output` as they arrive, see `run_streaming`."""
+        if self.config.persistent_shell:
+            if self.instance_name is None:
+                self._start_shell()
+            # a separate process in the running instance, the shell session only returns output at the end
+            cmd = self._exec_cmd(command, cwd, target=[f"instance://{self.instance_name}"])
+        else:
+            cmd = self._exec_cmd(command, cwd)
+        return run_streaming(
             cmd,
-            text=True,
             timeout=timeout or self.config.timeout,
-            encoding="utf-8",
-            errors="replace",
+            on_output=on_output,
+            **self._output_bounds(),
+        )
+
+    def _start_shell(self):
+        if self.instance_name is None:
+            instance_name = f"minisweagent-{uuid.uuid4().hex[:8]}"
+            subprocess.run(
+                [
+                    self.config.executable,
+                    "instance",
+                    "start",
+                    "--contain",
+                    "--cleanenv",
+                    "--no-mount",
+                    "hostfs",
+                    *self._container_args(),
+                    instance_name,
+                ],
+                check=True,
+                capture_output=True,
+            )
+            self.instance_name = instance_name
+        cmd = [self.config.executable, "exec", "--cleanenv", *self._env_args()]
+        cmd.extend([f"instance://{self.instance_name}", "bash", "--noprofile", "--norc"])
+        # own process group, so that a timed out command can be killed together with its children
+        self._shell = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
+            bufsize=0,
+            start_new_session=True,
         )
-        return {"output": result.stdout, "returncode": result.returncode}
\ No newline at end of file
+
+    def _kill_shell(self):
+        if self._shell is None:
+            return
+        kill_process_group(self._shell)
+        self._shell = None
+
+    def reset_shell(self):
+        """Discard the state of the persistent shell session, the next command starts a new one."""
+        self._kill_shell()
+
+    def _execute_in_shell(self, command: str, cwd: str = "", *, timeout: int | None = None) -> dict[str, Any]:
+        if self._shell is None or self._shell.poll() is not None:
+            self._start_shell()
+        assert self._shell is not None and self._shell.stdin is not None and self._shell.stdout is not None
+
+        work_dir = cwd or self.config.cwd or "/"
+        sentinel = f"__RCA_CMD_DONE_{uuid.uuid4().hex}__".encode()
+        # the command is passed base64-encoded to `eval`, so quoting, heredocs and syntax errors
+        # cannot break the framing, and stdin is detached so that the command can't eat our pipe
+        encoded = base64.b64encode(command.encode("utf-8")).decode("ascii")
+        script = (
+            f"cd {shlex.quote(work_dir)} && eval \"$(printf %s '{encoded}' | base64 -d)\" < /dev/null 2>&1\n"
+            f"printf '\\n%s %s\\n' '{sentinel.decode()}' \"$?\"\n"
+        )
+        self._shell.stdin.write(script.encode())
+        self._shell.stdin.flush()
+
+        timeout = timeout or self.config.timeout
+        deadline = time.monotonic() + timeout
+        marker = b"\n" + sentinel + b" "
+        output = self._new_output()
+        # unread bytes that may belong to the sentinel line, everything before it is the command's output
+        pending = b""
+        with selectors.DefaultSelector() as selector:
+            selector.register(self._shell.stdout, selectors.EVENT_READ)
+            while True:
+                end = pending.find(marker)
+                if end != -1 and (eol := pending.find(b"\n", end + len(marker))) != -1:
+                    returncode = int(pending[end + len(marker) : eol])
+                    output.feed(pending[:end])
+                    break
+                keep = end if end != -1 else max(len(pending) - len(marker) + 1, 0)
+                output.feed(pending[:keep])
+                pending = pending[keep:]
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._kill_shell()
+                    output.feed(pending)
+                    raise subprocess.TimeoutExpired(command, timeout, output=output.getvalue())
+                if not selector.select(timeout=remaining):
+                    continue
+                chunk = os.read(self._shell.stdout.fileno(), 65536)
+                if not chunk:
+                    # the shell exited (e.g. the command ran `exit`), the next command starts a new one
+                    returncode = self._shell.wait()
+                    self._shell = None
+                    output.feed(pending)
+                    break
+                pending += chunk
+        return {
+            "output": output.getvalue().decode("utf-8", errors="replace"),
+            "returncode": returncode,
+            "output_bytes": output.total_bytes,
+        }
+
+    def cleanup(self):
+        self._kill_shell()
+        if self.instance_name is not None:
+            subprocess.run(
+                [self.config.executable, "instance", "stop", self.instance_name],
+                capture_output=True,
+            )
+            self.instance_name = None
+        super().cleanup()
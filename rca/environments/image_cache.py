@@ -0,0 +1,207 @@
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import time
+import uuid
+from pathlib import Path
+
+from loguru import logger
+
+from rca.utils.locking import file_lock
+
+# resolved `image reference -> digest`, so that a worker asks the registry once per image
+_DIGEST_CACHE: dict[str, str] = {}
+
+
+def resolve_image_digest(image: str) -> str:
+    """Return the content digest of `image` (e.g. `docker://docker.io/org/name:tag`).
+
+    Uses `skopeo inspect` when available. If the digest can't be resolved (no skopeo, no registry access),
+    the reference itself is returned with a `ref:` prefix, i.e. the image cache degrades to being keyed by
+    tag. The evaluation cache doesn't cache results of such images.
+    """
+    if "@sha256:" in image:
+        return image.rsplit("@", 1)[1]
+    if image in _DIGEST_CACHE:
+        return _DIGEST_CACHE[image]
+    reference = image if "://" in image else f"docker://{image}"
+    digest = None
+    if shutil.which("skopeo"):
+        try:
+            out = subprocess.run(
+                ["skopeo", "inspect", "--format", "{{.Digest}}", reference],
+                capture_output=True,
+                text=True,
+                timeout=60,
+                check=True,
+            )
+            digest = out.stdout.strip() or None
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            logger.debug(f"Could not resolve digest of {image}: {e}")
+    if digest is None:
+        digest = "ref:" + reference
+    _DIGEST_CACHE[image] = digest
+    return digest
+
+
+def _dir_size(path: Path) -> int:
+    if path.is_file():
+        return path.stat().st_size
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class ImageCache:
+    """Node-local, content-addressed cache of converted Apptainer images.
+
+    Artifacts are keyed by the image digest and built at most once per node: concurrent builders
+    serialize on a per-key `flock` and all but the first find the finished artifact when they get the lock.
+    Two kinds of artifacts are kept:
+
+    - `sandbox`: an unpacked sandbox directory, cloned per trajectory with `cp --reflink=auto`
+      (copy-on-write on btrfs/xfs, a plain local copy elsewhere)
+    - `sif`: a SIF file, used read-only together with a per-trajectory writable overlay
+
+    The least recently used artifacts are evicted once the cache exceeds `max_bytes`. Artifacts used within
+    the last `evict_grace_seconds` are never evicted, since running overlay containers still read from them.
+
+    Layout::
+
+        <cache_dir>/{sandbox,sif}/<key>    artifacts
+        <cache_dir>/meta/<key>.json        image, kind and size; its mtime is the last-use time
+        <cache_dir>/locks/<key>.lock       build locks
+    """
+
+    def __init__(
+        self,
+        cache_dir: str | Path,
+        *,
+        max_bytes: int,
+        executable: str = "apptainer",
+        evict_grace_seconds: float = 3600,
+        build_retries: int = 3,
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.executable = executable
+        self.evict_grace_seconds = evict_grace_seconds
+        self.build_retries = build_retries
+        for sub in ("sandbox", "sif", "meta", "locks"):
+            (self.cache_dir / sub).mkdir(parents=True, exist_ok=True)
+
+    def _key(self, image: str, kind: str) -> str:
+        return f"{kind}-{hashlib.sha256(resolve_image_digest(image).encode()).hexdigest()[:32]}"
+
+    def _artifact_path(self, key: str) -> Path:
+        kind = key.split("-", 1)[0]
+        return self.cache_dir / kind / (f"{key}.sif" if kind == "sif" else key)
+
+    def _meta_path(self, key: str) -> Path:
+        return self.cache_dir / "meta" / f"{key}.json"
+
+    def _lock_path(self, key: str) -> Path:
+        return self.cache_dir / "locks" / f"{key}.lock"
+
+    def touch(self, path: Path):
+        """Mark the artifact at `path` as recently used."""
+        key = path.name.removesuffix(".sif")
+        try:
+            os.utime(self._meta_path(key))
+        except FileNotFoundError:
+            pass
+
+    def _get(self, image: str, kind: str) -> Path:
+        key = self._key(image, kind)
+        path = self._artifact_path(key)
+        meta_path = self._meta_path(key)
+        if meta_path.exists() and path.exists():
+            self.touch(path)
+            return path
+        with file_lock(self._lock_path(key)):
+            # someone else may have built it while we were waiting for the lock
+            if meta_path.exists() and path.exists():
+                self.touch(path)
+                return path
+            start = time.time()
+            self._build(image, kind, path)
+            size = _dir_size(path)
+            meta_path.write_text(json.dumps({"image": image, "kind": kind, "size": size}))
+            logger.info(f"Cached {kind} for {image} at {path} ({size / 1e9:.2f} GB, {time.time() - start:.0f}s)")
+        self.evict()
+        return path
+
+    def _build(self, image: str, kind: str, path: Path):
+        for attempt in range(self.build_retries):
+            # build next to the final path and rename, so readers never see a partial artifact
+            tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+            cmd = [self.executable, "build"]
+            if kind == "sandbox":
+                cmd.append("--sandbox")
+            cmd.extend([str(tmp_path), image])
+            try:
+                subprocess.run(cmd, check=True, capture_output=True)
+                shutil.rmtree(path, ignore_errors=True)
+                os.replace(tmp_path, path)
+                return
+            except subprocess.CalledProcessError as e:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                tmp_path.unlink(missing_ok=True)
+                logger.error(
+                    f"Error building {kind} for {image}, stdout: {e.stdout}, stderr: {e.stderr} "
+                    f"(attempt {attempt + 1}/{self.build_retries})"
+                )
+                if attempt == self.build_retries - 1:
+                    raise
+
+    def get_sandbox(self, image: str) -> Path:
+        """Path of the shared (read-only by convention) sandbox directory for `image`."""
+        return self._get(image, "sandbox")
+
+    def get_sif(self, image: str) -> Path:
+        """Path of the shared SIF file for `image`."""
+        return self._get(image, "sif")
+
+    def clone_sandbox(self, image: str, dest: Path) -> Path:
+        """Create a private writable copy of the sandbox for `image` at `dest`."""
+        source = self.get_sandbox(image)
+        subprocess.run(["cp", "-a", "--reflink=auto", str(source), str(dest)], check=True, capture_output=True)
+        return dest
+
+    def evict(self):
+        """Delete least recently used artifacts until the cache fits into `max_bytes`."""
+        with file_lock(self.cache_dir / "locks" / "evict.lock", blocking=False) as acquired:
+            if not acquired:
+                # another worker is already evicting
+                return
+            entries = []
+            for meta_path in (self.cache_dir / "meta").glob("*.json"):
+                try:
+                    entries.append((meta_path.stat().st_mtime, meta_path.stem, json.loads(meta_path.read_text())["size"]))
+                except (OSError, ValueError, KeyError):
+                    continue
+            total = sum(size for _, _, size in entries)
+            now = time.time()
+            for last_used, key, size in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if now - last_used < self.evict_grace_seconds:
+                    continue
+                with file_lock(self._lock_path(key), blocking=False) as acquired:
+                    if not acquired:
+                        continue
+                    self._meta_path(key).unlink(missing_ok=True)
+                    path = self._artifact_path(key)
+                    if path.is_dir():
+                        shutil.rmtree(path, ignore_errors=True)
+                    else:
+                        path.unlink(missing_ok=True)
+                    total -= size
+                    logger.info(f"Evicted {path} from image cache ({size / 1e9:.2f} GB)")
@@ -0,0 +1,121 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, Iterable
+
+from loguru import logger
+
+from minisweagent import Environment
+
+
+@dataclass
+class EnvironmentPoolStats:
+    hits: int = 0
+    """Environment was ready when the worker asked for it."""
+    partial_hits: int = 0
+    """Environment was still being provisioned, the worker waited for the rest."""
+    misses: int = 0
+    """Environment was provisioned synchronously by the worker."""
+    wait_time: float = 0.0
+    """Total seconds workers spent waiting for environments."""
+
+    def as_dict(self) -> dict[str, Any]:
+        acquired = self.hits + self.partial_hits + self.misses
+        return asdict(self) | {
+            "hit_rate": self.hits / acquired if acquired else 0.0,
+            "mean_wait_time": self.wait_time / acquired if acquired else 0.0,
+        }
+
+
+class EnvironmentPool:
+    """Provisions environments for upcoming instances while workers run the agent on earlier ones.
+
+    `schedule` registers instances in the order workers will ask for them. Up to `depth` environments
+    (in-flight or ready but not yet acquired) are kept ahead of the workers. `acquire` hands out a
+    pre-provisioned environment, waits for one that is in-flight, or provisions it on the spot if the
+    instance was never scheduled (or `depth` is 0). Provisioning errors are raised from `acquire`,
+    i.e. in the worker that would have created the environment itself.
+
+    Requests are identified by `key`, by default the instance id. Use a per-trajectory key if the same
+    instance is run several times concurrently (e.g. GRPO groups).
+
+    `release` is called for every environment that `close` cleans up because it was never acquired, for
+    resources the factory reserved next to the environment (e.g. a container slot of an `InstanceScheduler`).
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[dict], Environment],
+        *,
+        depth: int = 0,
+        key: Callable[[dict], str] = lambda instance: instance["instance_id"],
+        release: Callable[[Environment], None] | None = None,
+    ):
+        self._factory = factory
+        self._key = key
+        self._release = release
+        self.depth = depth
+        self.stats = EnvironmentPoolStats()
+        self._lock = threading.Lock()
+        self._upcoming: OrderedDict[str, dict] = OrderedDict()
+        self._provisioning: dict[str, Future] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max(depth, 1), thread_name_prefix="env-pool")
+        self._closed = False
+
+    def schedule(self, instances: Iterable[dict]):
+        with self._lock:
+            for instance in instances:
+                self._upcoming[self._key(instance)] = instance
+        self._fill()
+
+    def _fill(self):
+        with self._lock:
+            while not self._closed and self._upcoming and len(self._provisioning) < self.depth:
+                key, instance = self._upcoming.popitem(last=False)
+                self._provisioning[key] = self._executor.submit(self._factory, instance)
+
+    def acquire(self, instance: dict) -> Environment:
+        key = self._key(instance)
+        with self._lock:
+            self._upcoming.pop(key, None)
+            future = self._provisioning.pop(key, None)
+        start = time.monotonic()
+        outcome = "misses" if future is None else "hits" if future.done() else "partial_hits"
+        try:
+            return self._factory(instance) if future is None else future.result()
+        finally:
+            with self._lock:
+                setattr(self.stats, outcome, getattr(self.stats, outcome) + 1)
+                self.stats.wait_time += time.monotonic() - start
+            self._fill()
+
+    def take_stats(self) -> EnvironmentPoolStats:
+        """Return the stats since the previous call (or since the start) and reset them."""
+        with self._lock:
+            stats, self.stats = self.stats, EnvironmentPoolStats()
+        return stats
+
+    def close(self):
+        """Stop provisioning and clean up environments that were never acquired."""
+        with self._lock:
+            self._closed = True
+            self._upcoming.clear()
+            provisioning = list(self._provisioning.values())
+            self._provisioning.clear()
+        for future in provisioning:
+            future.cancel()
+        self._executor.shutdown(wait=True)
+        for future in provisioning:
+            if future.cancelled() or future.exception() is not None:
+                continue
+            env = future.result()
+            try:
+                if hasattr(env, "cleanup"):
+                    env.cleanup()
+            except Exception as e:
+                logger.warning(f"Error cleaning up unused environment: {e}")
+            finally:
+                if self._release is not None:
+                    self._release(env)
@@ -0,0 +1,122 @@
+import codecs
+import os
+import selectors
+import signal
+import subprocess
+import time
+from typing import Any, Callable, Optional
+
+
+class BoundedOutput:
+    """Keeps the first `head_bytes` and the last `tail_bytes` of a command's output.
+
+    The rest is dropped as it arrives and replaced by an elision marker in `getvalue`, so that a command
+    printing gigabytes doesn't have to be held in memory (or in the trajectory). Everything is kept if
+    `head_bytes` is `None`, or if the output starts with `keep_prefix` (after leading whitespace), which is
+    meant for output that is consumed as a whole, like the patch an agent submits.
+    """
+
+    def __init__(self, head_bytes: Optional[int] = None, tail_bytes: int = 0, *, keep_prefix: Optional[bytes] = None):
+        self.head_bytes = head_bytes
+        self.tail_bytes = tail_bytes
+        self.keep_prefix = keep_prefix
+        self.total_bytes = 0
+        self._head = bytearray()
+        self._tail = bytearray()
+        # whether the output starts with `keep_prefix`, `None` until enough of it arrived to tell
+        self._keep_all: Optional[bool] = None if keep_prefix else False
+
+    def feed(self, data: bytes):
+        self.total_bytes += len(data)
+        if self.head_bytes is None or self._keep_all:
+            self._head += data
+            return
+        if self._keep_all is None:
+            # buffered whole until the prefix can be checked, the head may be shorter than the prefix
+            self._head += data
+            self._check_prefix()
+            if self._keep_all is not False:
+                return
+            data = bytes(self._head[self.head_bytes :])
+            del self._head[self.head_bytes :]
+        elif (room := self.head_bytes - len(self._head)) > 0:
+            self._head += data[:room]
+            data = data[room:]
+        if data and self.tail_bytes > 0:
+            self._tail += data
+            # trimmed in batches, not on every read
+            if len(self._tail) > 2 * self.tail_bytes:
+                del self._tail[: -self.tail_bytes]
+
+    def _check_prefix(self):
+        assert self.keep_prefix is not None and self.head_bytes is not None
+        start = bytes(self._head).lstrip()
+        if len(start) >= len(self.keep_prefix) or len(self._head) >= max(self.head_bytes, len(self.keep_prefix)):
+            self._keep_all = start.startswith(self.keep_prefix)
+
+    def getvalue(self) -> bytes:
+        tail = self._tail[-self.tail_bytes :] if self.tail_bytes > 0 else b""
+        elided = self.total_bytes - len(self._head) - len(tail)
+        if not elided:
+            return bytes(self._head + tail)
+        marker = f"\n<output elided: {elided} of {self.total_bytes} bytes>\n".encode()
+        return bytes(self._head) + marker + bytes(tail)
+
+
+def kill_process_group(proc: subprocess.Popen):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+    proc.wait()
+
+
+def run_streaming(
+    cmd: list[str],
+    *,
+    timeout: float,
+    on_output: Optional[Callable[[str], bool]] = None,
+    head_bytes: Optional[int] = None,
+    tail_bytes: int = 0,
+    keep_prefix: Optional[bytes] = None,
+) -> dict[str, Any]:
+    """Run `cmd` and pass its output (stdout and stderr) to `on_output` as it arrives.
+
+    If `on_output` returns true the command is killed, together with everything it started, and the result
+    has `stopped: True`. On timeout the process group is killed as well and `subprocess.TimeoutExpired`
+    raised with the output so far, like `subprocess.run`. The returned output is bounded as in `BoundedOutput`,
+    `output_bytes` is the size of the whole output.
+    """
+    # own process group, so that `apptainer`/`docker` children don't outlive a killed command
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=0, start_new_session=True)
+    assert proc.stdout is not None
+    deadline = time.monotonic() + timeout
+    # incremental, so that a multi-byte character split between reads is decoded once it is complete
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    output = BoundedOutput(head_bytes, tail_bytes, keep_prefix=keep_prefix)
+    stopped = False
+    with selectors.DefaultSelector() as selector:
+        selector.register(proc.stdout, selectors.EVENT_READ)
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                kill_process_group(proc)
+                proc.stdout.close()
+                raise subprocess.TimeoutExpired(cmd, timeout, output=output.getvalue())
+            if not selector.select(timeout=remaining):
+                continue
+            chunk = os.read(proc.stdout.fileno(), 65536)
+            output.feed(chunk)
+            if on_output is not None and (text := decoder.decode(chunk, final=not chunk)) and on_output(text):
+                stopped = True
+                kill_process_group(proc)
+                break
+            if not chunk:
+                break
+    proc.stdout.close()
+    return {
+        "output": output.getvalue().decode("utf-8", errors="replace"),
+        "returncode": proc.wait(),
+        "stopped": stopped,
+        "output_bytes": output.total_bytes,
+    }
@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+import litellm
+import ray
+from tenacity import (
+    before_sleep_log,
+    retry,
+    retry_if_not_exception_type,
+    stop_after_attempt,
+    wait_exponential,
+)
+
+from minisweagent.models import GLOBAL_MODEL_STATS
+from minisweagent.models.litellm_model import LitellmModel
+from minisweagent.run.utils.save import save_traj
+
+from rca.agents import AsyncAgentWithReminder
+from rca.environments.pool import EnvironmentPool
+from rca.generators.token_capture import compact_token_records
+from rca.utils.config import thaw
+from rca.utils.eval_cache import EvalCache
+from rca.utils.mini_swe import evaluate_trajectory_cached, get_head_commit, get_sb_environment
+
+_logger = logging.getLogger("litellm_model")
+
+_LITELLM_MODEL_CLASSES = (None, "litellm", "minisweagent.models.litellm_model.LitellmModel")
+
+
+class AsyncLitellmModel(LitellmModel):
+    """`LitellmModel` with an awaitable `aquery`, so that model calls don't need a thread or process each."""
+
+    @retry(
+        stop=stop_after_attempt(10),
+        wait=wait_exponential(multiplier=1, min=4, max=60),
+        before_sleep=before_sleep_log(_logger, logging.WARNING),
+        retry=retry_if_not_exception_type(
+            (
+                litellm.exceptions.UnsupportedParamsError,
+                litellm.exceptions.NotFoundError,
+                litellm.exceptions.PermissionDeniedError,
+                litellm.exceptions.ContextWindowExceededError,
+                litellm.exceptions.APIError,
+                litellm.exceptions.AuthenticationError,
+                KeyboardInterrupt,
+            )
+        ),
+    )
+    async def _aquery(self, messages: list[dict[str, str]], **kwargs):
+        return await litellm.acompletion(
+            model=self.config.model_name, messages=messages, **(self.config.model_kwargs | kwargs)
+        )
+
+    async def aquery(self, messages: list[dict[str, str]], **kwargs) -> dict:
+        response = await self._aquery(messages, **kwargs)
+        try:
+            cost = litellm.cost_calculator.completion_cost(response)
+        except Exception as e:
+            _logger.critical(f"Error calculating cost for model {self.config.model_name}: {e}.")
+            raise
+        self.n_calls += 1
+        self.cost += cost
+        GLOBAL_MODEL_STATS.add(cost)
+        return {
+            "content": response.choices[0].message.content or "",  # type: ignore
+            "extra": {
+                "response": response.model_dump(),
+            },
+        }
+
+
+@ray.remote(num_cpus=0.01)
+class AsyncTrajectoryRunner:
+    """Runs many mini-swe-agent trajectories concurrently from one event loop on one node.
+
+    Used by `MiniSweAgentGenerator` with `miniswe_execution_mode=async`: one runner is started per node
+    and trajectories are spread over the runners, instead of starting one Ray worker process per trajectory.
+    Model calls are awaited, environment commands run as asyncio subprocesses (or in worker threads for
+    environments without `aexecute`), and at most `max_concurrent_trajectories` trajectories run at once.
+    Environments of trajectories waiting for a slot are provisioned ahead of time, up to `env_pool_depth`.
+    """
+
+    def __init__(self, max_concurrent_trajectories: int = 64, env_pool_depth: int = 0):
+        self.max_concurrent_trajectories = max_concurrent_trajectories
+        self._semaphore = asyncio.Semaphore(max_concurrent_trajectories)
+        self._env_pool = EnvironmentPool(
+            lambda request: get_sb_environment(request["sweagent_config"], request["instance"], request["data_source"]),
+            depth=env_pool_depth,
+            key=lambda request: request["trajectory_id"],
+        )
+        self._executor_configured = False
+
+    def get_env_pool_stats(self) -> Dict[str, Any]:
+        """Environment pool stats since the previous call, i.e. of the last training step."""
+        return self._env_pool.take_stats().as_dict()
+
+    async def run(
+        self, instance, litellm_model_name, sweagent_config, generator_cfg, data_source, sampling_params, group_eval=False
+    ) -> Tuple[List[dict], int, str | None, str | None, str | None]:
+        if not self._executor_configured:
+            # environment start-up, evaluation and blocking `execute`s run in threads, the default pool is too small
+            asyncio.get_running_loop().set_default_executor(
+                ThreadPoolExecutor(max_workers=2 * self.max_concurrent_trajectories + self._env_pool.depth)
+            )
+            self._executor_configured = True
+        request = {
+            "trajectory_id": uuid.uuid4().hex,
+            "instance": instance,
+            "sweagent_config": sweagent_config,
+            "data_source": data_source,
+        }
+        self._env_pool.schedule([request])
+        async with self._semaphore:
+            return await self._run(request, litellm_model_name, generator_cfg, sampling_params, group_eval)
+
+    async def _run(self, request, litellm_model_name, generator_cfg, sampling_params, group_eval):
+        from loguru import logger
+
+        instance = request["instance"]
+        sweagent_config = request["sweagent_config"]
+        data_source = request["data_source"]
+
+        model_config = thaw(sweagent_config.get("model", {}))
+        model_config.setdefault("model_kwargs", {}).update(sampling_params)
+        # model calls are made by `AsyncLitellmModel`
+        if (model_class := model_config.pop("model_class", None)) not in _LITELLM_MODEL_CLASSES:
+            raise ValueError(f"miniswe_execution_mode=async only supports litellm models, got model_class={model_class}")
+        model_config["model_name"] = litellm_model_name
+        model = AsyncLitellmModel(**model_config)
+
+        strict_eval = generator_cfg.get("miniswe_strict_eval", True)
+        # identical patches of an instance are evaluated once, see `EvalCache`
+        eval_cache_dir = generator_cfg.get("miniswe_eval_cache_dir")
+        eval_cache = EvalCache(eval_cache_dir) if eval_cache_dir else None
+
+        agent = None
+        env = None
+        base_commit = None
+        extra_info = None
+        result = None
+        reward = 0
+        error = None
+        eval_cache_status = None
+        model_patch = None
+        try:
+            env = await asyncio.to_thread(self._env_pool.acquire, request)
+            if not strict_eval and not group_eval:
+                base_commit = await asyncio.to_thread(get_head_commit, env, env.config.cwd)
+            agent = AsyncAgentWithReminder(model, env, **sweagent_config.get("agent", {}))
+            exit_status, result = await agent.arun(instance["problem_statement"])
+        except Exception as e:
+            logger.error(f"Error processing instance {instance['instance_id']}: {e}", exc_info=True)
+            exit_status, result = type(e).__name__, str(e)
+            error = str(e)
+            extra_info = {"traceback": traceback.format_exc()}
+        finally:
+            if agent is not None:
+                compact_token_records(agent.messages)
+            path = Path(generator_cfg.miniswe_traj_dir)
+            path.mkdir(parents=True, exist_ok=True)
+            path = path / f"{instance['instance_id']}.json"
+            if agent is not None and group_eval:
+                # evaluated together with the other trajectories of the instance, see `evaluate_group`
+                model_patch = result
+                await asyncio.to_thread(
+                    save_traj, agent, path, exit_status=exit_status, result=result, extra_info=extra_info  # type: ignore[arg-type]
+                )
+            elif agent is not None:
+                eval_error = None
+                try:
+                    result, eval_cache_status = await asyncio.to_thread(
+                        evaluate_trajectory_cached,
+                        eval_cache,
+                        instance,
+                        result,
+                        sweagent_config,
+                        data_source,
+                        env=None if strict_eval else env,
+                        base_commit=base_commit,
+                        eval_mode=generator_cfg.get("miniswe_eval_mode", "full"),
+                    )
+                    reward = int(result["resolved"])
+                    eval_error = result["eval_error"]
+                    if eval_error:
+                        error = eval_error
+                        logger.debug(f"Error during evaluation {eval_error}")
+                except Exception as e:
+                    logger.debug(f"Error during evaluation {e}")
+                    logger.debug(f"traceback: {traceback.format_exc()}")
+                    eval_error = str(e)
+                    error = str(e)
+
+                await asyncio.to_thread(
+                    save_traj, agent, path, exit_status=exit_status, result=result, extra_info=extra_info, reward=reward, eval_error=eval_error  # type: ignore[arg-type]
+                )
+
+        return (agent.messages if agent is not None else [], reward, error, eval_cache_status, model_patch)
@@ -1,15 +1,16 @@
 import asyncio
-from typing import Dict, List, Optional, Any, Tuple
+import itertools
+from collections import Counter
+from typing import Awaitable, Callable, Dict, List, Optional, Any, Tuple
+from loguru import logger
 from omegaconf import DictConfig
-import yaml
 import traceback
 import ray
+from ray.util.scheduling_strategies import NodeAffinitySchedulingStrategy
 from pathlib import Path
 
 from minisweagent.models import get_model
-from minisweagent.agents.default import DefaultAgent
 from minisweagent.run.utils.save import save_traj
-from minisweagent.config import get_config_path
 
 from skyrl_train.generators.skyrl_gym_generator import SkyRLGymGenerator, GeneratorOutput, GeneratorInput
 from skyrl_train.inference_engines.base import ConversationType
@@ -19,42 +20,50 @@ from skyrl_train.generators.utils import (
     get_rollout_metrics,
 )
 
-from rca.utils.mini_swe_utils import evaluate_trajectory, get_sb_environment
-
-class DefaultAgentWithReminder(DefaultAgent):
-    def get_observation(self, response: dict) -> dict:
-        """Execute the action and return the output."""
-        output = self.execute_action(self.parse_action(response))
-        observation = self.render_template(self.config.action_observation_template, output=output)
-        remaining = self.config.step_limit - self.model.n_calls
-
-        if remaining == 1:
-            observation = f"{observation}\nREMINDER: You only have 1 turn left. Please provide the final answer"
-        elif remaining > 1:
-            observation = f"{observation}\nREMINDER: You have {remaining} turns left to arrive at the solution."
-
-        self.add_message("user", observation)
-        return output
-
+from rca.agents import DefaultAgentWithReminder
+from rca.agents.early_stop_agent import get_early_stop_info
+from rca.datasets.instances import InstanceTable
+from rca.generators.async_runner import AsyncTrajectoryRunner
+from rca.generators.token_capture import assemble_captured_tokens, compact_token_records, with_token_capture
+from rca.generators.tokenization import TrajectoryTokenizer
+from rca.utils.config import load_config, thaw
+from rca.utils.eval_cache import EvalCache, get_eval_cache_metrics
+from rca.utils.mini_swe import (
+    evaluate_patches_cached,
+    evaluate_trajectory_cached,
+    get_head_commit,
+    get_sb_environment,
+)
 
 @ray.remote(num_cpus=0.01)
-def init_and_run(instance, litellm_model_name, sweagent_config, generator_cfg, data_source, sampling_params):
+def init_and_run(instance, litellm_model_name, sweagent_config, generator_cfg, data_source, sampling_params, group_eval=False):
     from loguru import logger
 
-    model_config = sweagent_config.get("model", {})
+    model_config = thaw(sweagent_config.get("model", {}))
     # Use new sampling parameters
     # Can also have custom sampling parameters per trajectory (ex: custom max tokens)
     model_config.setdefault("model_kwargs", {}).update(sampling_params)
     model = get_model(litellm_model_name, model_config)
 
+    # strict mode (default) evaluates in a fresh container instead of reusing the rollout's one
+    strict_eval = generator_cfg.get("miniswe_strict_eval", True)
+    # identical patches of an instance are evaluated once, see `EvalCache`
+    eval_cache_dir = generator_cfg.get("miniswe_eval_cache_dir")
+    eval_cache = EvalCache(eval_cache_dir) if eval_cache_dir else None
+
     agent = None
     env = None
+    base_commit = None
     extra_info = None
     result = None
     reward = 0
     error = None
+    eval_cache_status = None
+    model_patch = None
     try:
         env = get_sb_environment(sweagent_config, instance, data_source)
+        if not strict_eval and not group_eval:
+            base_commit = get_head_commit(env, env.config.cwd)
         agent = DefaultAgentWithReminder(model, env, **sweagent_config.get("agent", {}))
         exit_status, result = agent.run(instance["problem_statement"])  # type: ignore[arg-type]
     except Exception as e:
@@ -63,13 +72,29 @@ def init_and_run(instance, litellm_model_name, sweagent_config, generator_cfg, d
         error = str(e)
         extra_info = {"traceback": traceback.format_exc()}
     finally:
+        if agent is not None:
+            compact_token_records(agent.messages)
+        extra_info = (extra_info or {}) | get_early_stop_info(model)
         path = Path(generator_cfg.miniswe_traj_dir)
         path.mkdir(parents=True, exist_ok=True)
         path = path / f"{instance['instance_id']}.json"
-        if agent is not None:
+        if agent is not None and group_eval:
+            # evaluated together with the other trajectories of the instance, see `evaluate_group`
+            model_patch = result
+            save_traj(agent, path, exit_status=exit_status, result=result, extra_info=extra_info)  # type: ignore[arg-type]
+        elif agent is not None:
             eval_error = None
             try:
-                result = evaluate_trajectory(instance, result, sweagent_config, data_source)
+                result, eval_cache_status = evaluate_trajectory_cached(
+                    eval_cache,
+                    instance,
+                    result,
+                    sweagent_config,
+                    data_source,
+                    env=None if strict_eval else env,
+                    base_commit=base_commit,
+                    eval_mode=generator_cfg.get("miniswe_eval_mode", "full"),
+                )
                 reward = int(result["resolved"])
                 eval_error = result["eval_error"]
                 if eval_error:
@@ -83,7 +108,63 @@ def init_and_run(instance, litellm_model_name, sweagent_config, generator_cfg, d
 
             save_traj(agent, path, exit_status=exit_status, result=result, extra_info=extra_info, reward=reward, eval_error=eval_error)  # type: ignore[arg-type]
 
-    return (agent.messages if agent is not None else [], reward, error)
+    return (agent.messages if agent is not None else [], reward, error, eval_cache_status, model_patch)
+
+
+@ray.remote(num_cpus=0.01)
+def evaluate_group(instance, model_patches, sweagent_config, generator_cfg, data_source):
+    """Evaluate the patches of all trajectories of one instance in a single fresh environment.
+
+    Returns `(reward, eval_error, eval_cache_status)` per patch, `None` patches (failed rollouts) get no reward.
+    """
+    eval_cache_dir = generator_cfg.get("miniswe_eval_cache_dir")
+    indices = [i for i, patch in enumerate(model_patches) if patch is not None]
+    results = evaluate_patches_cached(
+        EvalCache(eval_cache_dir) if eval_cache_dir else None,
+        instance,
+        [model_patches[i] for i in indices],
+        sweagent_config,
+        data_source,
+        eval_mode=generator_cfg.get("miniswe_eval_mode", "full"),
+    )
+    outputs = [(0, None, None)] * len(model_patches)
+    for i, (result, status) in zip(indices, results):
+        outputs[i] = (int(result["resolved"]), result["eval_error"], status)
+    return outputs
+
+
+class GroupEvaluation:
+    """Collects the patches of the `size` trajectories of one instance and evaluates them with one `launch`.
+
+    `submit` returns a future of the trajectory's `(reward, eval_error, eval_cache_status)`, which is resolved
+    once every trajectory of the group has submitted its patch.
+    """
+
+    def __init__(self, size: int, launch: Callable[[List[Optional[str]]], Awaitable[List[Tuple[int, Optional[str], Optional[str]]]]]):
+        self.size = size
+        self._launch = launch
+        self._patches: List[Optional[str]] = []
+        self._futures: List[asyncio.Future] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def submit(self, model_patch: Optional[str]) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._patches.append(model_patch)
+        self._futures.append(future)
+        if len(self._patches) == self.size:
+            self._task = loop.create_task(self._evaluate())
+        return future
+
+    async def _evaluate(self):
+        try:
+            outputs = await self._launch(self._patches)
+        except Exception as e:
+            for future in self._futures:
+                future.set_exception(e)
+            return
+        for future, output in zip(self._futures, outputs):
+            future.set_result(output)
 
 
 class MiniSweAgentGenerator(SkyRLGymGenerator):
@@ -113,6 +194,66 @@ class MiniSweAgentGenerator(SkyRLGymGenerator):
         self.model_name = model_name
         self.litellm_model_name = "openai/" + self.model_name
 
+        # `ray_task`: one Ray task (and worker process) per trajectory
+        # `async`: one `AsyncTrajectoryRunner` per node driving many trajectories from an event loop
+        self.execution_mode = generator_cfg.get("miniswe_execution_mode", "ray_task")
+        if self.execution_mode not in ("ray_task", "async"):
+            raise ValueError(f"Unknown miniswe_execution_mode: {self.execution_mode}")
+        self._runners = None
+        self._runner_index = itertools.count()
+        # use the token ids and logprobs returned by the inference server instead of re-tokenizing trajectories
+        self.capture_tokens = generator_cfg.get("miniswe_capture_tokens", False)
+        # trajectories of the current batch that had to be re-tokenized although `capture_tokens` is set
+        self._token_capture_fallbacks = 0
+        self.trajectory_tokenizer = TrajectoryTokenizer(
+            tokenizer, max_workers=generator_cfg.get("miniswe_tokenizer_workers", 4)
+        )
+        # parsed and validated once, trajectories share it through the object store (see `_get_config_refs`)
+        self.sweagent_config = load_config(generator_cfg.miniswe_config_path)
+        self._config_refs = None
+        self._instances = None
+        # `EvalCache` statuses of the trajectories of the current batch, for `rollout_metrics`
+        self._eval_cache_statuses: List[Optional[str]] = []
+        # `miniswe_group_eval`: trajectories of an instance are evaluated together, see `GroupEvaluation`
+        self.group_eval = generator_cfg.get("miniswe_group_eval", False)
+        self._eval_groups: Dict[str, GroupEvaluation] = {}
+
+    def _get_config_refs(self) -> Tuple[ray.ObjectRef, ray.ObjectRef]:
+        """Object refs of the mini-swe-agent config and the generator config, put into the object store once.
+
+        Ray resolves top-level `ObjectRef` arguments before running a task or actor method, so trajectories
+        receive the configs without serializing them per call.
+        """
+        if self._config_refs is None:
+            self._config_refs = (ray.put(self.sweagent_config), ray.put(self.generator_cfg))
+        return self._config_refs
+
+    def _get_runners(self) -> List[ray.actor.ActorHandle]:
+        """Start one trajectory runner per alive node, Ray is only used to fan out across nodes."""
+        if self._runners is None:
+            nodes = [node for node in ray.nodes() if node["Alive"] and node["Resources"].get("CPU", 0) > 0]
+            max_concurrent = self.generator_cfg.get("miniswe_max_concurrent_trajectories", 64)
+            self._runners = [
+                AsyncTrajectoryRunner.options(
+                    scheduling_strategy=NodeAffinitySchedulingStrategy(node_id=node["NodeID"], soft=False),
+                    # trajectories beyond `max_concurrent` are queued by the runner itself
+                    max_concurrency=10_000,
+                ).remote(
+                    max_concurrent_trajectories=max_concurrent,
+                    env_pool_depth=self.generator_cfg.get("miniswe_env_pool_depth", 0),
+                )
+                for node in nodes
+            ]
+        return self._runners
+
+    def _get_instance(self, env_extras: Dict[str, Any]) -> Dict[str, Any]:
+        """The SWE instance of a prompt, either embedded in the row or from the `*_instances.parquet` side tables."""
+        if env_extras.get("instance") is not None:
+            return env_extras["instance"]
+        if self._instances is None:
+            self._instances = InstanceTable(self.generator_cfg.get("miniswe_instance_tables", []))
+        return self._instances[env_extras["instance_id"]]
+
     async def minisweagent_agent_loop(
         self,
         prompt: ConversationType,
@@ -120,60 +261,52 @@ class MiniSweAgentGenerator(SkyRLGymGenerator):
         max_tokens: int,
         max_input_length: int,
         sampling_params: Dict[str, Any],
-    ) -> Tuple[List[int], float, str, List[int], List[int], Optional[List[int]]]:
+    ) -> Tuple[List[int], float, str, List[int], List[int], Optional[List[float]]]:
 
-        sweagent_config = yaml.safe_load(get_config_path(self.generator_cfg.miniswe_config_path).read_text())
+        sweagent_config_ref, generator_cfg_ref = self._get_config_refs()
+        instance = self._get_instance(env_extras)
         # NOTE (sumanthrh): Input `prompt` is not used here because mini-swe-agent uses a similar entry from the `instance` obj
-        messages, reward, error = await init_and_run.remote(
-            env_extras["instance"],
-            self.litellm_model_name,
-            sweagent_config,
-            self.generator_cfg,
-            env_extras["data_source"],
-            sampling_params,
-        )
+        if self.execution_mode == "async":
+            runners = self._get_runners()
+            run = runners[next(self._runner_index) % len(runners)].run
+        else:
+            run = init_and_run
+        try:
+            messages, reward, error, eval_cache_status, model_patch = await run.remote(
+                instance,
+                self.litellm_model_name,
+                sweagent_config_ref,
+                generator_cfg_ref,
+                env_extras["data_source"],
+                with_token_capture(sampling_params) if self.capture_tokens else sampling_params,
+                self.group_eval,
+            )
+        except BaseException:
+            if self.group_eval:
+                # don't leave the rest of the group waiting
+                self._eval_groups[instance["instance_id"]].submit(None)
+            raise
+        if self.group_eval:
+            reward, error, eval_cache_status = await self._eval_groups[instance["instance_id"]].submit(
+                model_patch if len(messages) else None
+            )
+        self._eval_cache_statuses.append(eval_cache_status)
         if not len(messages):
             return None, None, None, None, None, None
 
-        # TODO (sumanthrh): This is currently hardcoded for SWEBench with 2 initial messages (system and user).
-        response_messages = messages[2:]
-
-        for message in messages[:2]:
-            assert message["role"] in (
-                "system",
-                "user",
-            ), "Expected the first two messages to be system and user messages"
-
-        initial_input_ids = self.tokenizer.apply_chat_template(messages[:2], add_generation_prompt=False, tokenize=True)
-        initial_prompt_length = len(initial_input_ids)
-
-        response_ids: List[int] = []
-        loss_mask: List[int] = []
-
-        # We remove trailing `user` messages - this is added by Mini-SWE-Agent to capture the final git diff for the trajectory
-        last_idx = len(response_messages) - 1
-        while response_messages[last_idx]["role"] == "user":
-            last_idx -= 1
-        if last_idx < 0:
-            raise ValueError(
-                "Found no assistant messages. Please ensure that your environment is configured correctly and the `OPENAI_BASE_URL` points to the HTTP server from the inference engine client"
+        rollout_logprobs = None
+        captured = assemble_captured_tokens(messages) if self.capture_tokens else None
+        if captured is not None:
+            prompt_ids, response_ids, loss_mask, rollout_logprobs = captured
+        else:
+            if self.capture_tokens:
+                # the endpoint didn't return token ids (e.g. dropped by litellm) or the template isn't prefix-consistent
+                logger.warning(f"No captured tokens for {instance['instance_id']}, re-tokenizing the trajectory")
+                self._token_capture_fallbacks += 1
+            prompt_ids, response_ids, loss_mask = await self.trajectory_tokenizer.atokenize(
+                instance["instance_id"], messages
             )
-        response_messages = response_messages[: last_idx + 1]
-
-        for message in response_messages:
-            # Apply chat template and tokenize each message
-            msg_encoding = self.tokenizer.apply_chat_template([message], add_generation_prompt=False, tokenize=True)
-
-            # Extend response_ids with the tokens
-            response_ids.extend(msg_encoding)
-
-            # Extend loss_mask: 0s for user, 1s for assistant
-            if message["role"] == "user":
-                loss_mask.extend([0] * len(msg_encoding))
-            else:  # assistant
-                loss_mask.extend([1] * len(msg_encoding))
-        # Extract prompt ids
-        prompt_ids = initial_input_ids
+        initial_prompt_length = len(prompt_ids)
 
         # Calculate maximum response tokens allowed
         max_response_tokens = max_tokens + max_input_length - initial_prompt_length
@@ -184,10 +317,12 @@ class MiniSweAgentGenerator(SkyRLGymGenerator):
             stop_reason = "length"
 
         # Truncate to maximum allowed length
-        response_ids = response_ids[:max_response_tokens]
-        loss_mask = loss_mask[:max_response_tokens]
+        response_ids = response_ids[:max_response_tokens].tolist()
+        loss_mask = loss_mask[:max_response_tokens].tolist()
+        if rollout_logprobs is not None:
+            rollout_logprobs = rollout_logprobs[:max_response_tokens].tolist()
 
-        return (response_ids, reward, stop_reason, loss_mask, prompt_ids, None)
+        return (response_ids, reward, stop_reason, loss_mask, prompt_ids, rollout_logprobs)
 
     async def generate(self, input_batch: GeneratorInput) -> GeneratorOutput:
         """
@@ -208,6 +343,25 @@ class MiniSweAgentGenerator(SkyRLGymGenerator):
         )
 
         tasks = []
+        self._eval_cache_statuses = []
+        self._token_capture_fallbacks = 0
+        if self.group_eval:
+            sizes = Counter()
+            groups = {}
+            for extras in env_extras:
+                instance = self._get_instance(extras)
+                sizes[instance["instance_id"]] += 1
+                groups[instance["instance_id"]] = (instance, extras["data_source"])
+            sweagent_config_ref, generator_cfg_ref = self._get_config_refs()
+            self._eval_groups = {
+                instance_id: GroupEvaluation(
+                    sizes[instance_id],
+                    lambda patches, instance=instance, data_source=data_source: evaluate_group.remote(
+                        instance, patches, sweagent_config_ref, generator_cfg_ref, data_source
+                    ),
+                )
+                for instance_id, (instance, data_source) in groups.items()
+            }
 
         for i in range(len(prompts)):
             tasks.append(
@@ -228,11 +382,21 @@ class MiniSweAgentGenerator(SkyRLGymGenerator):
         stop_reasons = [output[2] for output in all_outputs if output[0] is not None]
         loss_masks = [output[3] for output in all_outputs if output[0] is not None]
         prompt_token_ids = [output[4] for output in all_outputs if output[0] is not None]
+        logprobs = [output[5] for output in all_outputs if output[0] is not None]
         if not len(responses):
             raise ValueError(
                 "Found no valid responses for this step. This means that generation failed for all trajectories, likely due to errors in environment setup."
             )
         rollout_metrics = get_rollout_metrics(responses, rewards)
+        rollout_metrics.update(get_eval_cache_metrics(self._eval_cache_statuses))
+        if self.capture_tokens:
+            rollout_metrics["token_capture_fallback_rate"] = self._token_capture_fallbacks / len(all_outputs)
+        if self._runners is not None:
+            pool_stats = await asyncio.gather(*[runner.get_env_pool_stats.remote() for runner in self._runners])
+            acquired = sum(stats["hits"] + stats["partial_hits"] + stats["misses"] for stats in pool_stats)
+            if acquired:
+                rollout_metrics["env_pool_hit_rate"] = sum(stats["hits"] for stats in pool_stats) / acquired
+                rollout_metrics["env_pool_mean_wait_time"] = sum(stats["wait_time"] for stats in pool_stats) / acquired
 
         generator_output: GeneratorOutput = {
             "prompt_token_ids": prompt_token_ids,
@@ -241,7 +405,8 @@ class MiniSweAgentGenerator(SkyRLGymGenerator):
             "loss_masks": loss_masks,
             "stop_reasons": stop_reasons,
             "rollout_metrics": rollout_metrics,
-            "rollout_logprobs": None,
+            # only usable if every trajectory was captured, re-tokenized ones have no logprobs
+            "rollout_logprobs": logprobs if all(lp is not None for lp in logprobs) else None,
         }
 
         return generator_output
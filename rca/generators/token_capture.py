@@ -0,0 +1,116 @@
+from typing import Any, Dict, List, Optional, Tuple, TypedDict
+
+import numpy as np
+
+# Ask the vLLM-backed endpoint to return the sampled token ids with every completion:
+# `return_token_ids` adds `prompt_token_ids` (and `choices[].token_ids`), and `return_tokens_as_token_ids`
+# renders logprob tokens as `token_id:<id>`, which survives litellm's response conversion
+TOKEN_CAPTURE_SAMPLING_PARAMS: Dict[str, Any] = {
+    "logprobs": True,
+    "extra_body": {"return_token_ids": True, "return_tokens_as_token_ids": True},
+}
+
+
+class TokenRecord(TypedDict):
+    prompt_ids: Optional[List[int]]
+    """`None` if dropped by `compact_token_records`."""
+    prompt_length: int
+    response_ids: List[int]
+    logprobs: List[float]
+
+
+def with_token_capture(sampling_params: Dict[str, Any]) -> Dict[str, Any]:
+    """Return `sampling_params` extended by the request fields needed for token capture."""
+    extra_body = {**sampling_params.get("extra_body", {}), **TOKEN_CAPTURE_SAMPLING_PARAMS["extra_body"]}
+    return {**sampling_params, **TOKEN_CAPTURE_SAMPLING_PARAMS, "extra_body": extra_body}
+
+
+def get_token_record(message: dict) -> Optional[TokenRecord]:
+    """Token ids and logprobs the policy produced for an assistant message, if the endpoint returned them."""
+    response = message.get("extra", {}).get("response")
+    if not response or not response.get("choices"):
+        return None
+    prompt_ids = response.get("prompt_token_ids")
+    prompt_length = len(prompt_ids) if prompt_ids else response.get("prompt_token_count")
+    if not prompt_length:
+        return None
+    choice = response["choices"][0]
+    logprobs_content = (choice.get("logprobs") or {}).get("content") or []
+    response_ids = choice.get("token_ids")
+    if response_ids is None:
+        try:
+            response_ids = [int(entry["token"].removeprefix("token_id:")) for entry in logprobs_content]
+        except (KeyError, ValueError):
+            return None
+    if not response_ids or len(logprobs_content) != len(response_ids):
+        return None
+    return TokenRecord(
+        prompt_ids=list(prompt_ids) if prompt_ids else None,
+        prompt_length=prompt_length,
+        response_ids=list(response_ids),
+        logprobs=[entry["logprob"] for entry in logprobs_content],
+    )
+
+
+def compact_token_records(messages: List[dict]):
+    """Drop the prompt token ids of all but the last captured assistant message, in place.
+
+    Every prompt repeats the whole conversation so far, keeping them all would store a quadratic number of
+    token ids in the trajectory. The last prompt contains the earlier ones, so only their lengths
+    (`prompt_token_count`) are kept, which is all `assemble_captured_tokens` needs.
+    """
+    responses = [
+        response
+        for message in messages
+        if message["role"] == "assistant" and (response := message.get("extra", {}).get("response"))
+        if response.get("prompt_token_ids")
+    ]
+    for response in responses[:-1]:
+        response["prompt_token_count"] = len(response["prompt_token_ids"])
+        response["prompt_token_ids"] = None
+
+
+def assemble_captured_tokens(
+    messages: List[dict],
+) -> Optional[Tuple[List[int], np.ndarray, np.ndarray, np.ndarray]]:
+    """Build `(prompt_ids, response_ids, loss_mask, logprobs)` for a trajectory from captured token records.
+
+    Every model call's prompt must extend the previous prompt plus the sampled response, the tokens in between
+    are the observation (loss mask 0, logprob 0). This is checked against the last prompt, which must contain
+    each earlier prompt (any that were kept) and each sampled response at its position. Returns `None` if a
+    record is missing or the chat template is not prefix-consistent across turns (e.g. templates that drop
+    earlier reasoning), in which case the caller falls back to re-tokenizing the messages.
+    """
+    records = []
+    for message in messages:
+        if message["role"] != "assistant":
+            continue
+        if (record := get_token_record(message)) is None:
+            return None
+        records.append(record)
+    if not records or records[-1]["prompt_ids"] is None:
+        return None
+
+    # the last prompt plus its response is the whole trajectory
+    context = records[-1]["prompt_ids"] + records[-1]["response_ids"]
+    prompt_ids = context[: records[0]["prompt_length"]]
+    end = len(prompt_ids)
+    response_ids: List[np.ndarray] = []
+    loss_mask: List[np.ndarray] = []
+    logprobs: List[np.ndarray] = []
+    for record in records:
+        start = record["prompt_length"]
+        if start < end or (record["prompt_ids"] is not None and context[:start] != record["prompt_ids"]):
+            return None
+        if start > end:
+            observation_ids = context[end:start]
+            response_ids.append(np.asarray(observation_ids, dtype=np.int64))
+            loss_mask.append(np.zeros(len(observation_ids), dtype=np.int64))
+            logprobs.append(np.zeros(len(observation_ids), dtype=np.float32))
+        end = start + len(record["response_ids"])
+        if context[start:end] != record["response_ids"]:
+            return None
+        response_ids.append(np.asarray(record["response_ids"], dtype=np.int64))
+        loss_mask.append(np.ones(len(record["response_ids"]), dtype=np.int64))
+        logprobs.append(np.asarray(record["logprobs"], dtype=np.float32))
+    return prompt_ids, np.concatenate(response_ids), np.concatenate(loss_mask), np.concatenate(logprobs)
@@ -0,0 +1,79 @@
+import asyncio
+import hashlib
+import itertools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+import numpy as np
+
+
+class TrajectoryTokenizer:
+    """Turns finished mini-swe-agent trajectories into `(prompt_ids, response_ids, loss_mask)`.
+
+    - Runs in a thread pool (`atokenize`), so that chat templating of long trajectories doesn't block
+      the generator's event loop.
+    - Tokenizes all response messages with one batched `apply_chat_template` call.
+    - Caches the tokenized system + instance prompt per instance, which is shared by all rollouts of a group
+      and across epochs.
+    - Builds `response_ids`/`loss_mask` as numpy arrays instead of growing Python lists.
+    """
+
+    def __init__(self, tokenizer, *, max_workers: int = 4, prompt_cache_size: int = 4096):
+        self.tokenizer = tokenizer
+        self.prompt_cache_size = prompt_cache_size
+        self._prompt_cache: OrderedDict[Tuple[str, str], List[int]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tokenize")
+
+    def _prompt_ids(self, instance_id: str, initial_messages: List[dict]) -> List[int]:
+        # the rendered prompt is keyed by content too, in case the config (and so the templates) change
+        digest = hashlib.sha1("\0".join(m["content"] for m in initial_messages).encode()).hexdigest()
+        key = (instance_id, digest)
+        with self._lock:
+            if (prompt_ids := self._prompt_cache.get(key)) is not None:
+                self._prompt_cache.move_to_end(key)
+                return list(prompt_ids)
+        prompt_ids = self.tokenizer.apply_chat_template(initial_messages, add_generation_prompt=False, tokenize=True)
+        with self._lock:
+            self._prompt_cache[key] = prompt_ids
+            if len(self._prompt_cache) > self.prompt_cache_size:
+                self._prompt_cache.popitem(last=False)
+        return list(prompt_ids)
+
+    def tokenize(self, instance_id: str, messages: List[dict]) -> Tuple[List[int], np.ndarray, np.ndarray]:
+        # TODO (sumanthrh): This is currently hardcoded for SWEBench with 2 initial messages (system and user).
+        for message in messages[:2]:
+            assert message["role"] in (
+                "system",
+                "user",
+            ), "Expected the first two messages to be system and user messages"
+        prompt_ids = self._prompt_ids(instance_id, messages[:2])
+
+        # We remove trailing `user` messages - this is added by Mini-SWE-Agent to capture the final git diff for the trajectory
+        response_messages = messages[2:]
+        last_idx = len(response_messages) - 1
+        while last_idx >= 0 and response_messages[last_idx]["role"] == "user":
+            last_idx -= 1
+        if last_idx < 0:
+            raise ValueError(
+                "Found no assistant messages. Please ensure that your environment is configured correctly and the `OPENAI_BASE_URL` points to the HTTP server from the inference engine client"
+            )
+        response_messages = response_messages[: last_idx + 1]
+
+        # each message is templated on its own, as a batch of single-message conversations
+        encodings = self.tokenizer.apply_chat_template(
+            [[message] for message in response_messages], add_generation_prompt=False, tokenize=True
+        )
+        lengths = np.fromiter(map(len, encodings), dtype=np.int64, count=len(encodings))
+        response_ids = np.fromiter(
+            itertools.chain.from_iterable(encodings), dtype=np.int64, count=int(lengths.sum())
+        )
+        # 0s for user, 1s for assistant
+        is_assistant = np.fromiter((m["role"] != "user" for m in response_messages), dtype=np.int64)
+        loss_mask = np.repeat(is_assistant, lengths)
+        return prompt_ids, response_ids, loss_mask
+
+    async def atokenize(self, instance_id: str, messages: List[dict]) -> Tuple[List[int], np.ndarray, np.ndarray]:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self.tokenize, instance_id, messages)
@@ -4,27 +4,38 @@
 # Read this first: https://mini-swe-agent.com/latest/usage/swebench/  (usage docs)
 
 import concurrent.futures
-import json
+import math
+import multiprocessing
+import multiprocessing.synchronize
+import os
+import queue
 import random
 import re
 import threading
 import time
 import traceback
+from collections.abc import Mapping
 from pathlib import Path
 
+import pyarrow as pa
+import pyarrow.compute as pc
 import typer
 import yaml
-from datasets import load_dataset
+from datasets import Dataset, load_dataset
 from rich.live import Live
 
 from minisweagent.agents.default import DefaultAgent
 from minisweagent.config import builtin_config_dir, get_config_path
-from minisweagent.models import get_model
+from minisweagent.models import GLOBAL_MODEL_STATS, get_model
 from minisweagent.run.extra.utils.batch_progress import RunBatchProgressManager
 from minisweagent.run.utils.save import save_traj
 from minisweagent.utils.log import add_file_handler, logger
 
-from rca.utils.mini_swe import evaluate_trajectory, get_environment
+from rca.agents.early_stop_agent import get_early_stop_info
+from rca.environments.pool import EnvironmentPool
+from rca.utils.mini_swe import evaluate_trajectory, get_sb_environment
+from rca.utils.preds import PredictionsStore
+from rca.utils.scheduling import InstanceScheduler, load_history
 
 _HELP_TEXT = """Run mini-SWE-agent on SWEBench instances.
 
@@ -46,9 +57,6 @@ DATASET_MAPPING = {
 }
 
 
-_OUTPUT_FILE_LOCK = threading.Lock()
-
-
 class ProgressTrackingAgent(DefaultAgent):
     """Simple wrapper around DefaultAgent that provides progress updates."""
 
@@ -64,54 +72,39 @@ class ProgressTrackingAgent(DefaultAgent):
         )
         return super().step()
 
-def update_preds_file(output_path: Path, instance_id: str, model_name: str, result: str):
-    """Update the output JSON file with results from a single instance."""
-    with _OUTPUT_FILE_LOCK:
-        output_data = {}
-        if output_path.exists():
-            output_data = json.loads(output_path.read_text())
-        output_data[instance_id] = {
-            "model_name_or_path": model_name,
-            "instance_id": instance_id,
-            "model_patch": result,
-        }
-        output_path.write_text(json.dumps(output_data, indent=2))
-
-
-def remove_from_preds_file(output_path: Path, instance_id: str):
-    """Remove an instance from the predictions file."""
-    if not output_path.exists():
-        return
-    with _OUTPUT_FILE_LOCK:
-        output_data = json.loads(output_path.read_text())
-        if instance_id in output_data:
-            del output_data[instance_id]
-            output_path.write_text(json.dumps(output_data, indent=2))
-
-
 def process_instance(
     instance: dict,
     output_dir: Path,
     config: dict,
     progress_manager: RunBatchProgressManager,
+    preds_store: PredictionsStore,
+    env_pool: EnvironmentPool,
+    scheduler: InstanceScheduler | None = None,
 ) -> None:
     """Process a single SWEBench instance."""
     instance_id = instance["instance_id"]
     instance_dir = output_dir / instance_id
     # avoid inconsistent state if something here fails and there's leftover previous files
-    remove_from_preds_file(output_dir / "preds.json", instance_id)
+    preds_store.remove(instance_id)
     (instance_dir / f"{instance_id}.traj.json").unlink(missing_ok=True)
     model = get_model(config=config.get("model", {}))
     task = instance["problem_statement"]
 
     progress_manager.on_instance_start(instance_id)
-    progress_manager.update_instance_status(instance_id, "Pulling/starting docker")
+    progress_manager.update_instance_status(instance_id, "Waiting for environment")
 
     agent = None
+    env = None
     extra_info = None
+    start_time = time.monotonic()
 
     try:
-        env = get_environment(config, instance)
+        if scheduler is not None:
+            progress_manager.update_instance_status(instance_id, "Waiting for cost budget")
+            scheduler.start_instance(instance_id)
+            progress_manager.update_instance_status(instance_id, "Waiting for environment")
+        start_time = time.monotonic()
+        env = env_pool.acquire(instance)
         agent = ProgressTrackingAgent(
             model,
             env,
@@ -125,6 +118,10 @@ def process_instance(
         exit_status, result = type(e).__name__, str(e)
         extra_info = {"traceback": traceback.format_exc()}
     finally:
+        if scheduler is not None:
+            scheduler.end_instance(instance_id)
+            if env is not None:
+                scheduler.release_container()
         # try:
         #     eval_result = evaluate_trajectory(
         #         instance,
@@ -141,32 +138,295 @@ def process_instance(
             exit_status=exit_status,
             result=result,
             # extra_info=eval_result,
-            extra_info=extra_info,
+            # read back by `rca.utils.scheduling.load_history`
+            extra_info=(extra_info or {}) | {"wall_time": time.monotonic() - start_time} | get_early_stop_info(model),
             instance_id=instance_id,
             print_fct=logger.info,
         )
-        update_preds_file(output_dir / "preds.json", instance_id, model.config.model_name, result)
+        preds_store.update(instance_id, model.config.model_name, result)
         progress_manager.on_instance_end(instance_id, exit_status)
 
 
-def filter_instances(
-    instances: list[dict], *, filter_spec: str, slice_spec: str = "", shuffle: bool = False
-) -> list[dict]:
-    """Filter and slice a list of SWEBench instances."""
+class LazyInstance(Mapping):
+    """A dataset row that is only read (and converted to Python objects) when a field other than the id is accessed."""
+
+    def __init__(self, dataset: Dataset, index: int, instance_id: str):
+        self._dataset = dataset
+        self._index = index
+        self._instance_id = instance_id
+        self._row: dict | None = None
+
+    def _load(self) -> dict:
+        if self._row is None:
+            self._row = self._dataset[self._index]
+        return self._row
+
+    def __getitem__(self, key: str):
+        if key == "instance_id":
+            return self._instance_id
+        return self._load()[key]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self) -> int:
+        return len(self._dataset.column_names)
+
+
+def select_instances(
+    dataset: Dataset, *, filter_spec: str, slice_spec: str = "", shuffle: bool = False, skip_ids: set[str] = frozenset()
+) -> list[LazyInstance]:
+    """Filter, slice and skip SWEBench instances on the Arrow `instance_id` column, without reading the other columns."""
+    ids = dataset.with_format("arrow")["instance_id"]
+    indices = pa.array(range(len(ids)), pa.int64())
     if shuffle:
-        instances = sorted(instances.copy(), key=lambda x: x["instance_id"])
+        order = pc.sort_indices(ids).to_pylist()
         random.seed(42)
-        random.shuffle(instances)
-    before_filter = len(instances)
-    instances = [instance for instance in instances if re.match(filter_spec, instance["instance_id"])]
-    if (after_filter := len(instances)) != before_filter:
+        random.shuffle(order)
+        indices = pa.array(order, pa.int64())
+        ids = ids.take(indices)
+    before_filter = len(ids)
+    if filter_spec:
+        try:
+            # `re.match` semantics
+            mask = pc.match_substring_regex(ids, f"^(?:{filter_spec})")
+        except pa.ArrowInvalid:
+            # not supported by Arrow's regex engine (RE2)
+            mask = pa.array([re.match(filter_spec, instance_id) is not None for instance_id in ids.to_pylist()])
+        ids, indices = ids.filter(mask), indices.filter(mask)
+    if (after_filter := len(ids)) != before_filter:
         logger.info(f"Instance filter: {before_filter} -> {after_filter} instances")
     if slice_spec:
         values = [int(x) if x else None for x in slice_spec.split(":")]
-        instances = instances[slice(*values)]
-        if (after_slice := len(instances)) != before_filter:
+        positions = pa.array(range(len(ids))[slice(*values)], pa.int64())
+        ids, indices = ids.take(positions), indices.take(positions)
+        if (after_slice := len(ids)) != before_filter:
             logger.info(f"Instance slice: {before_filter} -> {after_slice} instances")
-    return instances
+    if skip_ids:
+        mask = pc.invert(pc.is_in(ids, value_set=pa.array(sorted(skip_ids), pa.string())))
+        before_skip = len(ids)
+        ids, indices = ids.filter(mask), indices.filter(mask)
+        logger.info(f"Skipping {before_skip - len(ids)} existing instances")
+    return [LazyInstance(dataset, index, instance_id) for index, instance_id in zip(indices.to_pylist(), ids.to_pylist())]
+
+
+def run_instances(
+    instances: list[Mapping],
+    output_path: Path,
+    config: dict,
+    dataset_path: str,
+    workers: int,
+    env_pool_depth: int,
+    progress_manager: RunBatchProgressManager,
+    preds_store: PredictionsStore,
+    scheduler: InstanceScheduler | None = None,
+) -> None:
+    """Process `instances` with a pool of `workers` threads."""
+    if scheduler is not None:
+        env_pool_depth = scheduler.pool_depth(env_pool_depth, workers)
+
+    def make_env(instance: Mapping):
+        if scheduler is None:
+            return get_sb_environment(config, instance, dataset_path)
+        # the slot is released when the instance ends, see `process_instance`
+        scheduler.acquire_container()
+        try:
+            return get_sb_environment(config, instance, dataset_path)
+        except BaseException:
+            scheduler.release_container()
+            raise
+
+    env_pool = EnvironmentPool(
+        make_env,
+        depth=env_pool_depth,
+        # environments provisioned for instances that never ran (e.g. cancelled) give their slot back on `close`
+        release=None if scheduler is None else lambda env: scheduler.release_container(),
+    )
+    # workers pick up instances in submission order, so this is the order the pool looks ahead in
+    env_pool.schedule(instances)
+
+    def process_futures(futures: dict[concurrent.futures.Future, str]):
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except concurrent.futures.CancelledError:
+                pass
+            except Exception as e:
+                instance_id = futures[future]
+                logger.error(f"Error in future for instance {instance_id}: {e}", exc_info=True)
+                progress_manager.on_uncaught_exception(instance_id, e)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                process_instance, instance, output_path, config, progress_manager, preds_store, env_pool, scheduler
+            ): instance["instance_id"]
+            for instance in instances
+        }
+        try:
+            process_futures(futures)
+        except KeyboardInterrupt:
+            logger.info("Cancelling all pending jobs. Press ^C again to exit immediately.")
+            for future in futures:
+                if not future.running() and not future.done():
+                    future.cancel()
+            process_futures(futures)
+        finally:
+            env_pool.close()
+    logger.info(f"Environment pool stats: {env_pool.stats.as_dict()}")
+
+
+class QueueProgressManager:
+    """Stand-in for `RunBatchProgressManager` in worker processes, forwards updates to the parent over a queue.
+
+    Every message carries the worker's total model cost and calls, so that the parent can show the overall cost
+    and enforce the global limits.
+    """
+
+    def __init__(self, progress_queue: multiprocessing.Queue):
+        self._queue = progress_queue
+
+    def _send(self, method: str, *args):
+        self._queue.put((os.getpid(), GLOBAL_MODEL_STATS.cost, GLOBAL_MODEL_STATS.n_calls, method, args))
+
+    def on_instance_start(self, instance_id: str):
+        self._send("on_instance_start", instance_id)
+
+    def update_instance_status(self, instance_id: str, message: str):
+        self._send("update_instance_status", instance_id, message)
+
+    def on_instance_end(self, instance_id: str, exit_status: str | None):
+        self._send("on_instance_end", instance_id, exit_status)
+
+    def on_uncaught_exception(self, instance_id: str, exception: Exception):
+        # exceptions aren't necessarily picklable
+        self.on_instance_end(instance_id, f"Uncaught {type(exception).__name__}")
+
+
+def run_shard(
+    instances: list[Mapping],
+    output_path: Path,
+    config: dict,
+    dataset_path: str,
+    workers: int,
+    env_pool_depth: int,
+    progress_queue: multiprocessing.Queue,
+    scheduler: InstanceScheduler | None = None,
+    limit_exceeded: multiprocessing.synchronize.Event | None = None,
+) -> None:
+    """Entry point of a worker process in `--executor process` mode.
+
+    Once the parent sets `limit_exceeded`, every further model call of this process fails, as they do in a
+    single process once the global cost/call limit is exceeded.
+    """
+    add_file_handler(output_path / "minisweagent.log")
+    if limit_exceeded is not None:
+
+        def watch_limit():
+            limit_exceeded.wait()
+            # `GlobalModelStats.add` raises once the calls exceed the call limit
+            GLOBAL_MODEL_STATS.call_limit = 1
+
+        threading.Thread(target=watch_limit, name="global-limit", daemon=True).start()
+    # appends from all processes are serialized by the store's file lock, the parent compacts at the end
+    preds_store = PredictionsStore(output_path / "preds.json", compact_every=0)
+    progress_manager = QueueProgressManager(progress_queue)
+    run_instances(
+        instances, output_path, config, dataset_path, workers, env_pool_depth, progress_manager, preds_store, scheduler  # type: ignore[arg-type]
+    )
+
+
+def run_processes(
+    instances: list[Mapping],
+    output_path: Path,
+    config: dict,
+    dataset_path: str,
+    workers: int,
+    processes: int,
+    env_pool_depth: int,
+    progress_manager: RunBatchProgressManager,
+    scheduler: InstanceScheduler | None = None,
+) -> None:
+    """Shard `instances` over `processes` worker processes that run `workers` threads in total.
+
+    The processes share the `scheduler`'s budgets. The global cost/call limits
+    (`MSWEA_GLOBAL_COST_LIMIT`, `MSWEA_GLOBAL_CALL_LIMIT`) apply to the totals of all processes, which the
+    parent tracks from the progress updates.
+    """
+    processes = max(min(processes or os.cpu_count() or 1, workers, len(instances)), 1)
+    threads = math.ceil(workers / processes)
+    if scheduler is not None and scheduler.max_containers > 0:
+        # the environments ahead of the workers of all processes share the containers with them
+        pool_depth = scheduler.pool_depth(env_pool_depth, threads * processes) // processes
+    else:
+        pool_depth = math.ceil(env_pool_depth / processes)
+    logger.info(f"Running {processes} worker processes with {threads} threads each")
+    # spawn, since the parent already runs threads (rendering, logging)
+    context = multiprocessing.get_context("spawn")
+    progress_queue = context.Queue()
+    limit_exceeded = context.Event()
+    shard_scheduler = scheduler.share(context) if scheduler is not None else None
+    shards = [
+        context.Process(
+            target=run_shard,
+            # round-robin, so that each process gets a similar mix of instances (and keeps the longest-first order)
+            args=(
+                instances[i::processes],
+                output_path,
+                config,
+                dataset_path,
+                threads,
+                pool_depth,
+                progress_queue,
+                shard_scheduler,
+                limit_exceeded,
+            ),
+            name=f"shard-{i}",
+        )
+        for i in range(processes)
+    ]
+    for shard in shards:
+        shard.start()
+
+    worker_stats: dict[int, tuple[float, int]] = {}
+
+    def drain(timeout: float) -> bool:
+        try:
+            pid, cost, n_calls, method, args = progress_queue.get(timeout=timeout)
+        except queue.Empty:
+            return False
+        if (delta := cost - worker_stats.get(pid, (0.0, 0))[0]) > 0:
+            try:
+                GLOBAL_MODEL_STATS.add(delta)
+            except RuntimeError:
+                # counts an update as a call, the limits are checked on the totals of the workers below
+                pass
+        worker_stats[pid] = (cost, n_calls)
+        total_cost = sum(cost for cost, _ in worker_stats.values())
+        total_calls = sum(n_calls for _, n_calls in worker_stats.values())
+        if not limit_exceeded.is_set() and (
+            0 < GLOBAL_MODEL_STATS.cost_limit < total_cost or 0 < GLOBAL_MODEL_STATS.call_limit <= total_calls
+        ):
+            logger.warning(f"Global cost/call limit exceeded: ${total_cost:.4f} / {total_calls}, stopping the workers")
+            limit_exceeded.set()
+        getattr(progress_manager, method)(*args)
+        return True
+
+    try:
+        while any(shard.is_alive() for shard in shards):
+            drain(timeout=0.2)
+    except KeyboardInterrupt:
+        # the workers got the SIGINT as well and cancel their pending instances
+        logger.info("Waiting for worker processes to finish their running instances. Press ^C again to exit immediately.")
+        while any(shard.is_alive() for shard in shards):
+            drain(timeout=0.2)
+    # updates sent right before the workers exited
+    while drain(timeout=0.1):
+        pass
+    for shard in shards:
+        shard.join()
+        if shard.exitcode != 0:
+            logger.error(f"Worker process {shard.name} exited with code {shard.exitcode}")
 
 
 # fmt: off
@@ -184,8 +444,19 @@ def main(
     redo_existing: bool = typer.Option(False, "--redo-existing", help="Redo existing instances", rich_help_panel="Data selection"),
     config_spec: Path = typer.Option( builtin_config_dir / "extra" / "swebench.yaml", "-c", "--config", help="Path to a config file", rich_help_panel="Basic"),
     environment_class: str | None = typer.Option( None, "--environment-class", help="Environment type to use. Recommended are docker or singularity", rich_help_panel="Advanced"),
+    env_pool_depth: int = typer.Option(0, "--env-pool-depth", help="Number of environments to provision ahead of the workers (0 to start them on demand)", rich_help_panel="Advanced"),
+    executor: str = typer.Option("thread", "--executor", help="Run the workers as threads of this process ('thread') or spread over worker processes ('process')", rich_help_panel="Advanced"),
+    processes: int = typer.Option(0, "--processes", help="Number of worker processes for '--executor process', each running a share of the workers as threads (0 for one per CPU)", rich_help_panel="Advanced"),
+    schedule: str = typer.Option("dataset", "--schedule", help="Run instances in dataset order ('dataset') or by the wall time of earlier runs, longest first ('longest-first')", rich_help_panel="Scheduling"),
+    history: list[str] = typer.Option([], "--history", help="Output directories of earlier runs to estimate instances from (the output directory is always used)", rich_help_panel="Scheduling"),
+    max_concurrent_cost: float = typer.Option(0.0, "--max-concurrent-cost", help="Budget on the estimated cost of the instances running at once (0 for no limit)", rich_help_panel="Scheduling"),
+    max_containers: int = typer.Option(0, "--max-containers", help="Maximum number of environments at once, including those provisioned ahead (0 for no limit); --env-pool-depth is reduced to fit next to the workers", rich_help_panel="Scheduling"),
 ) -> None:
     # fmt: on
+    if executor not in ("thread", "process"):
+        raise typer.BadParameter(f"Unknown executor: {executor}", param_hint="--executor")
+    if schedule not in ("dataset", "longest-first"):
+        raise typer.BadParameter(f"Unknown schedule: {schedule}", param_hint="--schedule")
     output_path = Path(output)
     output_path.mkdir(parents=True, exist_ok=True)
     logger.info(f"Results will be saved to {output_path}")
@@ -193,13 +464,24 @@ def main(
 
     dataset_path = DATASET_MAPPING.get(subset, subset)
     logger.info(f"Loading dataset {dataset_path}, split {split}...")
-    instances = list(load_dataset(dataset_path, split=split))
-
-    instances = filter_instances(instances, filter_spec=filter_spec, slice_spec=slice_spec, shuffle=shuffle)
-    if not redo_existing and (output_path / "preds.json").exists():
-        existing_instances = list(json.loads((output_path / "preds.json").read_text()).keys())
-        logger.info(f"Skipping {len(existing_instances)} existing instances")
-        instances = [instance for instance in instances if instance["instance_id"] not in existing_instances]
+    # memory-mapped, rows are read when workers get to them
+    dataset = load_dataset(dataset_path, split=split)
+
+    preds_store = PredictionsStore(output_path / "preds.json")
+    instances = select_instances(
+        dataset,
+        filter_spec=filter_spec,
+        slice_spec=slice_spec,
+        shuffle=shuffle,
+        skip_ids=set() if redo_existing else preds_store.instance_ids(),
+    )
+    scheduler = None
+    if schedule != "dataset" or max_concurrent_cost > 0 or max_containers > 0:
+        scheduler = InstanceScheduler(
+            load_history([output_path, *history]), max_concurrent_cost=max_concurrent_cost, max_containers=max_containers
+        )
+        if schedule == "longest-first":
+            instances = scheduler.order(instances)
     logger.info(f"Running on {len(instances)} instances...")
 
     config_path = get_config_path(config_spec)
@@ -214,33 +496,16 @@ def main(
 
     progress_manager = RunBatchProgressManager(len(instances), output_path / f"exit_statuses_{time.time()}.yaml")
 
-    def process_futures(futures: dict[concurrent.futures.Future, str]):
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                future.result()
-            except concurrent.futures.CancelledError:
-                pass
-            except Exception as e:
-                instance_id = futures[future]
-                logger.error(f"Error in future for instance {instance_id}: {e}", exc_info=True)
-                progress_manager.on_uncaught_exception(instance_id, e)
-
     with Live(progress_manager.render_group, refresh_per_second=4):
-        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
-            futures = {
-                executor.submit(process_instance, instance, output_path, config, progress_manager): instance[
-                    "instance_id"
-                ]
-                for instance in instances
-            }
-            try:
-                process_futures(futures)
-            except KeyboardInterrupt:
-                logger.info("Cancelling all pending jobs. Press ^C again to exit immediately.")
-                for future in futures:
-                    if not future.running() and not future.done():
-                        future.cancel()
-                process_futures(futures)
+        if executor == "thread":
+            run_instances(
+                instances, output_path, config, dataset_path, workers, env_pool_depth, progress_manager, preds_store, scheduler
+            )
+        else:
+            run_processes(
+                instances, output_path, config, dataset_path, workers, processes, env_pool_depth, progress_manager, scheduler
+            )
+    preds_store.compact()
 
 
 if __name__ == "__main__":
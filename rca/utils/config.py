@@ -0,0 +1,71 @@
+import dataclasses
+from pathlib import Path
+from typing import Any, Mapping
+
+import yaml
+
+from minisweagent.agents.default import AgentConfig
+from minisweagent.config import get_config_path
+
+from rca.utils.templates import get_template
+
+_SECTIONS = ("agent", "environment", "model", "run")
+
+
+class FrozenDict(dict):
+    """Read-only dict, so that one parsed config can be shared by (and `ray.put` once for) all trajectories."""
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError(f"{type(self).__name__} is immutable, use `thaw` to get a mutable copy")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = __ior__ = _immutable
+
+    def __reduce__(self):
+        return type(self), (dict(self),)
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+def freeze(obj: Any) -> Any:
+    if isinstance(obj, Mapping):
+        return FrozenDict({key: freeze(value) for key, value in obj.items()})
+    if isinstance(obj, (list, tuple)):
+        return tuple(freeze(value) for value in obj)
+    return obj
+
+
+def thaw(obj: Any) -> Any:
+    """Deep mutable copy of a (frozen) config section."""
+    if isinstance(obj, Mapping):
+        return {key: thaw(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [thaw(value) for value in obj]
+    return obj
+
+
+def validate_config(config: Mapping, *, agent_config_class: type = AgentConfig):
+    if unknown := set(config) - set(_SECTIONS):
+        raise ValueError(f"Unknown config sections {sorted(unknown)}, expected a subset of {_SECTIONS}")
+    for section in _SECTIONS:
+        if not isinstance(config.get(section, {}), Mapping):
+            raise ValueError(f"Config section `{section}` must be a mapping")
+    agent_fields = {field.name for field in dataclasses.fields(agent_config_class)}
+    if unknown := set(config.get("agent", {})) - agent_fields:
+        raise ValueError(f"Unknown agent config keys {sorted(unknown)} for {agent_config_class.__name__}")
+
+
+def load_config(spec: str | Path, *, agent_config_class: type = AgentConfig) -> FrozenDict:
+    """Load, validate and freeze a mini-swe-agent config.
+
+    The agent templates and `run.env_startup_command` are compiled here, which surfaces syntax errors
+    before any environment is started and warms this process' template cache.
+    """
+    config = yaml.safe_load(get_config_path(spec).read_text()) or {}
+    validate_config(config, agent_config_class=agent_config_class)
+    for key, value in config.get("agent", {}).items():
+        if key.endswith("_template"):
+            get_template(value)
+    if startup_command := config.get("run", {}).get("env_startup_command"):
+        get_template(startup_command)
+    return freeze(config)
@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+import uuid
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from rca.utils.locking import file_lock
+
+
+def normalize_patch(patch: str) -> str:
+    """Canonical form of a git diff for hashing.
+
+    Line endings and trailing whitespace are normalized, blank lines around the diff and `index` lines
+    (blob hashes) dropped, and the per-file sections sorted by their header, so that patches which only
+    differ in these respects evaluate from the same cache entry.
+    """
+    if not isinstance(patch, str):
+        return ""
+    sections: list[list[str]] = []
+    for line in patch.replace("\r\n", "\n").split("\n"):
+        line = line.rstrip()
+        if line.startswith("diff --git ") or not sections:
+            sections.append([])
+        if not line.startswith("index "):
+            sections[-1].append(line)
+    normalized = ["\n".join(section).strip("\n") for section in sections]
+    return "\n".join(sorted(section for section in normalized if section))
+
+
+def patch_hash(patch: str) -> str:
+    return hashlib.sha256(normalize_patch(patch).encode()).hexdigest()
+
+
+class EvalCache:
+    """On-disk cache of evaluation results, keyed by instance id, image digest, normalized patch hash and a
+    hash of the other inputs of the verdict (`spec`, e.g. test commands and evaluation mode).
+
+    Identical patches (including the empty one) are common within GRPO groups and across epochs. Each key
+    is evaluated once: concurrent requests for the same key, from threads, processes or Ray workers on
+    nodes sharing `cache_dir`, serialize on a per-key `flock` and all but the first read the stored result.
+    Results are written to a temporary file and renamed, so readers never see a partial entry.
+
+    Layout::
+
+        <cache_dir>/<key[:2]>/<key>.json    results
+        <cache_dir>/locks/<key>.lock        in-flight evaluations
+    """
+
+    HIT = "hit"
+    """Stored result."""
+    DEDUP = "dedup"
+    """Waited for a concurrent evaluation of the same key."""
+    MISS = "miss"
+
+    def __init__(self, cache_dir: str | Path):
+        self.cache_dir = Path(cache_dir)
+        (self.cache_dir / "locks").mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(instance_id: str, image_digest: str, patch: str, spec: str = "") -> str:
+        return hashlib.sha256(f"{instance_id}\0{image_digest}\0{patch_hash(patch)}\0{spec}".encode()).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            return json.loads(self._path(key).read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def put(self, key: str, result: Dict[str, Any]):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+        tmp_path.write_text(json.dumps(result))
+        os.replace(tmp_path, path)
+
+    def get_or_evaluate(
+        self,
+        key: str,
+        evaluate: Callable[[], Dict[str, Any]],
+        *,
+        cacheable: Callable[[Dict[str, Any]], bool] = lambda result: True,
+    ) -> Tuple[Dict[str, Any], str]:
+        """Return the result for `key` and how it was obtained (`HIT`, `DEDUP` or `MISS`).
+
+        Results for which `cacheable` is false (e.g. the environment failed to start) are returned but not
+        stored, so the next request evaluates again.
+        """
+        if (result := self.get(key)) is not None:
+            return result, self.HIT
+        with file_lock(self.cache_dir / "locks" / f"{key}.lock"):
+            # someone else may have evaluated it while we were waiting for the lock
+            if (result := self.get(key)) is not None:
+                return result, self.DEDUP
+            result = evaluate()
+            if cacheable(result):
+                self.put(key, result)
+        return result, self.MISS
+
+
+def get_eval_cache_metrics(statuses: list[Optional[str]]) -> Dict[str, float]:
+    """Hit rates of the `EvalCache.get_or_evaluate` statuses of a batch, `None` for uncached evaluations."""
+    statuses = [status for status in statuses if status is not None]
+    if not statuses:
+        return {}
+    return {
+        "eval_cache_hit_rate": sum(status != EvalCache.MISS for status in statuses) / len(statuses),
+        "eval_cache_dedup_rate": sum(status == EvalCache.DEDUP for status in statuses) / len(statuses),
+    }
@@ -1,13 +1,19 @@
 from typing import TypedDict, Optional
+import hashlib
+import json
+import os
+import re
+import shlex
+import subprocess
+import time
 import traceback
 import uuid
+from contextlib import ExitStack, contextmanager
 
-from typing import Dict, Any
+from typing import Callable, Dict, Any, Iterator, List, Tuple
 from loguru import logger
 
-from jinja2 import StrictUndefined, Template
-
-from swebench.harness.constants import DOCKER_WORKDIR
+from swebench.harness.constants import DOCKER_WORKDIR, TestStatus
 from swesmith.profiles import registry
 from swesmith.constants import (
     TEST_OUTPUT_START,
@@ -15,12 +21,34 @@ from swesmith.constants import (
 )
 
 from minisweagent.environments import Environment, get_environment
+from minisweagent.environments.docker import DockerEnvironment
 from rca.environments import ApptainerEnvironment
+from rca.environments.image_cache import resolve_image_digest
+from rca.environments.streaming import run_streaming
+from rca.utils.eval_cache import EvalCache, patch_hash
+from rca.utils.config import thaw
+from rca.utils.templates import get_template
 
 class MiniSWEEvaluationResult(TypedDict):
     instance_id: str
     resolved: bool
     eval_error: Optional[str]
+    # the test stages that ran, empty if the patch didn't apply and `None` if the evaluation itself failed
+    eval_stages: Optional[Dict[str, Dict[str, Any]]]
+
+EVAL_MODES = ("full", "staged")
+EVAL_TIMEOUT = 3600
+# where `stage_file` puts files in docker containers
+DOCKER_STAGING_DIR = "/tmp/rca-staging"
+_FAILING = {TestStatus.FAILED.value, TestStatus.ERROR.value}
+# as in SWE-bench's grading
+_PASSING = {TestStatus.PASSED.value, TestStatus.XFAIL.value}
+# pytest's verbose progress lines, `tests/test_x.py::test_y FAILED [ 50%]` or with xdist
+# `[gw0] [ 50%] FAILED tests/test_x.py::test_y`; the log parsers only match the `-rA` summary at the end
+_PYTEST_PROGRESS = (
+    re.compile(r"^(?P<test>\S+::.+?) (?P<status>FAILED|ERROR)(?: +\[ *\d+%\])?$"),
+    re.compile(r"^\[gw\d+\] \[ *\d+%\] (?P<status>FAILED|ERROR) (?P<test>\S+::.+)$"),
+)
 
 def get_docker_image_name(instance: dict, data_source: str="swe-bench") -> str:
     """Get the image name for a SWEBench instance."""
@@ -42,7 +70,8 @@ def get_docker_image_name(instance: dict, data_source: str="swe-bench") -> str:
     return image_name
 
 def get_sb_environment(config: dict, instance: dict, data_source: str) -> Environment:
-    env_config = config.setdefault("environment", {})
+    # copy, since the config is shared (and may be frozen) between concurrently provisioned environments
+    env_config = thaw(config.get("environment", {}))
     env_config["environment_class"] = env_config.get("environment_class", "apptainer")
     image_name = get_docker_image_name(instance, data_source=data_source)
     if env_config["environment_class"] == "docker":
@@ -56,72 +85,463 @@ def get_sb_environment(config: dict, instance: dict, data_source: str) -> Enviro
             env_config.pop("environment_class")
             env = ApptainerEnvironment(**env_config)
     if startup_command := config.get("run", {}).get("env_startup_command"):
-        startup_command = Template(startup_command, undefined=StrictUndefined).render(**instance)
+        startup_command = get_template(startup_command).render(**instance)
         out = env.execute(startup_command)
         if out["returncode"] != 0:
             raise RuntimeError(f"Error executing startup command: {out}")
     return env
 
-def evaluate_trajectory(
-    instance: Dict[str, Any],
-    model_patch: str,
-    sweagent_config: dict,
-    data_source: str
-) -> MiniSWEEvaluationResult:
+def execute_stream(
+    env: Environment,
+    command: str,
+    cwd: str = "",
+    *,
+    timeout: Optional[int] = None,
+    on_output: Optional[Callable[[str], bool]] = None,
+) -> Dict[str, Any]:
+    """`env.execute` that passes the output to `on_output` as it arrives and kills the command once it returns true.
+
+    Environments that can't stream run the command to completion and pass the output at once.
+    """
+    if isinstance(env, ApptainerEnvironment):
+        return env.execute_stream(command, cwd, timeout=timeout, on_output=on_output)
+    if isinstance(env, DockerEnvironment) and env.container_id:
+        # same command line as `DockerEnvironment.execute`
+        cmd = [env.config.executable, "exec", "-w", cwd or env.config.cwd]
+        for key in env.config.forward_env:
+            if (value := os.getenv(key)) is not None:
+                cmd.extend(["-e", f"{key}={value}"])
+        for key, value in env.config.env.items():
+            cmd.extend(["-e", f"{key}={value}"])
+        cmd.extend([env.container_id, "bash", "-lc", command])
+        return run_streaming(cmd, timeout=timeout or env.config.timeout, on_output=on_output)
+    obs = env.execute(command, cwd, timeout=timeout)
+    if on_output is not None:
+        on_output(obs["output"])
+    return obs | {"stopped": False}
+
+class TestLogMonitor:
+    """Parses the test log between `TEST_OUTPUT_START` and `TEST_OUTPUT_END` line by line while it streams in.
 
-    ret = MiniSWEEvaluationResult(instance_id=instance["instance_id"], resolved=False, eval_error=None)
+    `feed` returns true as soon as one of the `tracked` tests is reported failed or errored, by the log parser
+    or by a pytest progress line. Only single-line reports are recognized, a failure reported in a format
+    spanning several lines is not detected early and the stage runs to the end instead.
+    """
 
-    env = None
+    def __init__(self, log_parser: Callable[[str], Dict[str, str]], tracked: List[str]):
+        self.log_parser = log_parser
+        self.tracked = set(tracked)
+        self.statuses: Dict[str, str] = {}
+        self.failed_test: Optional[str] = None
+        self._partial = ""
+        self._in_output = False
+
+    def feed(self, chunk: str) -> bool:
+        lines = (self._partial + chunk).split("\n")
+        self._partial = lines.pop()
+        for line in lines:
+            if TEST_OUTPUT_START in line:
+                self._in_output = True
+            elif TEST_OUTPUT_END in line:
+                self._in_output = False
+            elif self._in_output and line:
+                statuses = self.log_parser(line)
+                for pattern in _PYTEST_PROGRESS:
+                    if match := pattern.match(line.rstrip()):
+                        statuses[match["test"]] = TestStatus[match["status"]].value
+                for test, status in statuses.items():
+                    self.statuses[test] = status
+                    if self.failed_test is None and test in self.tracked and status in _FAILING:
+                        self.failed_test = test
+        return self.failed_test is not None
+
+def _test_list(instance: Dict[str, Any], key: str) -> List[str]:
+    # SWE-bench stores the lists JSON-encoded, SWE-smith as lists
+    tests = instance.get(key) or []
+    return json.loads(tests) if isinstance(tests, str) else list(tests)
+
+def stage_file(env: Environment, content: str, name: str) -> Optional[str]:
+    """Copy `content` into the container as a file named `name` and return its path there.
+
+    Apptainer environments write it through the host filesystem, docker ones stream it to `docker exec -i`
+    over stdin, so neither passes the content on a command line. Returns `None` for other environments.
+    """
+    if isinstance(env, ApptainerEnvironment):
+        return env.stage_file(content, name)
+    if isinstance(env, DockerEnvironment) and env.container_id:
+        path = f"{DOCKER_STAGING_DIR}/{name}"
+        subprocess.run(
+            [
+                env.config.executable,
+                "exec",
+                "-i",
+                env.container_id,
+                "bash",
+                "-c",
+                f"mkdir -p {DOCKER_STAGING_DIR} && cat > {shlex.quote(path)}",
+            ],
+            input=content.encode(),
+            capture_output=True,
+            timeout=env.config.timeout,
+            check=True,
+        )
+        return path
+    return None
+
+def unstage_file(env: Environment, path: str):
+    """Remove a file created by `stage_file`."""
     try:
-        # env = get_environment(
-        env = get_sb_environment(
-            sweagent_config,
-            instance,
-            data_source
+        if isinstance(env, ApptainerEnvironment):
+            env.unstage_file(path)
+        elif isinstance(env, DockerEnvironment) and env.container_id:
+            subprocess.run(
+                [env.config.executable, "exec", env.container_id, "rm", "-f", path],
+                capture_output=True,
+                timeout=env.config.timeout,
+                check=True,
             )
-    except Exception as e:
-        ret["eval_error"] = f"Env creation failed with {e}"
-        logger.info(f"Starting environment failed with exception: {e}\n, {traceback.format_exc()}")
-        return ret
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning(f"Removing staged file {path} failed: {e}")
 
-    profile = registry[".".join(instance["instance_id"].split(".")[:-1])]()
+@contextmanager
+def _file_command(env: Environment, program: str, content: str, name: str) -> Iterator[str]:
+    """Command that runs `program` on a file with `content`, staged with `stage_file` (and removed on exit)
+    or else as a heredoc."""
+    if (path := stage_file(env, content, f"{uuid.uuid4().hex}-{name}")) is None:
+        # inline, limited by `ARG_MAX`
+        delimiter = f"EOF_{uuid.uuid4().hex}"  # unlikely to collide with symbols in the content
+        yield f"{program} <<'{delimiter}'\n{content}{delimiter}"
+        return
+    try:
+        yield f"{program} {shlex.quote(path)}"
+    finally:
+        unstage_file(env, path)
+
+def _eval_script(test_command: str) -> str:
+    return "\n".join(
+            [
+                "#!/bin/bash",
+                "set -uxo pipefail",
+                f"cd {DOCKER_WORKDIR}",
+                f": '{TEST_OUTPUT_START}'",
+                test_command,
+                f": '{TEST_OUTPUT_END}'",
+            ]
+        ) + "\n\n"
+
+def _eval_command(env: Environment, test_command: str):
+    return _file_command(env, "bash", _eval_script(test_command), "eval.sh")
+
+def _test_stages(instance: Dict[str, Any], profile, eval_mode: str) -> List[Tuple[str, str, List[str]]]:
+    """`(name, test command, tracked tests)` of the test stages of `eval_mode`."""
+    if eval_mode != "staged":
+        return [("full", profile.get_test_cmd(instance)[0], [])]
+    fail_to_pass = _test_list(instance, "FAIL_TO_PASS")
+    stages = []
+    try:
+        stages.append(("fail_to_pass", profile.get_test_cmd(instance, f2p_only=True)[0], fail_to_pass))
+    except TypeError:
+        logger.warning(f"{type(profile).__name__} can't run the FAIL_TO_PASS tests on their own, running all tests")
+    stages.append(("full", profile.get_test_cmd(instance)[0], fail_to_pass + _test_list(instance, "PASS_TO_PASS")))
+    return stages
+
+def _run_tests_staged(env: Environment, instance: Dict[str, Any], profile, cwd: str) -> Dict[str, Dict[str, Any]]:
+    """Run the FAIL_TO_PASS tests first and the full test command only if they pass, each stage stopping at
+    the first failing FAIL_TO_PASS/PASS_TO_PASS test.
+
+    A stage passes only if every tracked test is reported as passed (or xfailed) in the test log, so tests
+    that are never reported, e.g. because of a collection error or because the patch deleted them, count as
+    failed. This is stricter than the `full` mode, which only checks the return code of the eval script.
+    """
+    results = {}
+    for name, test_command, tracked in _test_stages(instance, profile, "staged"):
+        monitor = TestLogMonitor(profile.log_parser, tracked)
+        start = time.monotonic()
+        with _eval_command(env, test_command) as command:
+            obs = execute_stream(env, command, cwd, timeout=EVAL_TIMEOUT, on_output=monitor.feed)
+        failed_test = monitor.failed_test or next((t for t in tracked if monitor.statuses.get(t) not in _PASSING), None)
+        results[name] = {
+            "seconds": time.monotonic() - start,
+            "passed": obs["returncode"] == 0 and failed_test is None,
+            "stopped_early": obs["stopped"],
+            "failed_test": failed_test,
+            "output": obs["output"],
+        }
+        if not results[name]["passed"]:
+            break
+    return results
+
+def get_head_commit(env: Environment, cwd: str) -> Optional[str]:
+    """Commit the sandbox is at, used to reset it before evaluating in the same environment."""
+    out = env.execute("git rev-parse HEAD", cwd=cwd)
+    return out["output"].strip() if out["returncode"] == 0 else None
+
+def _eval_cwd(sweagent_config: dict) -> str:
+    return sweagent_config.get("cwd") or sweagent_config.get("environment", {}).get("cwd") or DOCKER_WORKDIR
+
+def _get_profile(instance: Dict[str, Any]):
+    return registry[".".join(instance["instance_id"].split(".")[:-1])]()
+
+def _evaluate_patch(
+    env: Environment, instance: Dict[str, Any], model_patch: str, profile, cwd: str, eval_mode: str
+) -> MiniSWEEvaluationResult:
+    """Apply `model_patch` on the clean working tree of `env` and run the instance's tests."""
+    ret = MiniSWEEvaluationResult(instance_id=instance["instance_id"], resolved=False, eval_error=None, eval_stages=None)
     f2p_files, p2p_files = profile.get_test_files(instance)
     test_files = " ".join(f2p_files + p2p_files)
     if test_files:
-        env.execute(f"git checkout -- {test_files}", cwd=sweagent_config["cwd"])
+        env.execute(f"git checkout -- {test_files}", cwd=cwd)
 
-    # apply git patch
-    # NOTE (sumanthrh): This applies patch in-line, and the maximum patch size is limited by the OS limits for `ARG_MAX`.
-    # In modern systems, this is typically ~ 1 MB, which is pretty generous.
-    # For simplicity, we assume that large patches greater than `ARG_MAX` are meant to fail
-    delimiter = f"PATCH_{uuid.uuid4().hex}"  # unlikely to collide with symbols in the patch
-    command = f"git apply <<'{delimiter}'\n{model_patch}\n{delimiter}"
-    obs = env.execute(command, cwd=sweagent_config["cwd"])
+    # apply git patch, staged as a file so that its size isn't limited by `ARG_MAX` (except in environments
+    # without `stage_file` support, where it is applied in-line)
+    with ExitStack() as stack:
+        try:
+            command = stack.enter_context(_file_command(env, "git apply", f"{model_patch}\n", "patch.diff"))
+        except (OSError, subprocess.SubprocessError) as e:
+            ret["eval_error"] = f"Staging the patch failed with {e}"
+            return ret
+        obs = env.execute(command, cwd=cwd)
 
     if obs["returncode"] != 0:
         ret["eval_error"] = obs["output"]
+        ret["eval_stages"] = {}
+    elif eval_mode == "staged":
+        stages = _run_tests_staged(env, instance, profile, cwd)
+        ret["resolved"] = all(stage["passed"] for stage in stages.values())
+        if not ret["resolved"]:
+            failed = next(stage for stage in stages.values() if not stage["passed"])
+            note = f"{failed['failed_test']} didn't pass, " if failed["failed_test"] else ""
+            ret["eval_error"] = f"({note}truncated to last 1000 characters)\n{failed['output'][-1000:]}"
+        ret["eval_stages"] = {name: {k: v for k, v in stage.items() if k != "output"} for name, stage in stages.items()}
     else:
         # run eval script in-line
         # eval_script = instance["eval_script"]
-        test_command, _ = profile.get_test_cmd(instance) #, f2p_only=f2p_only)
-        eval_script = "\n".join(
-                [
-                    "#!/bin/bash",
-                    "set -uxo pipefail",
-                    f"cd {DOCKER_WORKDIR}",
-                    f": '{TEST_OUTPUT_START}'",
-                    test_command,
-                    f": '{TEST_OUTPUT_END}'",
-                ]
-            ) + "\n"
-
-        eval_cmd = f"bash <<'EOF'\n{eval_script}\nEOF"
+        test_command, _ = profile.get_test_cmd(instance)
+        start = time.monotonic()
         # add longer timeout for evaluation
-        obs = env.execute(eval_cmd, cwd=sweagent_config["cwd"], timeout=3600)
+        with _eval_command(env, test_command) as command:
+            obs = env.execute(command, cwd=cwd, timeout=EVAL_TIMEOUT)
         # use the return value
         ret["resolved"] = obs["returncode"] == 0
+        ret["eval_stages"] = {"full": {"seconds": time.monotonic() - start, "passed": ret["resolved"]}}
         # truncate to last 1000 characters for brevity
         ret["eval_error"] = (
             f"(truncated to last 1000 characters)\n{obs["output"][-1000:]}" if not ret["resolved"] else None
         )
     return ret
+
+def evaluate_trajectory(
+    instance: Dict[str, Any],
+    model_patch: str,
+    sweagent_config: dict,
+    data_source: str,
+    env: Optional[Environment] = None,
+    base_commit: Optional[str] = None,
+    eval_mode: str = "full",
+) -> MiniSWEEvaluationResult:
+    """Apply `model_patch` and run the instance's tests.
+
+    By default (strict mode) a fresh environment is started and cleaned up afterwards. If the environment of
+    the rollout is passed as `env`, the agent's working tree is stashed, the repo is reset to `base_commit`
+    (defaults to `HEAD`), untracked files are removed, a persistent shell is restarted and the patch is
+    re-applied in the same sandbox, which saves a second container start-up. Ignored files are kept, since the
+    images rely on in-tree build outputs (compiled extensions, `*.egg-info` of editable installs); ignored
+    files the agent created, and changes outside the repo (e.g. installed packages, files in `/tmp` or
+    `$HOME`, running processes) are not undone and can leak into the result, so only reuse the rollout
+    environment when that's acceptable.
+
+    `eval_mode="staged"` runs the FAIL_TO_PASS tests first and stops at the first failing test, which is
+    cheaper for the (many) unresolved patches. `eval_stages` has the timing and outcome of every stage run.
+    """
+    if eval_mode not in EVAL_MODES:
+        raise ValueError(f"Unknown eval_mode: {eval_mode}")
+
+    ret = MiniSWEEvaluationResult(instance_id=instance["instance_id"], resolved=False, eval_error=None, eval_stages=None)
+    cwd = _eval_cwd(sweagent_config)
+
+    if env is None:
+        try:
+            # env = get_environment(
+            env = get_sb_environment(
+                sweagent_config,
+                instance,
+                data_source
+                )
+        except Exception as e:
+            ret["eval_error"] = f"Env creation failed with {e}"
+            logger.info(f"Starting environment failed with exception: {e}\n, {traceback.format_exc()}")
+            return ret
+        try:
+            return _evaluate_patch(env, instance, model_patch, _get_profile(instance), cwd, eval_mode)
+        finally:
+            env.cleanup()
+
+    if isinstance(env, ApptainerEnvironment):
+        # exported variables, activated venvs etc. of the agent's shell session
+        env.reset_shell()
+    obs = env.execute(
+        # the stash keeps the agent's final state around for debugging, `git clean` covers a failed stash
+        f"git stash push --include-untracked --quiet; git reset --hard --quiet {base_commit or 'HEAD'} && git clean -fdq",
+        cwd=cwd,
+    )
+    if obs["returncode"] != 0:
+        ret["eval_error"] = f"Resetting the rollout environment failed with {obs['output']}"
+        return ret
+    return _evaluate_patch(env, instance, model_patch, _get_profile(instance), cwd, eval_mode)
+
+_GROUP_RESET = "git reset --hard --quiet HEAD && git clean -fdq"
+
+def evaluate_patches(
+    instance: Dict[str, Any],
+    model_patches: List[str],
+    sweagent_config: dict,
+    data_source: str,
+    eval_mode: str = "full",
+) -> List[MiniSWEEvaluationResult]:
+    """Evaluate several patches of one instance (e.g. a GRPO group) in a single fresh environment.
+
+    Between patches the repo is reset with `git reset --hard && git clean -fd`, which restores tracked files
+    and removes untracked ones. Ignored files are kept, since the images rely on in-tree build outputs
+    (compiled extensions, `*.egg-info` of editable installs). Ignored files the tests of an earlier patch
+    wrote (`__pycache__`, test caches) and anything they changed outside the repo are not reset, e.g.
+    packages installed into site-packages, files in `/tmp` or `$HOME`, or processes left running, so a result
+    can differ from evaluating the patch alone with `evaluate_trajectory`.
+    """
+    if eval_mode not in EVAL_MODES:
+        raise ValueError(f"Unknown eval_mode: {eval_mode}")
+
+    def error(message: str) -> MiniSWEEvaluationResult:
+        return MiniSWEEvaluationResult(instance_id=instance["instance_id"], resolved=False, eval_error=message, eval_stages=None)
+
+    if not model_patches:
+        return []
+    cwd = _eval_cwd(sweagent_config)
+    try:
+        env = get_sb_environment(sweagent_config, instance, data_source)
+    except Exception as e:
+        logger.info(f"Starting environment failed with exception: {e}\n, {traceback.format_exc()}")
+        return [error(f"Env creation failed with {e}") for _ in model_patches]
+
+    try:
+        profile = _get_profile(instance)
+        results = []
+        for i, model_patch in enumerate(model_patches):
+            if i:
+                obs = env.execute(_GROUP_RESET, cwd=cwd)
+                if obs["returncode"] != 0:
+                    results.append(error(f"Resetting the environment failed with {obs['output']}"))
+                    continue
+            try:
+                results.append(_evaluate_patch(env, instance, model_patch, profile, cwd, eval_mode))
+            except Exception as e:
+                logger.debug(f"Error evaluating patch {i} of {instance['instance_id']}: {e}")
+                results.append(error(str(e)))
+        return results
+    finally:
+        env.cleanup()
+
+def _eval_spec(instance: Dict[str, Any], eval_mode: str, environment: str) -> str:
+    """Hash of everything besides the image and the patch that the verdict depends on: the eval scripts of the
+    test stages, the tracked tests, and the kind of environment (`fresh`, or the shared one of `group` with
+    the reset between patches)."""
+    stages = _test_stages(instance, _get_profile(instance), eval_mode)
+    spec = [eval_mode, environment, [(name, _eval_script(command), tracked) for name, command, tracked in stages]]
+    return hashlib.sha256(json.dumps(spec).encode()).hexdigest()
+
+_UNRESOLVED_IMAGES: set = set()
+
+def _image_digest(instance: Dict[str, Any], data_source: str) -> Optional[str]:
+    """Content digest of the instance's image, `None` if it can't be resolved.
+
+    A tag can be re-pushed with a different environment, so results of images without a digest aren't cached.
+    """
+    image = get_docker_image_name(instance, data_source=data_source)
+    digest = resolve_image_digest(image)
+    if not digest.startswith("ref:"):
+        return digest
+    if image not in _UNRESOLVED_IMAGES:
+        _UNRESOLVED_IMAGES.add(image)
+        logger.warning(f"Could not resolve the digest of {image} (is skopeo installed?), not caching its evaluations")
+    return None
+
+def _eval_cache_key(
+    instance: Dict[str, Any], model_patch: str, data_source: str, eval_mode: str, environment: str
+) -> Optional[str]:
+    if (image_digest := _image_digest(instance, data_source)) is None:
+        return None
+    return EvalCache.key(instance["instance_id"], image_digest, model_patch, _eval_spec(instance, eval_mode, environment))
+
+def evaluate_trajectory_cached(
+    cache: Optional[EvalCache],
+    instance: Dict[str, Any],
+    model_patch: str,
+    sweagent_config: dict,
+    data_source: str,
+    **kwargs,
+) -> Tuple[MiniSWEEvaluationResult, Optional[str]]:
+    """`evaluate_trajectory` through `cache`, returns the result and the cache status (`None` if not cached).
+
+    Only results with a verdict from a fresh environment are cached, not failures to start the environment.
+    Evaluations in the rollout's environment (`env`) bypass the cache, their result depends on what the
+    agent left behind. So do evaluations in images whose digest can't be resolved.
+    """
+    key = None
+    if cache is not None and kwargs.get("env") is None:
+        key = _eval_cache_key(instance, model_patch, data_source, kwargs.get("eval_mode", "full"), "fresh")
+    if key is None:
+        return evaluate_trajectory(instance, model_patch, sweagent_config, data_source, **kwargs), None
+    result, status = cache.get_or_evaluate(  # type: ignore[union-attr]
+        key,
+        lambda: evaluate_trajectory(instance, model_patch, sweagent_config, data_source, **kwargs),
+        cacheable=lambda result: result["eval_stages"] is not None,
+    )
+    return result, status  # type: ignore[return-value]
+
+def evaluate_patches_cached(
+    cache: Optional[EvalCache],
+    instance: Dict[str, Any],
+    model_patches: List[str],
+    sweagent_config: dict,
+    data_source: str,
+    eval_mode: str = "full",
+) -> List[Tuple[MiniSWEEvaluationResult, Optional[str]]]:
+    """`evaluate_patches` of the distinct patches that aren't in `cache`, with the cache status of every patch.
+
+    Patches with the same normalized form are evaluated once, the repeats count as `EvalCache.DEDUP`.
+    Without a cache, or if the image digest can't be resolved, they are deduplicated as well and the status
+    is `None`.
+    """
+    # the image digest and the spec are shared by all patches
+    image_digest = None if cache is None else _image_digest(instance, data_source)
+    if image_digest is None:
+        cache = None
+        keys = [patch_hash(patch) for patch in model_patches]
+    else:
+        # the reset between patches is part of the spec, verdicts cached with a different reset aren't reused
+        spec = _eval_spec(instance, eval_mode, f"group: {_GROUP_RESET}")
+        keys = [EvalCache.key(instance["instance_id"], image_digest, patch, spec) for patch in model_patches]
+    known: Dict[str, Tuple[MiniSWEEvaluationResult, Optional[str]]] = {}
+    pending: Dict[str, str] = {}
+    for key, patch in zip(keys, model_patches):
+        if key in known or key in pending:
+            continue
+        if cache is not None and (result := cache.get(key)) is not None:
+            known[key] = (result, EvalCache.HIT)  # type: ignore[assignment]
+        else:
+            pending[key] = patch
+    results = evaluate_patches(instance, list(pending.values()), sweagent_config, data_source, eval_mode=eval_mode)
+    for key, result in zip(pending, results):
+        # concurrent groups of the same instance may evaluate a patch twice, the last write wins
+        if cache is not None and result["eval_stages"] is not None:
+            cache.put(key, result)
+        known[key] = (result, EvalCache.MISS if cache is not None else None)
+
+    statuses = []
+    first = set()
+    for key in keys:
+        result, status = known[key]
+        if key in first and status is not None:
+            status = EvalCache.DEDUP
+        first.add(key)
+        statuses.append((result, status))
+    return statuses
@@ -1,17 +1,85 @@
 import re
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Function calls look like
+#
+#   <function=name>
+#   <parameter=key>value</parameter>
+#   </function>
+#
+# The parsers below find tags with `str.find`, i.e. a single left-to-right scan. They return the same
+# results as the non-greedy DOTALL regexes `<function=(.*?)>(.*?)</function>` and
+# `<parameter=(.*?)>(.*?)</parameter>` (kept in `parse_action_regex` for reference), which backtrack
+# over the rest of the text for every unclosed tag.
+
+
+def _find_tag(text: str, opening: str, closing: str, start: int = 0) -> Optional[Tuple[int, int, int, int]]:
+    """Find the first `<tag=name>body</tag>` at or after `start`, with `opening="<tag="` and `closing="</tag>"`.
+
+    Returns `(match_start, name_end, body_end, match_end)`, the name is `text[match_start + len(opening) : name_end]`
+    and the body `text[name_end + 1 : body_end]`.
+    """
+    match_start = text.find(opening, start)
+    if match_start < 0:
+        return None
+    name_end = text.find(">", match_start + len(opening))
+    if name_end < 0:
+        return None
+    body_end = text.find(closing, name_end + 1)
+    if body_end < 0:
+        # no later opening tag can be closed either
+        return None
+    return match_start, name_end, body_end, body_end + len(closing)
+
+
+def _parse_parameters(body: str) -> Dict[str, str]:
+    params = {}
+    if "</parameter>" not in body:
+        return params
+    position = 0
+    while (found := _find_tag(body, "<parameter=", "</parameter>", position)) is not None:
+        match_start, name_end, body_end, position = found
+        params[body[match_start + 11 : name_end]] = body[name_end + 1 : body_end].strip()  # len("<parameter=")
+    return params
+
 
 # regex function that captures string between <X= and >
 def parse_string_between_tags(response, tag="function"):
-    pattern = rf"<{tag}=(.*?)>(.*?)</{tag}>"
-    match = re.search(pattern, response, re.DOTALL)
-    if match:
-        return f"<{tag}={match.group(1)}>{match.group(2)}</{tag}>"
-    return None
+    found = _find_tag(response, f"<{tag}=", f"</{tag}>")
+    if found is None:
+        return None
+    match_start, _, _, match_end = found
+    return response[match_start:match_end]
 
 def parse_action(response, string_only=False):
-    function_format = r"<function=(.*?)>(.*?)</function>"
+    if not isinstance(response, str):
+        return None
+    found = _find_tag(response, "<function=", "</function>")
+    if found is None:
+        return None
+    match_start, name_end, body_end, match_end = found
+    if string_only:
+        return response[match_start:match_end]
+    function_name = response[match_start + 10 : name_end]  # len("<function=")
+    return function_name, _parse_parameters(response[name_end + 1 : body_end])
+
+
+def parse_actions(responses: Iterable[str], string_only=False) -> List:
+    """`parse_action` over a whole column (list, pandas Series, pyarrow array, ...)."""
+    if hasattr(responses, "to_pylist"):
+        responses = responses.to_pylist()
+    return [parse_action(response, string_only=string_only) for response in responses]
+
+
+_FUNCTION_RE = re.compile(r"<function=(.*?)>(.*?)</function>", re.DOTALL)
+_PARAMETER_RE = re.compile(r"<parameter=(.*?)>(.*?)</parameter>", re.DOTALL)
+
+
+def parse_action_regex(response, string_only=False):
+    """Regex implementation of `parse_action`, used as the reference in tests and benchmarks."""
     try:
-        function_matched = re.search(function_format, response, re.DOTALL)
+        function_matched = _FUNCTION_RE.search(response)
     except Exception as e:
         return None
 
@@ -21,19 +89,186 @@ def parse_action(response, string_only=False):
 
         function_name = function_matched.group(1)
         function_param_string = function_matched.group(2).strip()
-        
-        param_format = r"<parameter=(.*?)>(.*?)</parameter>"
-        param_matched = re.findall(param_format, function_param_string, re.DOTALL)
-        if param_matched:
-            params = {name: value.strip() for name, value in param_matched}
-        else:
-            params = {}
-        
-        return function_name, params
+        param_matched = _PARAMETER_RE.findall(function_param_string)
+        return function_name, {name: value.strip() for name, value in param_matched}
     else:
         return None
 
+
+@dataclass
+class ParameterEvent:
+    name: str
+    value: str
+
+
+@dataclass
+class FunctionEvent:
+    name: str
+    params: Dict[str, str] = field(default_factory=dict)
+    text: str = ""
+    """The complete `<function=...>...</function>` string."""
+
+
+class StreamingActionParser:
+    """Incremental `parse_action` for model output that arrives in chunks.
+
+    `feed` returns a `ParameterEvent` as soon as a `</parameter>` arrives and a `FunctionEvent` once the
+    first function call is closed, after which `done` is set and further input is ignored. Searches resume
+    where the previous one gave up, so the whole stream is scanned in linear time however it is chunked.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.done = False
+        self.end = -1
+        """Index in `buffer` right after the closed function call."""
+        self.function: Optional[FunctionEvent] = None
+        self._state = "function"
+        self._position = 0
+        self._cursors: Dict[str, int] = {}
+        self._function_start = -1
+        self._name_end = -1
+        self._parameter_start = -1
+        self._parameter_name_end = -1
+        self._params: Dict[str, str] = {}
+
+    def _find(self, pattern: str, start: int) -> int:
+        # each pattern is searched from non-decreasing starts, so a failed search never has to be repeated
+        start = max(start, self._cursors.get(pattern, 0))
+        index = self.buffer.find(pattern, start)
+        if index < 0:
+            # the pattern may still complete with the next chunk
+            self._cursors[pattern] = max(start, len(self.buffer) - len(pattern) + 1)
+        return index
+
+    def _finish(self, function_end: int) -> FunctionEvent:
+        self.end = function_end + len("</function>")
+        self.function = FunctionEvent(
+            name=self.buffer[self._function_start + len("<function=") : self._name_end],
+            # re-parsed from the body to match `parse_action` exactly, e.g. for a parameter left open
+            params=_parse_parameters(self.buffer[self._name_end + 1 : function_end]),
+            text=self.buffer[self._function_start : function_end + len("</function>")],
+        )
+        self.done = True
+        return self.function
+
+    def feed(self, chunk: str) -> List[ParameterEvent | FunctionEvent]:
+        if self.done:
+            return []
+        self.buffer += chunk
+        events = []
+        while not self.done:
+            if self._state == "function":
+                self._function_start = self._find("<function=", self._position)
+                if self._function_start < 0:
+                    break
+                self._position = self._function_start + len("<function=")
+                self._state = "function_name"
+                continue
+            if self._state == "function_name":
+                self._name_end = self._find(">", self._position)
+                if self._name_end < 0:
+                    break
+                self._position = self._name_end + 1
+                self._state = "body"
+                continue
+
+            # the body ends at the first `</function>`, parameters only count if they are closed before it
+            function_end = self._find("</function>", self._name_end + 1)
+            if self._state == "body":
+                tag = self._find("<parameter=", self._position)
+            elif self._state == "parameter_name":
+                tag = self._find(">", self._position)
+            else:
+                tag = self._find("</parameter>", self._position)
+            if tag >= 0 and (function_end < 0 or tag < function_end):
+                if self._state == "body":
+                    self._parameter_start = tag
+                    self._position = tag + len("<parameter=")
+                    self._state = "parameter_name"
+                elif self._state == "parameter_name":
+                    self._parameter_name_end = tag
+                    self._position = tag + 1
+                    self._state = "parameter_value"
+                else:
+                    event = ParameterEvent(
+                        self.buffer[self._parameter_start + len("<parameter=") : self._parameter_name_end],
+                        self.buffer[self._parameter_name_end + 1 : tag].strip(),
+                    )
+                    self._params[event.name] = event.value
+                    events.append(event)
+                    self._position = tag + len("</parameter>")
+                    self._state = "body"
+            elif function_end >= 0:
+                events.append(self._finish(function_end))
+            else:
+                break
+        return events
+
+
+@dataclass
+class BashBlockEvent:
+    command: str
+
+
+class StreamingBashBlockParser:
+    """Streaming counterpart of mini-swe-agent's bash action format: sets `done` once the first
+    ```` ```bash ... ``` ```` block is closed, with the same pattern as `DefaultAgent.parse_action`.
+
+    The regex only runs when a new closing fence candidate arrives.
+    """
+
+    pattern = re.compile(r"```bash\s*\n(.*?)\n```", re.DOTALL)
+
+    def __init__(self):
+        self.buffer = ""
+        self.done = False
+        self.end = -1
+        """Index in `buffer` right after the closing fence."""
+        self._start = -1
+        self._cursor = 0
+
+    def _is_final(self, match: re.Match) -> bool:
+        # `\s*\n` is greedy: if the command starts before the last newline of the whitespace after the
+        # opening fence, more text can still make the regex prefer a longer header
+        header = match.start() + len("```bash")
+        run_end = header
+        while run_end < len(self.buffer) and self.buffer[run_end].isspace():
+            run_end += 1
+        return match.start(1) == self.buffer.rfind("\n", header, run_end) + 1
+
+    def feed(self, chunk: str) -> List[BashBlockEvent]:
+        if self.done:
+            return []
+        self.buffer += chunk
+        if self._start < 0:
+            self._start = self.buffer.find("```bash", self._cursor)
+            if self._start < 0:
+                self._cursor = max(len(self.buffer) - len("```bash") + 1, 0)
+                return []
+            self._cursor = self._start + len("```bash")
+        while (fence := self.buffer.find("\n```", self._cursor)) >= 0:
+            self._cursor = fence + 1
+            # an earlier opening fence can't match later, its header can't change once followed by more text
+            match = self.pattern.search(self.buffer, self._start)
+            if match is not None and self._is_final(match):
+                self.done = True
+                self.end = match.end()
+                return [BashBlockEvent(match.group(1).strip())]
+        self._cursor = max(len(self.buffer) - len("\n```") + 1, self._cursor)
+        return []
+
+
 if __name__ == "__main__":
+    import argparse
+    import timeit
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", action="store_true", help="Compare against the regex parser on SWE-smith responses")
+    parser.add_argument("--data_path", default="neulab/agent-data-collection")
+    parser.add_argument("--data_name", default="SWE-smith_5kTrajectories")
+    parser.add_argument("--max_trajectories", type=int, default=500)
+    args = parser.parse_args()
 
     ## Example of model response
     response = """
@@ -47,4 +282,23 @@ if __name__ == "__main__":
 
     function, params = parse_action(response)
     print(f"Function: {function}")
-    print(f"Parameters: {params}")
\ No newline at end of file
+    print(f"Parameters: {params}")
+
+    if args.benchmark:
+        from datasets import load_dataset
+
+        dataset = load_dataset(args.data_path, args.data_name, split="train")
+        responses = [
+            step["value"]
+            for row in dataset.select(range(min(args.max_trajectories, len(dataset))))
+            for step in row["conversations"]
+            if step["from"] == "gpt"
+        ]
+        assert parse_actions(responses) == [parse_action_regex(r) for r in responses]
+        for name, fn in (("regex", parse_action_regex), ("scanner", parse_action)):
+            seconds = timeit.timeit(lambda: [fn(r) for r in responses], number=3) / 3
+            print(f"{name}: {seconds * 1e6 / len(responses):.2f} us per response ({len(responses)} responses)")
+        # an unclosed tag in a long response, e.g. a truncated generation
+        truncated = "<function=bash>" + "<parameter=command>" * 2000 + "x" * 100_000
+        for name, fn in (("regex", parse_action_regex), ("scanner", parse_action)):
+            print(f"{name}, truncated response: {timeit.timeit(lambda: fn(truncated), number=3) / 3 * 1e3:.2f} ms")
@@ -0,0 +1,115 @@
+import json
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator
+
+from rca.utils.locking import file_lock
+
+
+class PredictionsStore:
+    """Append-only predictions backend for `preds.json`.
+
+    Every update/removal is appended as a single JSON line to `preds.jsonl` next to `preds.json`.
+    The log is periodically folded into `preds.json` (`compact`), which is written to a temporary
+    file and atomically renamed, so a killed run leaves either the old or the new file in place.
+    A torn trailing line in the log (e.g. from a SIGKILL mid-write) is ignored on replay.
+
+    Appends and compaction are serialized with a `flock` on `preds.lock`, so several
+    processes can share one output directory.
+    """
+
+    def __init__(self, output_path: Path, *, compact_every: int = 500):
+        self.output_path = Path(output_path)
+        self.log_path = self.output_path.with_suffix(".jsonl")
+        self.lock_path = self.output_path.with_suffix(".lock")
+        # `0` disables automatic compaction (e.g. for worker processes that share the store)
+        self.compact_every = compact_every
+        self._thread_lock = threading.Lock()
+        self._n_appended = 0
+
+    @contextmanager
+    def _locked(self):
+        with self._thread_lock, file_lock(self.lock_path):
+            yield
+
+    def _append(self, record: dict):
+        line = (json.dumps(record) + "\n").encode("utf-8")
+        with self._locked():
+            # one `write` per record on an O_APPEND fd, so concurrent writers never interleave
+            fd = os.open(self.log_path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                size = os.fstat(fd).st_size
+                if size and os.pread(fd, 1, size - 1) != b"\n":
+                    # terminate a torn line left by a killed run so it doesn't swallow this record
+                    line = b"\n" + line
+                os.write(fd, line)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self._n_appended += 1
+            should_compact = self.compact_every > 0 and self._n_appended >= self.compact_every
+        if should_compact:
+            self.compact()
+
+    def update(self, instance_id: str, model_name: str, result: str):
+        """Record the prediction for a single instance."""
+        self._append(
+            {
+                "model_name_or_path": model_name,
+                "instance_id": instance_id,
+                "model_patch": result,
+            }
+        )
+
+    def remove(self, instance_id: str):
+        """Remove an instance from the predictions (appends a tombstone)."""
+        self._append({"instance_id": instance_id, "deleted": True})
+
+    def _iter_log(self) -> Iterator[dict]:
+        if not self.log_path.exists():
+            return
+        with open(self.log_path, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # partial write from an interrupted run, the record was never acknowledged
+                    continue
+                if isinstance(record, dict) and "instance_id" in record:
+                    yield record
+
+    def _load(self) -> Dict[str, dict]:
+        output_data = {}
+        if self.output_path.exists():
+            output_data = json.loads(self.output_path.read_text())
+        for record in self._iter_log():
+            if record.get("deleted"):
+                output_data.pop(record["instance_id"], None)
+            else:
+                output_data[record["instance_id"]] = record
+        return output_data
+
+    def load(self) -> Dict[str, dict]:
+        """Return the current predictions, i.e. `preds.json` with the log replayed on top."""
+        with self._locked():
+            return self._load()
+
+    def instance_ids(self) -> set[str]:
+        """Ids of all instances that currently have a prediction."""
+        return set(self.load())
+
+    def compact(self):
+        """Fold the log into `preds.json` and truncate the log."""
+        with self._locked():
+            output_data = self._load()
+            tmp_path = self.output_path.with_name(f".{self.output_path.name}.tmp")
+            with open(tmp_path, "w") as f:
+                f.write(json.dumps(output_data, indent=2))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.output_path)
+            # a crash before this point is harmless, replaying the log again is idempotent
+            self.log_path.unlink(missing_ok=True)
+            self._n_appended = 0
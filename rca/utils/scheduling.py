@@ -0,0 +1,188 @@
+import json
+import multiprocessing.context
+import statistics
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Mapping
+
+from loguru import logger
+
+# indices into `InstanceScheduler._usage`
+_COST, _RUNNING, _CONTAINERS = range(3)
+
+
+@dataclass
+class InstanceEstimate:
+    wall_time: float
+    """Seconds, 0 if unknown (trajectories written before `wall_time` was recorded)."""
+    steps: float
+    cost: float
+
+
+def get_repo(instance_id: str) -> str:
+    # `django__django-11099` -> `django__django`, `owner__repo.commit.func_pm_xyz__abc` -> `owner__repo.commit`
+    return instance_id.rsplit("-", 1)[0].split(".func_", 1)[0]
+
+
+def load_history(paths: Iterable[str | Path]) -> dict[str, InstanceEstimate]:
+    """Per-instance wall time, step count and cost of earlier runs, from the `*.traj.json` files under `paths`.
+
+    Runs that ended with an uncaught exception are skipped, they say little about how long an instance takes.
+    If an instance was run several times, the most recent trajectory wins.
+    """
+    history: dict[str, tuple[float, InstanceEstimate]] = {}
+    for root in map(Path, paths):
+        for path in root.rglob("*.traj.json"):
+            try:
+                info = json.loads(path.read_text())["info"]
+                mtime = path.stat().st_mtime
+            except (OSError, ValueError, KeyError):
+                continue
+            if str(info.get("exit_status")).startswith("Uncaught") or "traceback" in info:
+                continue
+            instance_id = path.name.removesuffix(".traj.json")
+            if instance_id in history and history[instance_id][0] >= mtime:
+                continue
+            stats = info.get("model_stats", {})
+            history[instance_id] = (
+                mtime,
+                InstanceEstimate(
+                    wall_time=float(info.get("wall_time", 0.0)),
+                    steps=float(stats.get("api_calls", 0)),
+                    cost=float(stats.get("instance_cost", 0.0)),
+                ),
+            )
+    return {instance_id: estimate for instance_id, (_, estimate) in history.items()}
+
+
+class InstanceScheduler:
+    """Orders instances longest-first and enforces budgets on concurrently running instances.
+
+    Instances are estimated from `history` (see `load_history`), falling back to the mean of their repository
+    and then of all instances. Longest-first ordering keeps the long instances from ending up at the tail of a
+    run, where the other workers would idle waiting for them.
+
+    - `max_concurrent_cost`: the estimated cost of the running instances may not exceed this (0 for no limit),
+      an instance over the budget on its own runs alone
+    - `max_containers`: at most this many environments exist at once, including those provisioned ahead of
+      the workers (0 for no limit)
+
+    The budgets apply to the threads of one process, or to several worker processes with `share`.
+    """
+
+    def __init__(self, history: Mapping[str, InstanceEstimate], *, max_concurrent_cost: float = 0.0, max_containers: int = 0):
+        self.history = dict(history)
+        self.max_concurrent_cost = max_concurrent_cost
+        self.max_containers = max_containers
+        by_repo: dict[str, list[InstanceEstimate]] = {}
+        for instance_id, estimate in self.history.items():
+            by_repo.setdefault(get_repo(instance_id), []).append(estimate)
+        self._repo_means = {repo: self._mean(estimates) for repo, estimates in by_repo.items()}
+        self._global_mean = self._mean(list(self.history.values()))
+        self._condition = threading.Condition()
+        # cost and number of the running instances, number of containers
+        self._usage: list[float] = [0.0, 0, 0]
+        # cost of each instance started in this process
+        self._running: dict[str, float] = {}
+        self._shared = False
+
+    def __getstate__(self):
+        state = {"history": self.history, "max_concurrent_cost": self.max_concurrent_cost, "max_containers": self.max_containers}
+        if self._shared:
+            # can only be pickled to start a process
+            state |= {"_condition": self._condition, "_usage": self._usage}
+        # otherwise the budgets are per process, a copy starts with nothing running
+        return state
+
+    def __setstate__(self, state):
+        shared = {key: state.pop(key) for key in ("_condition", "_usage") if key in state}
+        self.__init__(state.pop("history"), **state)
+        if shared:
+            self._condition, self._usage = shared["_condition"], shared["_usage"]
+            self._shared = True
+
+    def share(self, context: multiprocessing.context.BaseContext) -> "InstanceScheduler":
+        """A scheduler with the same budgets, shared by the worker processes of `context` it is passed to as an
+        argument. Nothing may be running on this one."""
+        if self._running or any(self._usage):
+            raise RuntimeError("Can't share a scheduler with running instances")
+        shared = InstanceScheduler(
+            self.history, max_concurrent_cost=self.max_concurrent_cost, max_containers=self.max_containers
+        )
+        shared._condition = context.Condition()
+        shared._usage = context.Array("d", 3, lock=False)  # guarded by `_condition`
+        shared._shared = True
+        return shared
+
+    def pool_depth(self, depth: int, workers: int) -> int:
+        """The largest number of environments up to `depth` that `workers` can provision ahead of them.
+
+        Provisioning for an instance blocks while `max_containers` are in use. If environments provisioned ahead
+        held slots that running workers need, the workers would wait for environments that wait for them.
+        """
+        if self.max_containers <= 0 or depth <= self.max_containers - workers:
+            return depth
+        fitting = max(self.max_containers - workers, 0)
+        logger.warning(
+            f"Provisioning {fitting} instead of {depth} environments ahead, {workers} workers and the environments "
+            f"ahead of them must fit into {self.max_containers} containers"
+        )
+        return fitting
+
+    @staticmethod
+    def _mean(estimates: list[InstanceEstimate]) -> InstanceEstimate:
+        if not estimates:
+            return InstanceEstimate(wall_time=0.0, steps=0.0, cost=0.0)
+        timed = [e.wall_time for e in estimates if e.wall_time > 0]
+        return InstanceEstimate(
+            wall_time=statistics.fmean(timed) if timed else 0.0,
+            steps=statistics.fmean(e.steps for e in estimates),
+            cost=statistics.fmean(e.cost for e in estimates),
+        )
+
+    def estimate(self, instance_id: str) -> InstanceEstimate:
+        if instance_id in self.history:
+            return self.history[instance_id]
+        return self._repo_means.get(get_repo(instance_id), self._global_mean)
+
+    def order(self, instances: list[Mapping]) -> list[Mapping]:
+        """Longest-first by wall time, then step count (for history without wall times); stable otherwise."""
+        known = sum(instance["instance_id"] in self.history for instance in instances)
+        logger.info(f"Scheduling {len(instances)} instances longest-first, {known} with history")
+
+        def key(instance: Mapping) -> tuple[float, float]:
+            estimate = self.estimate(instance["instance_id"])
+            return (-estimate.wall_time, -estimate.steps)
+
+        return sorted(instances, key=key)
+
+    def start_instance(self, instance_id: str):
+        """Block until the instance's estimated cost fits into the concurrent cost budget."""
+        cost = self.estimate(instance_id).cost
+        with self._condition:
+            if self.max_concurrent_cost > 0:
+                self._condition.wait_for(
+                    lambda: not self._usage[_RUNNING] or self._usage[_COST] + cost <= self.max_concurrent_cost
+                )
+            self._running[instance_id] = cost
+            self._usage[_COST] += cost
+            self._usage[_RUNNING] += 1
+
+    def end_instance(self, instance_id: str):
+        with self._condition:
+            if instance_id in self._running:
+                self._usage[_COST] -= self._running.pop(instance_id)
+                self._usage[_RUNNING] -= 1
+            self._condition.notify_all()
+
+    def acquire_container(self):
+        with self._condition:
+            if self.max_containers > 0:
+                self._condition.wait_for(lambda: self._usage[_CONTAINERS] < self.max_containers)
+            self._usage[_CONTAINERS] += 1
+
+    def release_container(self):
+        with self._condition:
+            self._usage[_CONTAINERS] -= 1
+            self._condition.notify_all()
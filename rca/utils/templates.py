@@ -0,0 +1,73 @@
+from dataclasses import asdict
+from functools import lru_cache
+from typing import Any
+
+from jinja2 import StrictUndefined, Template
+
+# per-call template variables of mini-swe-agent models, `template variable -> model attribute`
+_DYNAMIC_MODEL_VARS = {"n_model_calls": "n_calls", "model_cost": "cost"}
+
+
+@lru_cache(maxsize=256)
+def get_template(source: str) -> Template:
+    """Compiled jinja2 template for `source`, cached per process."""
+    return Template(source, undefined=StrictUndefined)
+
+
+class CachedTemplateRenderer:
+    """Mixin for mini-swe-agent agents that replaces `render_template` with a cached version.
+
+    `DefaultAgent.render_template` compiles the template and rebuilds `asdict(agent config) | env vars |
+    model vars` on every call, i.e. several times per step. Here templates come from `get_template` and
+    that context is built once and reused until the agent's, environment's or model's config object is
+    replaced. Only the model's call counter and cost are looked up per call. Call
+    `invalidate_template_context` after modifying one of the configs in place.
+
+    `template_model_attr` names the attribute holding the model whose variables are used.
+    """
+
+    template_model_attr = "model"
+
+    def invalidate_template_context(self):
+        self.__dict__.pop("_template_context", None)
+
+    def get_template_context(self) -> dict[str, Any]:
+        model = getattr(self, self.template_model_attr)
+        key = (id(self.config), id(self.env.config), id(model.config))
+        cached = self.__dict__.get("_template_context")
+        if cached is None or cached[0] != key:
+            model_vars = {k: v for k, v in model.get_template_vars().items() if k not in _DYNAMIC_MODEL_VARS}
+            cached = (key, asdict(self.config) | self.env.get_template_vars() | model_vars)
+            self._template_context = cached
+        context = cached[1]
+        dynamic = {var: getattr(model, attr) for var, attr in _DYNAMIC_MODEL_VARS.items() if hasattr(model, attr)}
+        return context | dynamic if dynamic else context
+
+    def render_template(self, template: str, **kwargs) -> str:
+        return get_template(template).render(**kwargs, **self.get_template_context(), **self.extra_template_vars)
+
+
+if __name__ == "__main__":
+    ## Micro-benchmark: cost of rendering the observation template once per agent step
+    import timeit
+
+    import yaml
+
+    from minisweagent.agents.default import DefaultAgent
+    from minisweagent.config import get_config_path
+    from minisweagent.environments.local import LocalEnvironment
+    from minisweagent.models.test_models import DeterministicModel
+
+    class CachedAgent(CachedTemplateRenderer, DefaultAgent):
+        pass
+
+    agent_config = yaml.safe_load(get_config_path("config_yaml/swebench.yaml").read_text())["agent"]
+    output = {"returncode": 0, "output": "x" * 2000}
+    number = 2000
+    for agent_class in (DefaultAgent, CachedAgent):
+        agent = agent_class(DeterministicModel(outputs=[]), LocalEnvironment(), **agent_config)
+        agent.extra_template_vars = {"task": "Fix the bug"}
+        seconds = timeit.timeit(
+            lambda: agent.render_template(agent.config.action_observation_template, output=output), number=number
+        )
+        print(f"{agent_class.__name__}: {seconds / number * 1e6:.1f} us per render")
@@ -68,6 +68,7 @@ uv run --isolated --extra vllm --extra miniswe --env-file examples/mini_swe_agen
   trainer.run_name="mini_swe_32B_swe_gym" \
   trainer.resume_mode=null \
   trainer.ckpt_path="$CKPT_PATH" \
+  +generator.miniswe_instance_tables="['$DATA_DIR/train_instances.parquet','$DATA_DIR/validation_instances.parquet']" \
   +generator.miniswe_config_path="examples/mini_swe_agent/swebench.yaml" \
   +generator.miniswe_traj_dir=$MINISWE_TRAJ_DIR
   $@
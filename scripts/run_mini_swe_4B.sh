@@ -99,6 +99,7 @@ uv run \
         trainer.run_name=$RUN_NAME" \
         trainer.resume_mode=null \
         trainer.ckpt_path="$CKPT_PATH" \
+        +generator.miniswe_instance_tables="['$DATA_PATH/train_instances.parquet','$DATA_PATH/validation_instances.parquet']" \
         +generator.miniswe_config_path="examples/mini_swe_agent/swebench.yaml" \
         +generator.miniswe_traj_dir=$MINISWE_TRAJ_DIR
         $@
@@ -0,0 +1,125 @@
+import os
+import shlex
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from rca.environments.apptainer_env import ApptainerEnvironment, ApptainerEnvironmentConfig
+from rca.environments.streaming import BoundedOutput
+
+
+class LocalApptainerEnvironment(ApptainerEnvironment):
+    """Runs commands with the host's bash instead of in a container, staging into a host directory."""
+
+    def __init__(self, root: Path, **kwargs):
+        self.config = ApptainerEnvironmentConfig(image="unused", staging_dir=str(root / "staging"), **kwargs)
+        self.sandbox_dir = root
+        self.image_path = None
+        self.image_cache = None
+        self.instance_name = None
+        self._shell = None
+
+    def _staging_host_dir(self) -> Path:
+        return Path(self.config.staging_dir)
+
+    def _exec_cmd(self, command: str, cwd: str = "", *, target: list[str] | None = None) -> list[str]:
+        return ["bash", "-c", f"cd {shlex.quote(cwd or self.config.cwd)} && {command}"]
+
+    def _start_shell(self):
+        self._shell = subprocess.Popen(
+            ["bash", "--noprofile", "--norc"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            bufsize=0,
+            start_new_session=True,
+        )
+
+    def cleanup(self):
+        self._kill_shell()
+
+
+def test_staged_patch_larger_than_arg_max(tmp_path):
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    git = ["git", "-c", "user.email=a@b", "-c", "user.name=a"]
+    subprocess.run([*git, "init", "-q"], cwd=repo, check=True)
+    (repo / "a.txt").write_text("a\n")
+    subprocess.run([*git, "add", "."], cwd=repo, check=True)
+    subprocess.run([*git, "commit", "-qm", "init"], cwd=repo, check=True)
+    content = "".join(f"line {i}\n" for i in range(os.sysconf("SC_ARG_MAX") // 8))
+    (repo / "big.txt").write_text(content)
+    subprocess.run([*git, "add", "big.txt"], cwd=repo, check=True)
+    patch = subprocess.run([*git, "diff", "--cached"], cwd=repo, check=True, capture_output=True, text=True).stdout
+    subprocess.run([*git, "rm", "-q", "--cached", "big.txt"], cwd=repo, check=True)
+    (repo / "big.txt").unlink()
+    assert len(patch) > os.sysconf("SC_ARG_MAX")
+
+    for persistent_shell in (False, True):
+        env = LocalApptainerEnvironment(tmp_path, cwd=str(repo), persistent_shell=persistent_shell)
+        path = env.stage_file(patch, "patch.diff")
+        obs = env.execute(f"git apply {shlex.quote(path)}")
+        assert obs["returncode"] == 0, obs["output"]
+        assert (repo / "big.txt").read_text() == content
+        env.unstage_file(path)
+        assert list(env._staging_host_dir().iterdir()) == []
+        (repo / "big.txt").unlink()
+        env.cleanup()
+
+
+def test_bounded_output():
+    output = BoundedOutput(4, 3)
+    for chunk in (b"ab", b"cdefgh", b"ij" * 50, b"xyz"):
+        output.feed(chunk)
+    assert output.total_bytes == 111
+    assert output.getvalue() == b"abcd\n<output elided: 104 of 111 bytes>\nxyz"
+
+    short = BoundedOutput(4, 3)
+    short.feed(b"abcdefg")
+    assert short.getvalue() == b"abcdefg"
+
+    # output starting with `keep_prefix` is kept whole, even if the prefix arrives in pieces
+    kept = BoundedOutput(8, 0, keep_prefix=b"SUBMIT")
+    for chunk in (b"\n SU", b"BMIT\n", b"x" * 100):
+        kept.feed(chunk)
+    assert kept.getvalue() == b"\n SUBMIT\n" + b"x" * 100
+    other = BoundedOutput(8, 0, keep_prefix=b"SUBMIT")
+    other.feed(b"SUBMARINE" + b"x" * 100)
+    assert other.getvalue().startswith(b"SUBMARIN\n<output elided: 101 of 109 bytes>")
+
+
+@pytest.mark.parametrize("persistent_shell", [False, True])
+def test_execute_bounds_output_except_submission(tmp_path, persistent_shell):
+    env = LocalApptainerEnvironment(
+        tmp_path, cwd=str(tmp_path), persistent_shell=persistent_shell, output_head_bytes=16, output_tail_bytes=16
+    )
+    obs = env.execute("seq 100000; exit 3")
+    assert obs["returncode"] == 3
+    assert obs["output_bytes"] == len("".join(f"{i}\n" for i in range(1, 100001)))
+    assert obs["output"].startswith("1\n2\n3\n") and obs["output"].endswith("99999\n100000\n")
+    assert "<output elided:" in obs["output"]
+
+    patch = "".join(f"+line {i}\n" for i in range(1000))
+    (tmp_path / "patch.diff").write_text(patch)
+    obs = env.execute("echo COMPLETE_TASK_AND_SUBMIT_FINAL_OUTPUT && cat patch.diff")
+    assert obs["output"] == "COMPLETE_TASK_AND_SUBMIT_FINAL_OUTPUT\n" + patch
+    env.cleanup()
+
+
+def test_shell_output_around_sentinel(tmp_path):
+    env = LocalApptainerEnvironment(tmp_path, cwd=str(tmp_path), persistent_shell=True)
+    # output that looks like the start of the sentinel line, without a trailing newline, is the command's own
+    obs = env.execute("printf 'abc\\n__RCA_CMD_DONE_'")
+    assert obs == {"output": "abc\n__RCA_CMD_DONE_", "returncode": 0, "output_bytes": 19}
+    obs = env.execute("printf '\\n__RCA_CMD_DONE_0123__ 7\\n'; false")
+    assert obs["output"] == "\n__RCA_CMD_DONE_0123__ 7\n" and obs["returncode"] == 1
+    # state persists between commands, a command that exits the shell ends it
+    env.execute("export RCA_TEST=1")
+    assert env.execute("echo $RCA_TEST")["output"] == "1\n"
+    assert env.execute("exit 5")["returncode"] == 5
+    assert env.execute("echo ${RCA_TEST:-unset}")["output"] == "unset\n"
+    with pytest.raises(subprocess.TimeoutExpired):
+        env.execute("echo started; sleep 10", timeout=1)
+    assert env.execute("echo recovered")["output"] == "recovered\n"
+    env.cleanup()
@@ -0,0 +1,45 @@
+from minisweagent.environments.local import LocalEnvironment
+from minisweagent.models.test_models import DeterministicModel
+
+from rca.agents.early_stop_agent import EarlyStopAgent
+
+AGENT_CONFIG = {
+    "system_template": "system",
+    "instance_template": "{{task}}",
+    "action_observation_template": "{{output.output}}",
+    "format_error_template": "format error",
+    "step_limit": 0,
+    "cost_limit": 0,
+}
+
+
+class StreamingModel(DeterministicModel):
+    """Feeds its outputs to the `action_parser` in small chunks, like `EarlyStopLitellmModel`."""
+
+    def query(self, messages, action_parser=None, **kwargs):
+        response = super().query(messages, **kwargs)
+        if action_parser is not None:
+            content = response["content"]
+            for i in range(0, len(content), 3):
+                action_parser.feed(content[i : i + 3])
+                if action_parser.done:
+                    response["content"] = content[: action_parser.end]
+                    break
+        return response
+
+
+def test_function_format_stops_after_first_call():
+    submit = "<function=bash>\n<parameter=command>echo COMPLETE_TASK_AND_SUBMIT_FINAL_OUTPUT</parameter>\n</function>"
+    outputs = [
+        "<function=str_replace_editor>\n<parameter=command>view</parameter>\n</function>",
+        "```bash\nls\n```",
+        f"{submit}\n<function=bash>\n<parameter=command>rm -rf /</parameter>\n</function>",
+    ]
+    agent = EarlyStopAgent(
+        StreamingModel(outputs=outputs, cost_per_call=0.0), LocalEnvironment(), **AGENT_CONFIG, action_format="function"
+    )
+    assert agent.run("Fix the bug")[0] == "Submitted"
+    assistant = [m["content"] for m in agent.messages if m["role"] == "assistant"]
+    assert assistant == outputs[:2] + [submit]
+    # only functions of `bash_functions` are executed
+    assert [m["content"] for m in agent.messages[3:6:2]] == ["format error", "format error"]
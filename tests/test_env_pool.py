@@ -0,0 +1,100 @@
+import threading
+import time
+
+import pytest
+
+from rca.environments.pool import EnvironmentPool
+from rca.utils.scheduling import InstanceScheduler
+
+
+class FakeEnvironment:
+    def __init__(self, instance_id):
+        self.instance_id = instance_id
+        self.cleaned_up = False
+
+    def cleanup(self):
+        self.cleaned_up = True
+
+
+def test_pool_provisions_ahead_of_workers():
+    provisioned = []
+    release = threading.Event()
+
+    def factory(instance):
+        if instance["instance_id"] == "slow":
+            release.wait(timeout=5)
+        if instance["instance_id"] == "broken":
+            raise RuntimeError("image not found")
+        env = FakeEnvironment(instance["instance_id"])
+        provisioned.append(env)
+        return env
+
+    released = []
+    pool = EnvironmentPool(factory, depth=2, release=released.append)
+    pool.schedule([{"instance_id": i} for i in ("a", "slow", "broken", "unused")])
+    first = pool.acquire({"instance_id": "a"})
+    assert first.instance_id == "a"
+    # "broken" took the slot freed by "a"; its error is raised in the worker that asks for it
+    with pytest.raises(RuntimeError, match="image not found"):
+        pool.acquire({"instance_id": "broken"})
+    threading.Timer(0.1, release.set).start()
+    assert pool.acquire({"instance_id": "slow"}).instance_id == "slow"
+    assert pool.acquire({"instance_id": "never-scheduled"}).instance_id == "never-scheduled"
+
+    stats = pool.take_stats()
+    assert stats.partial_hits >= 1 and stats.misses == 1
+    assert stats.hits + stats.partial_hits == 3
+    assert pool.take_stats().as_dict()["hit_rate"] == 0.0
+
+    # the environment provisioned for "unused" is cleaned up, acquired ones are left to their workers
+    deadline = time.monotonic() + 5
+    while len(provisioned) < 4 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    pool.close()
+    assert [env.instance_id for env in provisioned if env.cleaned_up] == ["unused"]
+    assert [env.instance_id for env in released] == ["unused"]
+    assert not first.cleaned_up
+
+
+@pytest.mark.parametrize("max_containers", [2, 4])
+def test_pool_within_container_budget(max_containers):
+    # mirrors `run_instances`: the factory takes a container slot, the worker gives it back when the instance ends
+    scheduler = InstanceScheduler({}, max_containers=max_containers)
+    in_use = []
+
+    def factory(instance):
+        scheduler.acquire_container()
+        in_use.append(scheduler._usage[2])
+        time.sleep(0.001)
+        return FakeEnvironment(instance["instance_id"])
+
+    pool = EnvironmentPool(factory, depth=scheduler.pool_depth(4, 2), release=lambda env: scheduler.release_container())
+    instances = [{"instance_id": str(i)} for i in range(30)]
+    pool.schedule(instances)
+    pending = iter(instances)
+    lock = threading.Lock()
+    done = []
+
+    def worker():
+        # workers pick up instances in schedule order, like the executor in `run_instances`
+        while True:
+            with lock:
+                instance = next(pending, None)
+            if instance is None:
+                return
+            scheduler.start_instance(instance["instance_id"])
+            pool.acquire(instance)
+            time.sleep(0.001)
+            scheduler.end_instance(instance["instance_id"])
+            scheduler.release_container()
+            done.append(instance["instance_id"])
+
+    # daemon threads, so that a deadlock fails the test instead of hanging it
+    workers = [threading.Thread(target=worker, daemon=True) for _ in range(2)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join(timeout=30)
+    assert len(done) == 30
+    pool.close()
+    assert max(in_use) <= max_containers and scheduler._usage[2] == 0
@@ -0,0 +1,53 @@
+import threading
+import time
+
+from rca.utils.eval_cache import EvalCache, get_eval_cache_metrics, patch_hash
+
+PATCH_A = "diff --git a/a.py b/a.py\nindex 111..222 100644\n--- a/a.py\n+++ b/a.py\n@@ -1 +1 @@\n-x = 1\n+x = 2\n"
+PATCH_B = "diff --git a/b.py b/b.py\nindex 333..444 100644\n--- a/b.py\n+++ b/b.py\n@@ -1 +1 @@\n-y = 1\n+y = 2\n"
+
+
+def test_patch_hash_normalization():
+    assert patch_hash(PATCH_A + PATCH_B) == patch_hash(PATCH_B + PATCH_A)
+    assert patch_hash(PATCH_A) == patch_hash("\n" + PATCH_A.replace("\n", "  \r\n").replace("index 111..222", "index abc..def"))
+    assert patch_hash(PATCH_A) != patch_hash(PATCH_B)
+    assert patch_hash("") == patch_hash("\n\n")
+
+
+def test_concurrent_requests_evaluate_once(tmp_path):
+    cache = EvalCache(tmp_path)
+    key = cache.key("instance", "sha256:abc", PATCH_A)
+    calls = []
+
+    def evaluate():
+        calls.append(1)
+        time.sleep(0.2)
+        return {"resolved": True}
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_evaluate(key, evaluate))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert sorted(status for _, status in results) == ["dedup", "dedup", "dedup", "miss"]
+    assert all(result == {"resolved": True} for result, _ in results)
+    assert cache.get_or_evaluate(key, evaluate) == ({"resolved": True}, "hit")
+    assert get_eval_cache_metrics([status for _, status in results] + [None]) == {
+        "eval_cache_hit_rate": 0.75,
+        "eval_cache_dedup_rate": 0.75,
+    }
+
+
+def test_uncacheable_results_are_not_stored(tmp_path):
+    cache = EvalCache(tmp_path)
+    key = cache.key("instance", "sha256:abc", "")
+    result = {"resolved": False, "eval_stages": None}
+    assert cache.get_or_evaluate(key, lambda: result, cacheable=lambda r: r["eval_stages"] is not None)[1] == "miss"
+    assert cache.get(key) is None
+
+
+def test_key_covers_eval_spec():
+    assert EvalCache.key("instance", "sha256:abc", PATCH_A, "full") != EvalCache.key("instance", "sha256:abc", PATCH_A, "staged")
+    assert EvalCache.key("instance", "sha256:abc", PATCH_A) != EvalCache.key("instance", "sha256:def", PATCH_A)
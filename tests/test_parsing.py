@@ -0,0 +1,91 @@
+import random
+import re
+
+from rca.utils.parsing import (
+    BashBlockEvent,
+    FunctionEvent,
+    ParameterEvent,
+    StreamingActionParser,
+    StreamingBashBlockParser,
+    parse_action,
+    parse_action_regex,
+    parse_actions,
+    parse_string_between_tags,
+)
+
+RESPONSE = """Let me look at the file.
+<function=str_replace_editor>
+<parameter=command>view</parameter>
+<parameter=path>/testbed/conan/tools/files/files.py</parameter>
+</function>
+trailing text"""
+
+FRAGMENTS = ["<function=", "</function>", "<parameter=", "</parameter>", ">", "<", "=", "a", "b", " ", "\n", "x" * 5]
+
+
+def random_responses(n, seed=0):
+    rng = random.Random(seed)
+    return ["".join(rng.choice(FRAGMENTS) for _ in range(rng.randint(0, 30))) for _ in range(n)]
+
+
+def test_parse_action_matches_regex():
+    responses = [RESPONSE, "", "no call", "<function=bash>unclosed", *random_responses(5000)]
+    for response in responses:
+        assert parse_action(response) == parse_action_regex(response), response
+        assert parse_action(response, string_only=True) == parse_action_regex(response, string_only=True), response
+    assert parse_actions(responses) == [parse_action_regex(r) for r in responses]
+    assert parse_string_between_tags(RESPONSE, "parameter") == "<parameter=command>view</parameter>"
+
+
+def test_streaming_parser_matches_parse_action():
+    rng = random.Random(1)
+    for response in [RESPONSE, *random_responses(2000, seed=2)]:
+        parser = StreamingActionParser()
+        events = []
+        position = 0
+        while position < len(response):
+            size = rng.randint(1, 8)
+            events.extend(parser.feed(response[position : position + size]))
+            position += size
+        expected = parse_action(response)
+        if expected is None:
+            assert not parser.done, response
+            continue
+        assert parser.done and isinstance(events[-1], FunctionEvent), response
+        assert (parser.function.name, parser.function.params) == expected, response
+        assert parser.function.text == parse_action(response, string_only=True)
+
+
+def test_streaming_parser_emits_parameters_when_closed():
+    parser = StreamingActionParser()
+    assert parser.feed("<function=bash>\n<parameter=command>ls") == []
+    assert parser.feed(" -la</param") == []
+    assert parser.feed("eter>\n") == [ParameterEvent("command", "ls -la")]
+    text = "<function=bash>\n<parameter=command>ls -la</parameter>\n</function>"
+    assert parser.feed("</function> ignored") == [FunctionEvent("bash", {"command": "ls -la"}, text)]
+    assert parser.feed("<function=other></function>") == []
+
+
+def test_streaming_bash_parser_never_stops_early():
+    pattern = re.compile(r"```bash\s*\n(.*?)\n```", re.DOTALL)
+    rng = random.Random(3)
+    fragments = ["```bash", "```", "\n", "\n\n", " ", "ls", "`", "b"]
+    for _ in range(5000):
+        response = "".join(rng.choice(fragments) for _ in range(rng.randint(0, 25)))
+        parser = StreamingBashBlockParser()
+        events = []
+        position = 0
+        while position < len(response) and not parser.done:
+            size = rng.randint(1, 5)
+            events.extend(parser.feed(response[position : position + size]))
+            position += size
+        if parser.done:
+            # the stream is cut at `end`, which must not change the action the agent parses
+            match = pattern.search(response)
+            assert match is not None and match.end() == parser.end, response
+            assert events == [BashBlockEvent(match.group(1).strip())]
+            assert pattern.findall(response[: parser.end]) == [match.group(1)]
+
+    parser = StreamingBashBlockParser()
+    assert parser.feed("Listing files.\n```bash\nls -la\n") == []
+    assert parser.feed("```\nand more") == [BashBlockEvent("ls -la")]
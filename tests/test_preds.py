@@ -0,0 +1,39 @@
+import json
+
+from rca.utils.preds import PredictionsStore
+
+
+def test_update_remove_and_compact(tmp_path):
+    store = PredictionsStore(tmp_path / "preds.json", compact_every=0)
+    store.update("a", "model", "patch-a")
+    store.update("b", "model", "patch-b")
+    store.remove("a")
+    store.update("b", "model", "patch-b2")
+    assert store.instance_ids() == {"b"}
+    assert not (tmp_path / "preds.json").exists()
+
+    store.compact()
+    assert not store.log_path.exists()
+    preds = json.loads((tmp_path / "preds.json").read_text())
+    assert preds == {"b": {"model_name_or_path": "model", "instance_id": "b", "model_patch": "patch-b2"}}
+
+
+def test_torn_write_is_ignored(tmp_path):
+    store = PredictionsStore(tmp_path / "preds.json", compact_every=0)
+    store.update("a", "model", "patch-a")
+    with open(store.log_path, "a") as f:
+        f.write('{"instance_id": "b", "model_pa')
+    assert store.instance_ids() == {"a"}
+
+    # appending after a torn line must not lose the new record
+    store.update("c", "model", "patch-c")
+    assert store.instance_ids() == {"a", "c"}
+
+
+def test_automatic_compaction_keeps_existing_preds(tmp_path):
+    (tmp_path / "preds.json").write_text(json.dumps({"old": {"instance_id": "old", "model_patch": ""}}))
+    store = PredictionsStore(tmp_path / "preds.json", compact_every=2)
+    store.update("a", "model", "patch-a")
+    store.update("b", "model", "patch-b")
+    assert not store.log_path.exists()
+    assert set(json.loads((tmp_path / "preds.json").read_text())) == {"old", "a", "b"}
@@ -0,0 +1,50 @@
+import pickle
+
+from rca.datasets.prefix_dataset import PrefixDataset, PrefixDatasetWriter
+
+TRAJECTORIES = [
+    [
+        {"role": "system", "content": "sys"},
+        {"role": "user", "content": "task 0"},
+        {"role": "assistant", "content": "ls"},
+        {"role": "user", "content": "a.py"},
+        {"role": "assistant", "content": "cat a.py"},
+    ],
+    [
+        {"role": "system", "content": "sys"},
+        {"role": "user", "content": "task 1"},
+        {"role": "assistant", "content": "submit"},
+    ],
+]
+
+
+def test_writer_dataset_round_trip(tmp_path):
+    samples = {"train": [(0, 0, 2), (1, 0, 2), (0, 1, 4)], "test": [(0, 1, 4)]}
+    # a batch size below the number of rows, so that several record batches are written
+    with PrefixDatasetWriter(str(tmp_path), "swe-data", batch_size=2) as writer:
+        assert [writer.add_trajectory(messages) for messages in TRAJECTORIES] == [0, 1]
+        for split, split_samples in samples.items():
+            for trajectory_id, turn, n in split_samples:
+                writer.add_sample(split, trajectory_id, turn, n)
+
+    for split, split_samples in samples.items():
+        dataset = PrefixDataset(str(tmp_path), split)
+        assert len(dataset) == len(split_samples)
+        for row, (trajectory_id, turn, n) in zip((dataset[i] for i in range(len(dataset))), split_samples):
+            output = TRAJECTORIES[trajectory_id][n]["content"]
+            assert row == {
+                "id": trajectory_id,
+                "turn": turn,
+                "input": TRAJECTORIES[trajectory_id][:n],
+                "output": output,
+                "N": n,
+                "data_source": "swe-data",
+                "reward_model": {"ground_truth": output},
+                "extra_info": {"task": "swe-data", "ground_truth": output, "reward_partial": True},
+            }
+
+    dataset = PrefixDataset(str(tmp_path), "train")
+    assert dataset[-1]["output"] == "cat a.py"
+    # workers get the path, not the tables
+    copy = pickle.loads(pickle.dumps(dataset))
+    assert copy._samples is None and copy[0] == dataset[0]
@@ -0,0 +1,93 @@
+import json
+import multiprocessing
+import pickle
+import threading
+import time
+
+from rca.utils.scheduling import InstanceEstimate, InstanceScheduler, get_repo, load_history
+
+
+def write_traj(path, instance_id, info):
+    path.mkdir(parents=True, exist_ok=True)
+    (path / f"{instance_id}.traj.json").write_text(json.dumps({"info": info}))
+
+
+def test_load_history(tmp_path):
+    stats = {"api_calls": 12, "instance_cost": 0.5}
+    write_traj(tmp_path / "run1" / "a", "django__django-1", {"wall_time": 30.0, "model_stats": stats})
+    write_traj(tmp_path / "run1" / "b", "django__django-2", {"exit_status": "Uncaught RuntimeError"})
+    write_traj(tmp_path / "run1" / "c", "flask__flask-3", {"model_stats": stats, "traceback": "..."})
+    history = load_history([tmp_path])
+    assert history == {"django__django-1": InstanceEstimate(wall_time=30.0, steps=12.0, cost=0.5)}
+    assert get_repo("owner__repo.abc123.func_pm_ctrl__x1") == "owner__repo.abc123"
+
+
+def test_order_falls_back_to_repo_mean():
+    scheduler = InstanceScheduler(
+        {
+            "django__django-1": InstanceEstimate(wall_time=100.0, steps=10, cost=1.0),
+            "flask__flask-1": InstanceEstimate(wall_time=10.0, steps=5, cost=0.1),
+            "flask__flask-2": InstanceEstimate(wall_time=30.0, steps=5, cost=0.1),
+        }
+    )
+    instances = [{"instance_id": i} for i in ("flask__flask-1", "flask__flask-9", "django__django-9", "sympy__sympy-1")]
+    # unknown repos get the global mean (~47s), unknown flask instances the flask mean (20s)
+    assert [i["instance_id"] for i in scheduler.order(instances)] == [
+        "django__django-9",
+        "sympy__sympy-1",
+        "flask__flask-9",
+        "flask__flask-1",
+    ]
+
+
+def test_budgets_block_until_released():
+    history = {"big": InstanceEstimate(wall_time=0, steps=0, cost=0.8), "small": InstanceEstimate(wall_time=0, steps=0, cost=0.3)}
+    scheduler = InstanceScheduler(history, max_concurrent_cost=1.0, max_containers=1)
+    # over the budget on its own, but nothing else is running
+    scheduler.start_instance("big")
+    scheduler.acquire_container()
+    events = []
+
+    def start_small():
+        scheduler.start_instance("small")
+        events.append("started")
+        scheduler.acquire_container()
+        events.append("container")
+
+    thread = threading.Thread(target=start_small)
+    thread.start()
+    time.sleep(0.1)
+    assert events == []
+    scheduler.end_instance("big")
+    time.sleep(0.1)
+    assert events == ["started"]
+    scheduler.release_container()
+    thread.join(timeout=5)
+    assert events == ["started", "container"]
+
+    # a copy starts with nothing running
+    copy = pickle.loads(pickle.dumps(scheduler))
+    assert (copy.max_concurrent_cost, copy.max_containers) == (1.0, 1)
+    copy.acquire_container()
+    copy.start_instance("big")
+
+
+def start_big_instance(scheduler):
+    scheduler.acquire_container()
+    scheduler.start_instance("big")
+
+
+def test_shared_budgets_across_processes():
+    history = {"big": InstanceEstimate(wall_time=0, steps=0, cost=0.8)}
+    context = multiprocessing.get_context("spawn")
+    scheduler = InstanceScheduler(history, max_concurrent_cost=1.0, max_containers=2).share(context)
+    process = context.Process(target=start_big_instance, args=(scheduler,))
+    process.start()
+    process.join(timeout=30)
+    assert process.exitcode == 0
+    # the slot and the cost taken by the other process count here
+    assert list(scheduler._usage) == [0.8, 1, 1]
+    scheduler.acquire_container()
+
+    # environments provisioned ahead must leave a container for every worker
+    assert [scheduler.pool_depth(4, workers) for workers in (1, 2, 3)] == [1, 0, 0]
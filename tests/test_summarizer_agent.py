@@ -0,0 +1,50 @@
+from minisweagent.environments.local import LocalEnvironment
+from minisweagent.models.test_models import DeterministicModel
+
+from rca.agents.summarizer_agent import SummarizerAgent
+
+AGENT_CONFIG = {
+    "system_template": "system",
+    "instance_template": "{{task}}",
+    "action_observation_template": "{{output.output}}",
+    "format_error_template": "format error",
+    "step_limit": 0,
+    "cost_limit": 0,
+}
+
+
+class RecordingModel(DeterministicModel):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.requests = []
+
+    def query(self, messages, **kwargs):
+        self.requests.append(messages)
+        return super().query(messages, **kwargs)
+
+
+class EchoSummarizer(DeterministicModel):
+    """Summarizes by returning the update request, which lists the folded messages."""
+
+    def query(self, messages, **kwargs):
+        self.n_calls += 1
+        return {"content": messages[-1]["content"]}
+
+
+def test_pipelined_summary_covers_last_observation():
+    # the observation (upper case) differs from the command, which is summarized before it runs
+    steps = [f"```bash\necho observation-{i} | tr a-z A-Z\n```" for i in range(3)]
+    deliberator = RecordingModel(outputs=steps + ["```bash\necho COMPLETE_TASK_AND_SUBMIT_FINAL_OUTPUT\n```"], cost_per_call=0.0)
+    agent = SummarizerAgent(
+        deliberator,
+        EchoSummarizer(outputs=[], cost_per_call=0.0),
+        LocalEnvironment(),
+        **AGENT_CONFIG,
+        summary_mode="incremental",
+        summary_pipeline=True,
+        summary_deadline=30.0,
+    )
+    assert agent.run("Fix the bug")[0] == "Submitted"
+    for i, request in enumerate(deliberator.requests[1:]):
+        assert f"OBSERVATION-{i}" in request[1]["content"]
+    assert not any(stats.get("stale") for stats in agent.summary_stats)
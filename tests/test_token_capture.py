@@ -0,0 +1,72 @@
+import copy
+
+from rca.generators.token_capture import assemble_captured_tokens, compact_token_records
+from rca.generators.tokenization import TrajectoryTokenizer
+
+ROLE_IDS = {"system": 1, "user": 2, "assistant": 3}
+END_ID = 0
+
+
+class CharTokenizer:
+    """Chat template with one token per character, each message framed by a role and an end token."""
+
+    def _render(self, messages):
+        ids = []
+        for message in messages:
+            ids += [ROLE_IDS[message["role"]], *map(ord, message["content"]), END_ID]
+        return ids
+
+    def apply_chat_template(self, conversation, add_generation_prompt=False, tokenize=True):
+        if conversation and isinstance(conversation[0], list):
+            return [self._render(messages) for messages in conversation]
+        return self._render(conversation)
+
+
+def captured_trajectory(tokenizer, contents):
+    """Messages as the agent records them, with the token ids an endpoint using `tokenizer` would return."""
+    messages = [{"role": "system", "content": "sys"}, {"role": "user", "content": "task"}]
+    for i, content in enumerate(contents):
+        response_ids = tokenizer.apply_chat_template([{"role": "assistant", "content": content}])
+        response = {
+            "prompt_token_ids": tokenizer.apply_chat_template(messages),
+            "choices": [{"token_ids": response_ids, "logprobs": {"content": [{"logprob": -0.5}] * len(response_ids)}}],
+        }
+        messages.append({"role": "assistant", "content": content, "extra": {"response": response}})
+        messages.append({"role": "user", "content": f"observation {i}"})
+    return messages
+
+
+def test_captured_tokens_match_retokenized_trajectory():
+    tokenizer = CharTokenizer()
+    messages = captured_trajectory(tokenizer, ["ls", "cat a.py", "submit"])
+    expected_prompt, expected_response, expected_mask = TrajectoryTokenizer(tokenizer).tokenize("instance", messages)
+
+    compacted = copy.deepcopy(messages)
+    compact_token_records(compacted)
+    for trajectory in (messages, compacted):
+        prompt_ids, response_ids, loss_mask, logprobs = assemble_captured_tokens(trajectory)
+        assert prompt_ids == expected_prompt
+        assert response_ids.tolist() == expected_response.tolist()
+        assert loss_mask.tolist() == expected_mask.tolist()
+        assert logprobs.tolist() == [-0.5 if m else 0.0 for m in loss_mask.tolist()]
+
+
+def test_compact_token_records_keeps_last_prompt():
+    messages = captured_trajectory(CharTokenizer(), ["ls", "cat a.py", "submit"])
+    full_size = sum(len(m["extra"]["response"]["prompt_token_ids"]) for m in messages if m["role"] == "assistant")
+    compact_token_records(messages)
+    responses = [m["extra"]["response"] for m in messages if m["role"] == "assistant"]
+    assert [r["prompt_token_ids"] is None for r in responses] == [True, True, False]
+    assert len(responses[-1]["prompt_token_ids"]) < full_size
+    assert assemble_captured_tokens(messages) is not None
+
+
+def test_inconsistent_template_is_rejected():
+    messages = captured_trajectory(CharTokenizer(), ["ls", "submit"])
+    # the template rendered the first response differently in the second prompt (e.g. dropped reasoning)
+    messages[4]["extra"]["response"]["prompt_token_ids"][len("sys") + len("task") + 6] = ord("X")
+    assert assemble_captured_tokens(messages) is None
+    compact_token_records(messages)
+    assert assemble_captured_tokens(messages) is None
+    del messages[2]["extra"]["response"]["prompt_token_count"]
+    assert assemble_captured_tokens(messages) is None
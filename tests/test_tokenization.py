@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+from rca.generators.tokenization import TrajectoryTokenizer
+
+MESSAGES = [
+    {"role": "system", "content": "sys"},
+    {"role": "user", "content": "task"},
+    {"role": "assistant", "content": "ls"},
+    {"role": "user", "content": "a.py"},
+    {"role": "assistant", "content": "submit"},
+    {"role": "user", "content": "diff"},
+]
+
+
+class CountingTokenizer:
+    """One token per character, with a role token in front of each message."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def _render(self, messages):
+        return [ord(m["role"][0]) for m in messages[:1]] + [ord(c) for m in messages for c in m["content"]]
+
+    def apply_chat_template(self, conversation, add_generation_prompt=False, tokenize=True):
+        self.calls += 1
+        if conversation and isinstance(conversation[0], list):
+            return [self._render(messages) for messages in conversation]
+        return self._render(conversation)
+
+
+def test_tokenize_matches_per_message_templating():
+    tokenizer = CountingTokenizer()
+    trajectory_tokenizer = TrajectoryTokenizer(tokenizer)
+    prompt_ids, response_ids, loss_mask = trajectory_tokenizer.tokenize("instance", MESSAGES)
+
+    assert prompt_ids == tokenizer._render(MESSAGES[:2])
+    # the trailing user message (the final diff) is dropped
+    expected_ids, expected_mask = [], []
+    for message in MESSAGES[2:5]:
+        ids = tokenizer._render([message])
+        expected_ids += ids
+        expected_mask += [int(message["role"] == "assistant")] * len(ids)
+    assert response_ids.tolist() == expected_ids
+    assert loss_mask.tolist() == expected_mask
+
+    # the prompt is cached per instance, the responses are templated in one batched call
+    calls = tokenizer.calls
+    assert asyncio.run(trajectory_tokenizer.atokenize("instance", MESSAGES))[0] == prompt_ids
+    assert tokenizer.calls == calls + 1
+    changed = [MESSAGES[0], {"role": "user", "content": "other task"}, *MESSAGES[2:]]
+    assert trajectory_tokenizer.tokenize("instance", changed)[0] == tokenizer._render(changed[:2])
+
+
+def test_tokenize_requires_an_assistant_message():
+    with pytest.raises(ValueError, match="no assistant messages"):
+        TrajectoryTokenizer(CountingTokenizer()).tokenize("instance", MESSAGES[:2] + [MESSAGES[3]])